@@ -2,13 +2,19 @@ import copy
 import inspect
 import logging
 import logging.handlers
-import re
 import sys
 import threading
 import time
 from havocbot import pluginmanager
 from havocbot import httpserver
+from havocbot.cache import TTLCache
+from havocbot.common import gather_executor
+from havocbot.dispatcher import Dispatcher, parse_concurrency_limits
+from havocbot.httpclient import HTTPClient
+from havocbot.metrics import Metrics
+from havocbot.scheduler import Scheduler
 from havocbot.stasherfactory import StasherFactory
+from havocbot.triggerindex import TriggerIndex, create_trigger_index
 from havocbot.user import UserDoesNotExist
 
 # Python2/3 compat
@@ -34,15 +40,32 @@ class HavocBot:
         self.plugins_core = []
         self.plugins_custom = []
         self.triggers = []
+        self.trigger_index = TriggerIndex()
+        self.dispatcher = Dispatcher()
         self.settings = {}
         self.settings_file = None
         self.is_configured = False
         self.processing_threads = []
+        self.shutdown_threads = []
+        self.shutdown_timeout = 10
+        self.shutdown_started = None
+        self.state_changed = threading.Event()
         self.should_shutdown = False
         self.should_restart = False
+        self.metrics = Metrics()
         self.http_server = None
+        self.http = HTTPClient(metrics=self.metrics)
+        self.scheduler = Scheduler()
         self.exact_match_one_word_triggers = False
-        self.db = StasherFactory.factory('StasherTinyDB')
+        self.stasher = 'StasherTinyDB'
+        self.stasher_sqlite_file = 'stasher/havocbot.sqlite'
+        self.stasher_flush_interval = 5
+        self.stasher_flush_threshold = 100
+        self.stasher_oplog = False
+        self.stasher_oplog_compact_threshold = 1000
+        self.db = None
+        self.permission_cache_ttl = 300
+        self.permission_cache = TTLCache(ttl=self.permission_cache_ttl)
 
     def configure(self, settings_file):
         self.load_settings_from_file(settings_file)
@@ -102,6 +125,11 @@ class HavocBot:
         {'havocbot': [('plugins_dir', 'plugins'),
         ('property2', 'value12)], ...}
         """
+        # The previous dispatcher, HTTP session and scheduler have been stopped if this is a restart
+        self.dispatcher = Dispatcher()
+        self.http = HTTPClient(metrics=self.metrics)
+        self.scheduler = Scheduler()
+
         if settings_dict is not None and 'havocbot' in settings_dict:
             for (key, value) in settings_dict['havocbot']:
                 if key == 'plugin_dirs':
@@ -115,6 +143,61 @@ class HavocBot:
                         self.exact_match_one_word_triggers = True
                     else:
                         self.exact_match_one_word_triggers = False
+                elif key == 'trigger_matcher':
+                    self.trigger_index = create_trigger_index(value)
+                    self.trigger_index.rebuild(self.triggers, self.exact_match_one_word_triggers)
+                elif key == 'stasher':
+                    self.stasher = value.strip()
+                elif key == 'stasher_sqlite_file':
+                    self.stasher_sqlite_file = value.strip()
+                elif key == 'stasher_flush_interval':
+                    self.stasher_flush_interval = int(value)
+                elif key == 'stasher_flush_threshold':
+                    self.stasher_flush_threshold = int(value)
+                elif key == 'stasher_oplog':
+                    self.stasher_oplog = value.lower() == 'true'
+                elif key == 'stasher_oplog_compact_threshold':
+                    self.stasher_oplog_compact_threshold = int(value)
+                elif key == 'permission_cache_ttl':
+                    self.permission_cache_ttl = int(value)
+                elif key == 'http_timeout':
+                    self.http.timeout = float(value)
+                elif key == 'http_retries':
+                    self.http.retries = int(value)
+                elif key == 'http_backoff_factor':
+                    self.http.backoff_factor = float(value)
+                elif key == 'http_pool_size':
+                    self.http.pool_maxsize = int(value)
+                elif key == 'shutdown_timeout':
+                    self.shutdown_timeout = int(value)
+                elif key == 'dispatch_workers':
+                    self.dispatcher.workers = int(value)
+                elif key == 'dispatch_max_queue_depth':
+                    self.dispatcher.max_queue_depth = int(value)
+                elif key == 'dispatch_max_plugin_queue_depth':
+                    self.dispatcher.max_plugin_queue_depth = int(value)
+                elif key == 'dispatch_max_catch_all_queue_depth':
+                    self.dispatcher.max_catch_all_queue_depth = int(value)
+                elif key == 'dispatch_plugin_concurrency':
+                    self.dispatcher.plugin_concurrency = int(value)
+                elif key == 'dispatch_plugin_concurrency_limits':
+                    self.dispatcher.plugin_concurrency_limits = parse_concurrency_limits(value)
+                elif key == 'gather_workers':
+                    gather_executor.workers = int(value)
+                elif key == 'gather_max_pending':
+                    gather_executor.max_pending = int(value)
+
+        if self.stasher == 'StasherSQLite':
+            self.db = StasherFactory.factory(self.stasher, path=self.stasher_sqlite_file)
+        else:
+            self.db = StasherFactory.factory(self.stasher, flush_interval=self.stasher_flush_interval,
+                                             flush_threshold=self.stasher_flush_threshold,
+                                             oplog=self.stasher_oplog,
+                                             oplog_compact_threshold=self.stasher_oplog_compact_threshold)
+
+        # Resolved permissions are cached per sender until the stasher reports a change to the user
+        self.permission_cache = TTLCache(ttl=self.permission_cache_ttl)
+        self.db.add_change_listener(self.invalidate_permissions)
 
     def configure_clients(self, clients_dict):
         """ Configures a client integration prior to starting up.
@@ -211,11 +294,22 @@ class HavocBot:
         return next((obj[1] for obj in self.settings['havocbot']['havocbot'] if name == obj[0]), None)
 
     def start(self):
+        # Main thread of the bot
+        self.process()
+
+    def start_services(self):
+        """ Prepares the bot to run its clients.
+
+        Returns True if there are client integrations to start.
+        """
         if self.is_configured is not True:
             sys.exit('Havocbot has not been configured. Please configure the bot and try again')
         else:
             logger.info("Starting HavocBot")
 
+        # Start the thread that runs the delayed and repeating plugin callbacks
+        self.scheduler.start()
+
         # Start HTTP server if enabled
         if self.http_server is not None and self.http_server.is_enabled is True:
             self.http_server.start()
@@ -223,145 +317,226 @@ class HavocBot:
         if self.clients is not None and self.clients:
             logger.debug("Setting should_shutdown to False")
             self.should_shutdown = False
-
-            # Connect and begin processing for each client in tuple
-            for client in self.clients:
-                # Spawn a thread for each unconnected client
-                logger.debug("Spawning new daemon thread for client %s" % client.integration_name)
-                t = ClientThread(self)
-                t.daemon = True
-                self.processing_threads.append(t)
-                t.start()
-
-                logger.info("Connecting to %s" % client.integration_name)
-
-                # Have the client connect to the client's services
-                if client.connect():
-                    logger.info("%s client is connected" % client.integration_name)
-
-                    self.queue.put(client)
-                else:
-                    logger.error("Unable to connect to the client %s" % client.integration_name)
-
-            # Main thread of the bot
-            self.process()
+            return True
         else:
             logger.critical((
                 'No valid client integrations found. Make sure the settings.ini file has an '
                 'entry for clients_enabled and that the settings for the client are configured')
             )
+            return False
+
+    def start_clients(self):
+        # Start the workers that run triggered plugin functions
+        self.dispatcher.start()
+
+        # A fresh queue so wake up markers left from a previous shutdown are never read
+        self.queue = Queue()
+
+        # Connect and begin processing for each client in tuple
+        for client in self.clients:
+            # Spawn a thread for each unconnected client
+            logger.debug("Spawning new daemon thread for client %s" % client.integration_name)
+            t = ClientThread(self)
+            t.daemon = True
+            self.processing_threads.append(t)
+            t.start()
+
+            logger.info("Connecting to %s" % client.integration_name)
+
+            # Have the client connect to the client's services
+            if client.connect():
+                logger.info("%s client is connected" % client.integration_name)
+
+                self.queue.put(client)
+            else:
+                logger.error("Unable to connect to the client %s" % client.integration_name)
 
     def process(self):
+        """ Supervises the bot from the main thread.
+
+        Each pass starts the services and clients and then runs them until
+        they are shut down. A restart reconfigures the bot and makes another
+        pass. The supervisor returns after any other shutdown or when there
+        are no clients to start.
+        """
         try:
-            while threading.activeCount() > 0:
-                """
-                If exit mode is true the bot will be expecting
-                processing threads to die off. During every loop the bot
-                will be checking to see if background threads have
-                switched to inactive status. If so, the thread will be
-                removed from the active processing thread list.
-                """
-
-                # logger.debug(
-                #     "Main Loop - active threads: %s, "
-                #     "should_shutdown: %s, should_restart: %s"
-                #     % (threading.activeCount(), self.should_shutdown,
-                #        self.should_restart)
-                # )
-                if self.should_shutdown:
-                    # Updating the list with only the threads that are still active
-                    self.processing_threads = [x for x in self.processing_threads if x.is_alive()]
-
-                    """
-                    Integrations like xmpp rely on sleekxmpp behind the
-                    scenes for processing. Sleekxmpp spawns its own
-                    background threads for scheduling purposes that take
-                    a little while longer to stop then the items in
-                    self.processing_threads so this next conditional will
-                    wait not only until HavocBot threads are burned down
-                    but also until the total active threads are down to
-                    just the main thread.
-
-                    TODO: This probably should be redone to be cleaner.
-                    """
-                    if len(self.processing_threads) == 0:
-                        if threading.activeCount() == 1:
-                            logger.debug('Only the main thread is active. All background threads have exited')
-                            self.should_shutdown = False
-                        else:
-                            logger.debug('Waiting on non HavocBot background thread to exit')
-                    else:
-                        logger.debug('Waiting on HavocBot background thread to exit')
-                else:
-                    # Reconfigure and restart the bot if coming from a restart event
-                    if self.should_restart:
-                        self.should_restart = False
-                        self.configure(self.settings_file)
-                        self.start()
-                time.sleep(0.5)
+            is_restart = False
+
+            while self.start_services():
+                self.start_clients()
+                if is_restart:
+                    self.record_restart()
+
+                self.run_clients()
+
+                # Reconfigure and restart the bot if coming from a restart event
+                if not self.should_restart:
+                    break
+
+                self.should_restart = False
+                self.configure(self.settings_file)
+                is_restart = True
         except (KeyboardInterrupt, SystemExit) as e:
             logger.info("Interrupt received - %s" % e)
             # Cleanup before finally exiting
             self.should_shutdown = True
             self.exit()
 
+    def run_clients(self):
+        """ Sleeps until a shutdown is requested instead of polling.
+
+        The shutdown then joins the client threads and the threads owned by
+        the client integrations, like the sleekxmpp scheduler, so a restart
+        never overlaps the previous clients.
+        """
+        # should_shutdown is set as a shutdown starts. The state change comes once it has finished
+        self.wait_for_state_change()
+        while not self.should_shutdown:
+            self.wait_for_state_change()
+
+        self.join_threads(self.shutdown_threads, self.shutdown_timeout)
+        self.shutdown_threads = []
+        self.processing_threads = []
+        self.should_shutdown = False
+
+    def wait_for_state_change(self):
+        # Python 2 can not interrupt a wait without a timeout so it wakes up periodically there
+        timeout = None if sys.version_info >= (3,) else 60
+
+        while not self.state_changed.wait(timeout):
+            pass
+
+        self.state_changed.clear()
+
+    def join_threads(self, threads, timeout):
+        """ Joins the threads, giving all of them a shared timeout in seconds.
+
+        Returns the list of threads that were still alive when the timeout ran out.
+        """
+        start = time.time()
+        deadline = start + timeout
+        remaining = []
+
+        logger.info("Waiting up to %d seconds for %d threads to exit" % (timeout, len(threads)))
+
+        for (index, thread) in enumerate(threads, 1):
+            thread.join(max(0, deadline - time.time()))
+
+            if thread.is_alive():
+                logger.warning("Thread %s did not exit in time (%d of %d)" % (thread.name, index, len(threads)))
+                remaining.append(thread)
+            else:
+                logger.debug("Thread %s has exited (%d of %d)" % (thread.name, index, len(threads)))
+
+        elapsed = time.time() - start
+        self.metrics.timing('havocbot.shutdown', elapsed)
+        self.metrics.gauge('havocbot.shutdown.threads_remaining', len(remaining))
+
+        logger.info("Shutdown finished in %.2f seconds with %d threads still running" % (elapsed, len(remaining)))
+
+        return remaining
+
+    def record_restart(self):
+        if self.shutdown_started is not None:
+            elapsed = time.time() - self.shutdown_started
+            self.metrics.timing('havocbot.restart', elapsed)
+            logger.info("Restart completed in %.2f seconds" % elapsed)
+
     def handle_message(self, client, message_object):
-        for tuple_item in self.triggers:
-            trigger = tuple_item[0]
+        for (entry, match) in self.trigger_index.match_entries(message_object.text):
+            tuple_item = entry.trigger
             triggered_function = tuple_item[1]
 
-            # Add exact regex match if user defined
-            if len(trigger.split()) == 1 and self.exact_match_one_word_triggers is True:
-                if not trigger.startswith('^') and not trigger.endswith('$'):
-                    # logger.debug("Converting trigger to a line exact match requirement")
-                    trigger = "^" + trigger + "$"
-
-            # Use trigger as regex pattern and then search the message for a match
-            regex = re.compile(trigger)
-
-            match = regex.search(message_object.text)
-            if match is not None:
-                logger.info("%s - Matched message against trigger '%s'" % (
-                    self.get_method_class_name(triggered_function), trigger))
-
-                # Pass the message to the function associated with the trigger
-                try:
-                    if hasattr(tuple_item, 'requires') and tuple_item.requires:
-                        logger.debug("This trigger requires permission '%s'" % tuple_item.requires)
-
-                        # Check if user has this permission
-                        try:
-                            user = self.db.find_user_by_username_for_client(message_object.sender,
-                                                                            message_object.client)
-                        except UserDoesNotExist:
-                            text = 'That can only be run by users registered with me'
-                            client.send_message(text, message_object.reply(), event=message_object.event)
-                        else:
-                            if user.has_permission(tuple_item.requires):
-                                logger.debug("permission '%s' found for user %s" % (tuple_item.requires, user.user_id))
-
-                                if hasattr(tuple_item, 'param_dict') and tuple_item.param_dict:
-                                    triggered_function(client, message_object, capture_groups=match.groups(),
-                                                       **tuple_item.param_dict)
-                                else:
-                                    triggered_function(client, message_object, capture_groups=match.groups())
-                            else:
-                                logger.debug("permission '%s' not found for user %s" % (
-                                    tuple_item.requires, user.user_id))
-                                text = 'You do not have permission to do that. Permission required: %s' % \
-                                       tuple_item.requires
-                                client.send_message(text, message_object.reply(), event=message_object.event)
+            logger.info("%s - Matched message against trigger '%s'" % (
+                self.get_method_class_name(triggered_function), entry.pattern))
+
+            # Catch-all triggers see every message. They keep their place in the plugin's queue but have their own limit
+            plugin_name = self.get_method_plugin_name(triggered_function)
+            if entry.is_catch_all:
+                submit = self.dispatcher.submit_catch_all
+                metric_name = '%s.catch-all' % plugin_name
+            else:
+                submit = self.dispatcher.submit
+                metric_name = plugin_name
+
+            # Hand the work to the dispatcher so the client can keep reading messages
+            if not submit(plugin_name, self.run_trigger, client, message_object, tuple_item, match):
+                self.metrics.increment('havocbot.dispatch.rejected')
+                self.metrics.increment('havocbot.dispatch.rejected.%s' % metric_name)
+                logger.warning("%s - Dropped message from %s for trigger '%s'. The plugin has too much pending work" % (
+                    plugin_name, message_object.sender, entry.pattern))
+
+    def run_trigger(self, client, message_object, tuple_item, match):
+        triggered_function = tuple_item[1]
+
+        # Pass the message to the function associated with the trigger
+        try:
+            if self.has_trigger_permission(client, message_object, tuple_item):
+                triggered_function(client, message_object, **self.get_trigger_kwargs(tuple_item, match))
+        except Exception as e:
+            logger.error(e)
+            raise
+
+    def has_trigger_permission(self, client, message_object, tuple_item):
+        if hasattr(tuple_item, 'requires') and tuple_item.requires:
+            logger.debug("This trigger requires permission '%s'" % tuple_item.requires)
+
+            # Check if user has this permission
+            (user_id, permissions) = self.get_sender_permissions(message_object)
+
+            if user_id is None:
+                text = 'That can only be run by users registered with me'
+                client.send_message(text, message_object.reply(), event=message_object.event)
+            elif tuple_item.requires in permissions:
+                logger.debug("permission '%s' found for user %s" % (tuple_item.requires, user_id))
+                return True
+            else:
+                logger.debug("permission '%s' not found for user %s" % (tuple_item.requires, user_id))
+                text = 'You do not have permission to do that. Permission required: %s' % tuple_item.requires
+                client.send_message(text, message_object.reply(), event=message_object.event)
+
+            return False
+        else:
+            logger.debug("This trigger does not require permission")
+            return True
 
-                    else:
-                        logger.debug("This trigger does not require permission")
-                        if hasattr(tuple_item, 'param_dict') and tuple_item.param_dict:
-                            triggered_function(client, message_object, capture_groups=match.groups(),
-                                               **tuple_item.param_dict)
-                        else:
-                            triggered_function(client, message_object, capture_groups=match.groups())
-                except Exception as e:
-                    logger.error(e)
-                    raise
+    def get_sender_permissions(self, message_object):
+        """ Returns a (user_id, permissions) tuple for the sender of a message.
+
+        The user_id is None if the sender is not a registered user.
+        """
+        key = (message_object.client, message_object.sender)
+
+        result = self.permission_cache.get(key)
+        if result is not None:
+            self.metrics.increment('havocbot.permission_cache.hit')
+            return result
+
+        self.metrics.increment('havocbot.permission_cache.miss')
+        generation = self.permission_cache.generation
+
+        try:
+            user = self.db.find_user_by_username_for_client(message_object.sender, message_object.client)
+        except UserDoesNotExist:
+            result = (None, frozenset())
+        else:
+            result = (user.user_id, frozenset(user.permissions or []))
+
+        self.permission_cache.set(key, result, generation=generation)
+
+        return result
+
+    def invalidate_permissions(self, user_id):
+        # Unregistered senders are dropped too since the change may have been adding them
+        self.permission_cache.remove_where(lambda key, value: value[0] is None or value[0] == user_id)
+
+    def get_trigger_kwargs(self, tuple_item, match):
+        kwargs = {'capture_groups': match.groups()}
+
+        if hasattr(tuple_item, 'param_dict') and tuple_item.param_dict:
+            kwargs.update(tuple_item.param_dict)
+
+        return kwargs
 
     def register_triggers(self, trigger_tuple_list):
         if trigger_tuple_list:
@@ -377,6 +552,7 @@ class HavocBot:
             logger.debug("Loading %s new %s. %s %s previously loaded" % (
                 triggers_length, triggers_phrase, existing_triggers_length, existing_triggers_phrase))
             self.triggers = working_copy_triggers
+            self.trigger_index.rebuild(self.triggers, self.exact_match_one_word_triggers)
 
     def unregister_triggers(self, trigger_tuple_list):
         if trigger_tuple_list:
@@ -397,6 +573,7 @@ class HavocBot:
             logger.debug("Removing %s existing %s. %s %s previously loaded" % (
                 triggers_length, triggers_phrase, existing_triggers_length, existing_triggers_phrase))
             self.triggers = working_copy_triggers
+            self.trigger_index.rebuild(self.triggers, self.exact_match_one_word_triggers)
 
     def reload_plugins(self):
         self.plugins_core = pluginmanager.load_plugins_core(self)
@@ -411,23 +588,42 @@ class HavocBot:
         self.shutdown()
 
     def shutdown(self):
+        self.shutdown_started = time.time()
         self.disconnect()
 
-        # Need to kill threads
+        # Collect the threads the supervisor must wait on before a restart
+        self.shutdown_threads = list(self.processing_threads)
+        for client in self.clients:
+            self.shutdown_threads.extend(client.get_threads())
+
+        # Wake up client threads still waiting on a client to process
         for thread in self.processing_threads:
             if thread.is_active:
-                thread.queue.task_done()
-                thread.is_active = False
+                self.queue.put(None)
 
         self.clients = []
         self.plugins_core = []
         self.plugins_custom = []
         self.triggers = []
+        self.trigger_index.rebuild(self.triggers)
+        self.dispatcher.stop()
+        self.scheduler.stop()
         self.is_configured = False
 
+        # Write out any batched stasher changes
+        if self.db is not None:
+            self.db.close()
+
         if self.http_server is not None and self.http_server:
             self.http_server.stop()
 
+        self.http.close()
+
+        logger.debug("Metrics at shutdown - %s" % self.metrics.snapshot())
+
+        # Wake up the supervisor
+        self.state_changed.set()
+
     def disconnect(self):
         self.should_shutdown = True
         for client in self.clients:
@@ -497,6 +693,14 @@ class HavocBot:
         else:
             return method.__self__.__class__.__name__
 
+    def get_method_plugin_name(self, method):
+        plugin = getattr(method, '__self__', None)
+
+        if plugin is not None and hasattr(plugin, 'plugin_short_name'):
+            return plugin.plugin_short_name
+        else:
+            return self.get_method_class_name(method)
+
     def process_callback(self, message_object):
         logger.info("Received callback - '%s'" % message_object)
         if self.clients is not None and self.clients:
@@ -517,6 +721,11 @@ class ClientThread(threading.Thread):
         while not self.havocbot.should_shutdown:
             try:
                 client = self.queue.get()
+
+                # A shutdown puts None on the queue to wake the thread up
+                if client is None:
+                    break
+
                 # Trigger the client integration's process() method
                 client.process()
             except Exception as e:
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """ Thread safe least recently used cache whose entries expire.
+
+    Entries live for ttl seconds unless set() is given a ttl of its own. When
+    the cache holds max_size entries the least recently used one is evicted.
+    A ttl of 0 or less disables the cache so every get() is a miss.
+
+    Every invalidation bumps generation. A caller that reads from slow
+    storage can pass the generation it saw before the read to set() so a
+    value that was invalidated in the meantime is never cached.
+    """
+
+    def __init__(self, max_size=1000, ttl=300, timer=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self):
+        return "TTLCache(Size: %d, Hits: %d, Misses: %d, Evictions: %d)" % (
+            len(self.entries), self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def is_enabled(self):
+        return self.ttl is not None and self.ttl > 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                (value, expires) = entry
+                if expires > self.timer():
+                    # Move the entry to the most recently used end
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return value
+
+                del self.entries[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None, generation=None):
+        ttl = ttl if ttl is not None else self.ttl
+
+        if not self.is_enabled or ttl <= 0:
+            return
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                logger.debug("Not caching '%s'. The cache was invalidated while it was loaded" % (key,))
+                return
+
+            self.entries.pop(key, None)
+            self.entries[key] = (value, self.timer() + ttl)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, key):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def remove_where(self, predicate):
+        """ Removes every entry where predicate(key, value) is True.
+        """
+
+        with self.lock:
+            self.generation += 1
+            for key in [k for (k, v) in self.entries.items() if predicate(k, v[0])]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
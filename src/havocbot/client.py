@@ -145,3 +145,17 @@ class Client(object):
             list that may contain user object
         """
         pass
+
+    def get_threads(self):
+        """ Threads started by the client integration itself.
+
+        HavocBot waits for these to exit during a shutdown before it
+        restarts. Integrations that do not start their own threads do not
+        need to override this.
+
+        Args:
+            self (Client): the HavocBotPlugin subclass
+        Returns:
+            list of threading.Thread objects
+        """
+        return []
@@ -2,13 +2,16 @@ from dateutil import tz
 from datetime import datetime
 import logging
 import requests
+import threading
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import sleekxmpp
 from havocbot.client import Client
+from havocbot.common import timedelta_total_seconds
 from havocbot.exceptions import FormattedMessageNotSentError
 from havocbot.message import Message
 from havocbot.room import Room
 from havocbot.user import User, ClientUser
+from havocbot.vcardcache import VCardCache, get_bare_jid
 
 logger = logging.getLogger(__name__)
 
@@ -35,7 +38,17 @@ class HipChat(Client):
         self.use_ssl = True
         self.port = 5223
         self.rooms = None
+        self.rooms_by_jid = {}
         self.rooms_last_updated = None
+        self.rooms_last_attempted = None
+        self.rooms_refresh_failures = 0
+        self.rooms_refresh_interval = 3600
+        self.rooms_retry_interval = 60
+        self.rooms_page_size = 500
+        self.rooms_lock = threading.Lock()
+        self.rooms_refresh_thread = None
+        self.vcard_cache_ttl = 3600
+        self.vcard_cache = VCardCache(self._fetch_vcard, ttl=self.vcard_cache_ttl)
 
     # Takes in a list of kv tuples in the format [('key', 'value'),...]
     def configure(self, settings):
@@ -66,11 +79,19 @@ class HipChat(Client):
                     self.use_ssl = False
             elif item[0] == 'port':
                 self.port = int(item[1])
+            elif item[0] == 'vcard_cache_ttl':
+                self.vcard_cache_ttl = int(item[1])
+            elif item[0] == 'rooms_refresh_interval':
+                self.rooms_refresh_interval = int(item[1])
+            elif item[0] == 'rooms_retry_interval':
+                self.rooms_retry_interval = int(item[1])
             elif item[0] == 'disable_warnings':
                 if item[1] == 'True':
                     logger.debug('urllib3 warnings are now disabled')
                     requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+        self.vcard_cache = VCardCache(self._fetch_vcard, ttl=self.vcard_cache_ttl)
+
         # Return true if this integrations has the information required to connect
         if self.server is not None and self.chat_server is not None and self.room_names is not None:
             if self.bot_username is not None and self.password is not None and self.bot_name is not None:
@@ -108,7 +129,7 @@ class HipChat(Client):
         if self.client.connect(address=(self.server, self.port), use_tls=True):
         #if self.client.connect(address=(self.server, self.port), use_ssl=True, use_tls=True):
             logger.info("I am.. %s! (%s)" % (self.bot_name, self.bot_username))
-            self._update_rooms()
+            self._refresh_rooms_in_background()
             return True
         else:
             return False
@@ -120,6 +141,13 @@ class HipChat(Client):
     def process(self):
         self.client.process(block=True)
 
+    def get_threads(self):
+        # sleekxmpp keeps the threads it starts in a private dictionary on XMLStream
+        if self.client is not None:
+            return list(getattr(self.client, '_XMLStream__thread', {}).values())
+        else:
+            return []
+
     def handle_message(self, **kwargs):
         if kwargs is not None:
             if 'message_object' in kwargs and kwargs.get('message_object') is not None:
@@ -134,6 +162,7 @@ class HipChat(Client):
         if kwargs is not None:
             if 'presence_object' in kwargs and kwargs.get('presence_object') is not None:
                 presence_object = kwargs.get('presence_object')
+                self.vcard_cache.handle_presence(presence_object)
 
                 logger.info(presence_object)
                 logger.info('Hello, %s %s' % (presence_object['muc']['role'], presence_object['muc']['nick']))
@@ -211,11 +240,17 @@ class HipChat(Client):
         result_list = []
 
         if event is not None and event == 'groupchat':
+            channel = self._get_room_jid(channel)
             roster = self.client.plugin['xep_0045'].getRoster(channel)
             if roster is not None and roster:
+                jabber_ids = dict((x, self.client.plugin['xep_0045'].getJidProperty(channel, x, 'jid')) for x in roster)
+
+                # Fetch the vCards that are not cached in batches instead of one round trip per user
+                vcards = self.vcard_cache.get_many(jabber_ids.values())
+
                 for roster_item in roster:
                     logger.debug("roster_item is '%s'" % roster_item)
-                    user = self._get_user_from_groupchat(roster_item, channel)
+                    user = self._create_user_from_groupchat(roster_item, jabber_ids[roster_item], vcards)
                     if user is not None and user:
                         result_list.append(user)
 
@@ -226,36 +261,55 @@ class HipChat(Client):
 
         # Fetch JID from xep_0045
         if channel is not None and channel:
-            if '@' not in channel:
-                channel = "%s@%s" % (channel, self.server)
-
+            channel = self._get_room_jid(channel)
             jabber_id = self.client.plugin['xep_0045'].getJidProperty(channel, name, 'jid')
 
-            if jabber_id is not None and jabber_id:
-                vcard = self._get_vcard_by_jabber_id(jabber_id)
-                logger.debug("jabber_id is '%s', name is '%s' and vcard is '%s'" % (jabber_id, name, vcard))
-                user = create_user_object(jabber_id, name, vcard)
+            user = self._create_user_from_groupchat(name, jabber_id)
 
         logger.info(user)
         return user
 
-    def _get_vcard_by_jabber_id(self, jabber_id):
-        vcard = None
+    def _create_user_from_groupchat(self, name, jabber_id, vcards=None):
+        """ Creates the user for a room occupant.
+
+        vcards is the bare JID to vCard dictionary returned by
+        VCardCache.get_many(). Without it the vCard is looked up on its own.
+        """
 
-        if jabber_id is not None:
-            if isinstance(jabber_id, sleekxmpp.jid.JID):
-                bare_jid = jabber_id.bare
+        user = None
+
+        if jabber_id is not None and jabber_id:
+            if vcards is not None:
+                vcard = vcards.get(get_bare_jid(jabber_id))
             else:
-                bare_jid = jabber_id
+                vcard = self._get_vcard_by_jabber_id(jabber_id)
 
-            try:
-                vcard = self.client.plugin['xep_0054'].get_vcard(jid=bare_jid)
-            except sleekxmpp.exceptions.IqError as e:
-                logger.error("IqError - %s" % e.iq)
-            except sleekxmpp.exceptions.IqTimeout:
-                logger.error('IqTimeOut')
+            logger.debug("jabber_id is '%s', name is '%s' and vcard is '%s'" % (jabber_id, name, vcard))
+            user = create_user_object(jabber_id, name, vcard)
+
+        return user
 
-            return vcard
+    def _get_room_jid(self, channel):
+        # Rooms may be configured by their short name
+        if channel is not None and channel and '@' not in channel:
+            channel = "%s@%s" % (channel, self.server)
+
+        return channel
+
+    def _get_vcard_by_jabber_id(self, jabber_id):
+        return self.vcard_cache.get(jabber_id)
+
+    def _fetch_vcard(self, bare_jid):
+        vcard = None
+
+        try:
+            vcard = self.client.plugin['xep_0054'].get_vcard(jid=bare_jid)
+        except sleekxmpp.exceptions.IqError as e:
+            logger.error("IqError - %s" % e.iq)
+        except sleekxmpp.exceptions.IqTimeout:
+            logger.error('IqTimeOut')
+
+        return vcard
 
     def _get_client_object_from_message_object(self, message_sender, channel=None, event=None, **kwargs):
         user = None
@@ -382,7 +436,7 @@ class HipChat(Client):
         url = '%s/v2/room/%s/notification?auth_token=%s' % (self.api_root_url, room_id, self.api_token)
 
         logger.debug("POSTING to '%s' with '%s'" % (url, json_payload))
-        r = requests.post(url, json=json_payload, verify=False)
+        r = self.havocbot.http.post(url, json=json_payload, verify=False)
 
         if r.status_code not in [200, 201, 202, 204]:
             raise FormattedMessageNotSentError(room_id, json_payload)
@@ -390,28 +444,71 @@ class HipChat(Client):
     def _get_room_id_from_room_jid(self, room_jid):
         logger.debug("Looking up '%s'" % room_jid)
 
-        if self.rooms:
-            for room in self.rooms:
-                if room.xmpp_jid == room_jid:
-                    return room._id
+        # Never wait on the REST API here. A stale or missing room schedules a refresh for later lookups
+        room = self.rooms_by_jid.get(room_jid)
+
+        if room is None or self._rooms_are_stale():
+            self._refresh_rooms_in_background()
+
+        return room._id if room is not None else None
+
+    def _rooms_are_stale(self):
+        if self.rooms_last_updated is None:
+            return True
+
+        age = datetime.utcnow().replace(tzinfo=tz.tzutc()) - self.rooms_last_updated
+        return timedelta_total_seconds(age) >= self.rooms_refresh_interval
+
+    def _rooms_refresh_is_due(self):
+        """ Returns whether enough time has passed since the last refresh attempt to start another.
+
+        Attempts are at least rooms_retry_interval seconds apart so a room the
+        API token cannot see does not refetch the room list on every message.
+        Each failed attempt in a row doubles the wait, up to
+        rooms_refresh_interval, so an API outage is not polled continuously.
+        """
+
+        if self.rooms_last_attempted is None:
+            return True
+
+        wait = min(self.rooms_retry_interval * 2 ** min(self.rooms_refresh_failures, 16), self.rooms_refresh_interval)
+        age = datetime.utcnow().replace(tzinfo=tz.tzutc()) - self.rooms_last_attempted
+        return timedelta_total_seconds(age) >= wait
+
+    def _refresh_rooms_in_background(self):
+        with self.rooms_lock:
+            if self.rooms_refresh_thread is not None and self.rooms_refresh_thread.is_alive():
+                return
+
+            if not self._rooms_refresh_is_due():
+                return
 
-        return None
+            self.rooms_last_attempted = datetime.utcnow().replace(tzinfo=tz.tzutc())
+            self.rooms_refresh_thread = threading.Thread(target=self._update_rooms, name='HavocBotHipChatRooms')
+            self.rooms_refresh_thread.daemon = True
+            self.rooms_refresh_thread.start()
 
     def _update_rooms(self):
         if self.api_root_url is not None and self.api_root_url and self.api_token is not None and self.api_token:
             logger.info("Updating room data...")
 
-            room_list = []
-
             api_data = self._fetch_rooms()
-            if api_data is not None and api_data:
-                for room in api_data:
-                    a_room = self._create_room_object(room)
+            if api_data is None:
+                # Keep serving the rooms from the last successful update and back off before retrying
+                self.rooms_refresh_failures += 1
+                logger.warning("Unable to update room data. %d attempts have failed in a row" %
+                               self.rooms_refresh_failures)
+                return
 
-                    room_list.append(a_room)
+            room_list = [self._create_room_object(room) for room in api_data]
 
+            # Swap in a complete index so lookups never see a half built one
             self.rooms = room_list
+            self.rooms_by_jid = dict((x.xmpp_jid, x) for x in room_list if x.xmpp_jid is not None)
             self.rooms_last_updated = datetime.utcnow().replace(tzinfo=tz.tzutc())
+            self.rooms_refresh_failures = 0
+
+            logger.info("Indexed %d rooms" % len(room_list))
         else:
             logger.info("%s api root url or api token is not defined" % self.integration_name)
 
@@ -419,16 +516,28 @@ class HipChat(Client):
         if self.api_root_url is not None and self.api_root_url and self.api_token is not None and self.api_token:
             logger.info("Fetching room list...")
 
-            url = '%s/v2/room?auth_token=%s&expand=items&max-results=500' % (self.api_root_url, self.api_token)
-            r = requests.get(url)
+            items = []
+            url = '%s/v2/room?expand=items&max-results=%d' % (self.api_root_url, self.rooms_page_size)
+
+            # Follow the next links until every page has been read
+            while url is not None:
+                try:
+                    r = self.havocbot.http.get(url, params={'auth_token': self.api_token})
+                except requests.RequestException as e:
+                    logger.error("Unable to fetch the room list - %s" % e)
+                    return None
+
+                if r.status_code != 200:
+                    logger.info('Nothing here')
+                    return None
 
-            if r.status_code == 200:
                 data = r.json()
-                if 'items' in data and data['items'] is not None and data['items']:
-                    return data['items']
-            else:
-                logger.info('Nothing here')
-                return None
+                if 'items' in data and data['items'] is not None:
+                    items.extend(data['items'])
+
+                url = (data.get('links') or {}).get('next')
+
+            return items
 
     def _create_room_object(self, room):
         a_room = HipChatRoom(room['id'], room['name'])
@@ -1,6 +1,11 @@
+import argparse
 import json
 import logging
-import requests
+import os
+import select
+import socket
+import threading
+import time
 from slackclient import SlackClient
 from havocbot.client import Client
 from havocbot.message import Message
@@ -24,6 +29,19 @@ class Slack(Client):
         self.api_root_url = None
         self.bot_name = None
         self.bot_username = None
+        self.directory = SlackUserDirectory()
+        self.read_timeout = 1
+        self.event_handlers_lock = threading.Lock()
+        self.event_handlers = {
+            'message': [self._on_message_event],
+            'presence_change': [self._on_presence_change_event],
+            'user_change': [self._on_user_change_event],
+            'team_join': [self._on_user_change_event],
+            'user_typing': [self._log_event],
+            'hello': [self._log_event],
+            'status_change': [self._log_event],
+            'reconnect_url': [self._log_event],
+        }
 
     # Takes in a list of kv tuples in the format [('key', 'value'),...]
     def configure(self, settings):
@@ -57,6 +75,7 @@ class Slack(Client):
             self.bot_username = self.client.server.login_data["self"]["id"]
 
             logger.info("I am.. %s! (%s)" % (self.bot_name, self.bot_username))
+            self._load_directory()
             return True
         else:
             return False
@@ -69,41 +88,111 @@ class Slack(Client):
     def process(self):
         while not self.havocbot.should_shutdown:
             try:
+                # Sleep until the websocket has data instead of polling rtm_read()
+                if not self.wait_for_events(self.read_timeout):
+                    continue
+
                 for event in self.client.rtm_read():
-                    if 'type' in event:
-                        if event['type'] == 'message':
-                            logger.debug("raw message received - '%s'" % event)
-
-                            # Ignore messages originating from havocbot
-                            if 'user' in event and event['user'] != self.bot_username:
-                                message_object = create_message_object_from_json(event)
-                                logger.info("Received - %s" % message_object)
-
-                                try:
-                                    self.handle_message(message_object=message_object)
-                                except Exception as e:
-                                    logger.error("Unable to handle the message")
-                                    logger.error(e)
-                        elif event['type'] == 'user_typing':
-                            logger.debug("user_typing received - '%s'" % event)
-                        elif event['type'] == 'hello':
-                            logger.debug("hello received - '%s'" % event)
-                        elif event['type'] == 'presence_change':
-                            logger.debug("presence_change received - '%s'" % event)
-                        elif event['type'] == 'status_change':
-                            logger.debug("status_change received - '%s'" % event)
-                        elif event['type'] == 'reconnect_url':
-                            logger.debug("reconnect_url received - '%s'" % event)
-                        else:
-                            logger.debug("UNKNOWN EVENT received - '%s'" % event)
-                    elif 'reply_to' in event:
-                        logger.debug("reply_to received - '%s'" % event)
-                    else:
-                        logger.debug("UNKNOWN THING received - '%s'" % event)
+                    self.dispatch_event(event)
             except AttributeError as e:
                 logger.error("We have a problem! Is there a client?")
                 logger.error(e)
 
+    def wait_for_events(self, timeout):
+        """ Blocks for up to timeout seconds until the RTM websocket is readable.
+        """
+
+        try:
+            sock = self.client.server.websocket.sock
+        except AttributeError:
+            sock = None
+
+        if sock is None:
+            time.sleep(timeout)
+            return False
+
+        # An SSL socket can hold decrypted data that select() does not know about
+        if hasattr(sock, 'pending') and sock.pending():
+            return True
+
+        try:
+            (readable, _, _) = select.select([sock], [], [], timeout)
+        except (ValueError, TypeError, select.error, socket.error) as e:
+            # The websocket was closed by another thread
+            logger.debug("Unable to wait on the websocket - %s" % e)
+            time.sleep(timeout)
+            return False
+
+        return bool(readable)
+
+    def add_event_handler(self, event_type, handler):
+        """ Calls handler(event) for every RTM event of event_type.
+
+        Plugins can use this to react to events other than messages, for
+        example reaction_added. Handlers run on the client thread so they
+        must return quickly.
+        """
+
+        with self.event_handlers_lock:
+            handlers = list(self.event_handlers.get(event_type, []))
+            handlers.append(handler)
+            self.event_handlers[event_type] = handlers
+
+    def remove_event_handler(self, event_type, handler):
+        with self.event_handlers_lock:
+            handlers = [x for x in self.event_handlers.get(event_type, []) if x != handler]
+            if handlers:
+                self.event_handlers[event_type] = handlers
+            else:
+                self.event_handlers.pop(event_type, None)
+
+    def dispatch_event(self, event):
+        if 'type' in event:
+            # The handler lists are replaced rather than changed so this is safe without the lock
+            handlers = self.event_handlers.get(event['type'])
+
+            if handlers:
+                for handler in handlers:
+                    try:
+                        handler(event)
+                    except Exception as e:
+                        logger.error("Unable to handle the %s event" % event['type'])
+                        logger.error(e)
+            else:
+                logger.debug("UNKNOWN EVENT received - '%s'" % event)
+        elif 'reply_to' in event:
+            logger.debug("reply_to received - '%s'" % event)
+        else:
+            logger.debug("UNKNOWN THING received - '%s'" % event)
+
+    def _on_message_event(self, event):
+        logger.debug("raw message received - '%s'" % event)
+
+        # Ignore messages originating from havocbot
+        if 'user' in event and event['user'] != self.bot_username:
+            message_object = create_message_object_from_json(event)
+            logger.info("Received - %s" % message_object)
+
+            try:
+                self.handle_message(message_object=message_object)
+            except Exception as e:
+                logger.error("Unable to handle the message")
+                logger.error(e)
+
+    def _on_presence_change_event(self, event):
+        logger.debug("presence_change received - '%s'" % event)
+
+        for user_id in event.get('users') or [event.get('user')]:
+            self.directory.set_presence(user_id, event.get('presence'))
+
+    def _on_user_change_event(self, event):
+        logger.debug("%s received - '%s'" % (event['type'], event))
+
+        self.directory.update(event['user'])
+
+    def _log_event(self, event):
+        logger.debug("%s received - '%s'" % (event['type'], event))
+
     def handle_message(self, **kwargs):
         if kwargs is not None:
             if 'message_object' in kwargs and kwargs.get('message_object') is not None:
@@ -221,16 +310,23 @@ class Slack(Client):
         url = '%s/api/chat.postMessage' % self.api_root_url
 
         logger.debug("POSTING to '%s' with '%s'" % (url, json_payload))
-        r = requests.post(url, params=json_payload, verify=False)
+        r = self.havocbot.http.post(url, params=json_payload, verify=False)
 
     def get_user_from_message(self, message_sender, channel=None, event=None, **kwargs):
         user = User(0)
 
         logger.debug("Channel is '%s', message_sender is '%s', event is '%s'" % (channel, message_sender, event))
 
-        api_json = self.client.api_call('users.info', user=message_sender)
-        if 'user' in api_json and api_json['user'] is not None:
-            client_user = create_user_object_from_json(api_json['user'])
+        member = self.directory.get(message_sender)
+        if member is None:
+            # Someone the directory has not heard about yet
+            api_json = self.client.api_call('users.info', user=message_sender)
+            if 'user' in api_json and api_json['user'] is not None:
+                member = api_json['user']
+                self.directory.update(member)
+
+        if member is not None:
+            client_user = create_user_object_from_json(member)
             user.client_user = client_user
 
             user.name = client_user.name
@@ -242,15 +338,75 @@ class Slack(Client):
         result_list = []
 
         if self.client:
-            result = self.client.api_call('users.list', presence=1)
-            if 'members' in result and result['members']:
-                for member in result['members']:
-                    if 'presence' in member and member['presence'] is not None and member['presence'] == 'active':
-                        a_user = create_user_object_from_json(member)
-                        result_list.append(a_user)
+            if not self.directory.is_loaded:
+                self._load_directory()
+
+            for member in self.directory.get_all():
+                if 'presence' in member and member['presence'] is not None and member['presence'] == 'active':
+                    a_user = create_user_object_from_json(member)
+                    result_list.append(a_user)
 
         return result_list
 
+    def _load_directory(self):
+        result = self.client.api_call('users.list', presence=1)
+        if 'members' in result and result['members']:
+            self.directory.load(result['members'])
+        else:
+            logger.error("Unable to load the Slack user directory - %s" % result.get('error'))
+
+
+class SlackUserDirectory(object):
+    """ In memory copy of the Slack team's users keyed by user id.
+
+    Loaded from users.list when the client connects and kept current from
+    the user_change, team_join and presence_change RTM events so looking up
+    a user never needs a Web API call. Stored members are replaced rather
+    than changed so callers must not modify what they get back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = {}
+        self.is_loaded = False
+
+    def __len__(self):
+        return len(self.members)
+
+    def load(self, members):
+        with self.lock:
+            self.members = dict((x['id'], x) for x in members if 'id' in x)
+            self.is_loaded = True
+
+        logger.info("Loaded %d users into the Slack user directory" % len(self.members))
+
+    def update(self, member):
+        if member is None or 'id' not in member:
+            return
+
+        with self.lock:
+            # Profile change events do not carry presence so keep the last known value
+            previous = self.members.get(member['id'])
+            member = dict(member)
+            if previous is not None and 'presence' not in member and 'presence' in previous:
+                member['presence'] = previous['presence']
+
+            self.members[member['id']] = member
+
+    def set_presence(self, user_id, presence):
+        with self.lock:
+            member = self.members.get(user_id)
+            if member is not None:
+                self.members[user_id] = dict(member, presence=presence)
+
+    def get(self, user_id):
+        with self.lock:
+            return self.members.get(user_id)
+
+    def get_all(self):
+        with self.lock:
+            return list(self.members.values())
+
 
 class SlackMessage(Message):
     def __init__(self, text, sender, to, event, client, team, reply_to, timestamp):
@@ -316,3 +472,112 @@ def create_user_object_from_json(j):
     user.tz = time_zone
 
     return user
+
+
+class BenchmarkWebSocket(object):
+    """ Stands in for the RTM websocket. Events written to the other end of a socketpair become readable on sock.
+    """
+
+    def __init__(self):
+        (self.sock, self.peer) = socket.socketpair()
+        self.sock.setblocking(0)
+        self.buffer = b''
+
+    def send_event(self, event):
+        self.peer.sendall(json.dumps(event).encode('utf-8') + b'\n')
+
+    def read_events(self):
+        # Like rtm_read(), return straight away with whatever has arrived
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                self.buffer += data
+        except socket.error:
+            pass
+
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+
+        return [json.loads(x.decode('utf-8')) for x in lines if x]
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+
+
+class BenchmarkServer(object):
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+
+class BenchmarkRTMClient(object):
+    def __init__(self):
+        self.server = BenchmarkServer(BenchmarkWebSocket())
+
+    def rtm_read(self):
+        return self.server.websocket.read_events()
+
+
+class BenchmarkHavocBot(object):
+    def __init__(self):
+        self.should_shutdown = False
+
+
+def poll_rtm_read(slack):
+    # How Slack.process read events before it waited on the websocket
+    while not slack.havocbot.should_shutdown:
+        for event in slack.client.rtm_read():
+            slack.dispatch_event(event)
+
+
+def run_benchmark(seconds, event_interval):
+    print('%8s  %8s  %8s  %14s  %6s  %10s' % ('loop', 'wall s', 'cpu s', 'cpu s/hour', 'sent', 'dispatched'))
+
+    for (name, loop) in (('polling', poll_rtm_read), ('select', Slack.process)):
+        slack = Slack(BenchmarkHavocBot())
+        slack.client = BenchmarkRTMClient()
+        dispatched = []
+        slack.add_event_handler('benchmark', dispatched.append)
+
+        thread = threading.Thread(target=loop, args=(slack,), name='HavocBotSlackBenchmark')
+        start_times = os.times()
+        start = time.time()
+        thread.start()
+
+        sent = 0
+        deadline = start + seconds
+        while time.time() < deadline:
+            if event_interval > 0:
+                time.sleep(min(event_interval, max(0, deadline - time.time())))
+                slack.client.server.websocket.send_event({'type': 'benchmark', 'sequence': sent})
+                sent += 1
+            else:
+                time.sleep(max(0, deadline - time.time()))
+
+        # Let the loop pick up the last event before asking it to stop
+        time.sleep(0.1)
+        slack.havocbot.should_shutdown = True
+        thread.join()
+
+        wall = time.time() - start
+        end_times = os.times()
+        cpu = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+        slack.client.server.websocket.close()
+
+        print('%8s  %8.2f  %8.2f  %14.1f  %6d  %10d' % (name, wall, cpu, cpu / wall * 3600, sent, len(dispatched)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the CPU the Slack read loop uses while idle')
+    parser.add_argument('-s', '--seconds', help='how long to run each read loop', type=float, default=3)
+    parser.add_argument('-i', '--interval', help='seconds between fake events, 0 for an idle workspace', type=float,
+                        default=0)
+    args = vars(parser.parse_args())
+
+    run_benchmark(args['seconds'], args['interval'])
+
+
+if __name__ == "__main__":
+    main()
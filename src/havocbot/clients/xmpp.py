@@ -5,6 +5,7 @@ import sleekxmpp
 from havocbot.client import Client
 from havocbot.message import Message
 from havocbot.user import User, ClientUser
+from havocbot.vcardcache import VCardCache, get_bare_jid
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,8 @@ class XMPP(Client):
         self.chat_server = None
         self.use_ssl = False
         self.port = 5222
+        self.vcard_cache_ttl = 3600
+        self.vcard_cache = VCardCache(self._fetch_vcard, ttl=self.vcard_cache_ttl)
 
     # Takes in a list of kv tuples in the format [('key', 'value'),...]
     def configure(self, settings):
@@ -54,6 +57,10 @@ class XMPP(Client):
                     self.use_ssl = False
             elif item[0] == 'port':
                 self.port = int(item[1])
+            elif item[0] == 'vcard_cache_ttl':
+                self.vcard_cache_ttl = int(item[1])
+
+        self.vcard_cache = VCardCache(self._fetch_vcard, ttl=self.vcard_cache_ttl)
 
         # Return true if this integrations has the information required to connect
         if self.server is not None and self.chat_server is not None and self.room_names is not None:
@@ -99,6 +106,13 @@ class XMPP(Client):
     def process(self):
         self.client.process(block=True)
 
+    def get_threads(self):
+        # sleekxmpp keeps the threads it starts in a private dictionary on XMLStream
+        if self.client is not None:
+            return list(getattr(self.client, '_XMLStream__thread', {}).values())
+        else:
+            return []
+
     def handle_message(self, **kwargs):
         if kwargs is not None:
             if 'message_object' in kwargs and kwargs.get('message_object') is not None:
@@ -109,6 +123,11 @@ class XMPP(Client):
                 else:
                     logger.debug("Ignoring non message event of type '%s'" % message_object.event)
 
+    def handle_presence(self, **kwargs):
+        if kwargs is not None:
+            if 'presence_object' in kwargs and kwargs.get('presence_object') is not None:
+                self.vcard_cache.handle_presence(kwargs.get('presence_object'))
+
     def send_message(self, text, channel, event=None, **kwargs):
         if channel and text and event:
             logger.info("Sending %s text '%s' to channel '%s'" % (event, text, channel))
@@ -149,34 +168,25 @@ class XMPP(Client):
 
         logger.debug('starting get_active_users_in_channel')
         if event is not None and event == 'groupchat':
+            channel = self._get_room_jid(channel)
             roster = self.client.plugin['xep_0045'].getRoster(channel)
             if roster is not None and roster:
+                jabber_ids = dict((x, self.client.plugin['xep_0045'].getJidProperty(channel, x, 'jid')) for x in roster)
+
+                # Fetch the vCards that are not cached in batches instead of one round trip per user
+                vcards = self.vcard_cache.get_many(jabber_ids.values())
+
                 logger.debug("roster is '%s'" % roster)
                 for roster_item in roster:
                     logger.debug("roster_item is '%s'" % roster_item)
-                    user = self._get_user_from_groupchat(roster_item, channel)
+                    user = self._create_user_from_groupchat(roster_item, jabber_ids[roster_item], vcards)
                     if user is not None and user:
                         result_list.append(user)
 
         return result_list
 
     def get_vcard_by_jabber_id(self, jabber_id):
-        vcard = None
-
-        if jabber_id is not None:
-            if isinstance(jabber_id, sleekxmpp.jid.JID):
-                bare_jid = jabber_id.bare
-            else:
-                bare_jid = jabber_id
-
-            try:
-                vcard = self.client.plugin['xep_0054'].get_vcard(jid=bare_jid)
-            except sleekxmpp.exceptions.IqError as e:
-                logger.error("IqError - %s" % e.iq)
-            except sleekxmpp.exceptions.IqTimeout:
-                logger.error('IqTimeOut')
-
-            return vcard
+        return self.vcard_cache.get(jabber_id)
 
     def _get_user_from_jid(self, jabber_id):
         user = None
@@ -199,26 +209,48 @@ class XMPP(Client):
 
         # Fetch JID from xep_0045
         if channel is not None and channel:
-            if '@' not in channel:
-                channel = "%s@%s" % (channel, self.server)
-
+            channel = self._get_room_jid(channel)
             jabber_id = self.client.plugin['xep_0045'].getJidProperty(channel, name, 'jid')
 
-            if jabber_id is not None and jabber_id.bare is not None and jabber_id.bare:
-                vcard = self._get_vcard_by_jabber_id(jabber_id)
-                logger.info('Creating user')
-                logger.info("jabber_id is '%s', name is '%s' and vcard is '%s'" % (jabber_id, name, vcard))
-                user = create_user_object(jabber_id, name, vcard)
+            user = self._create_user_from_groupchat(name, jabber_id)
+        else:
+            logger.info('else clause')
 
-                logger.info('Displaying user')
-                logger.info(user)
+        return user
+
+    def _create_user_from_groupchat(self, name, jabber_id, vcards=None):
+        """ Creates the user for a room occupant.
+
+        vcards is the bare JID to vCard dictionary returned by
+        VCardCache.get_many(). Without it the vCard is looked up on its own.
+        """
+
+        user = None
+
+        if jabber_id is not None and jabber_id.bare is not None and jabber_id.bare:
+            if vcards is not None:
+                vcard = vcards.get(get_bare_jid(jabber_id))
             else:
-                logger.info('else clause top')
+                vcard = self._get_vcard_by_jabber_id(jabber_id)
+
+            logger.info('Creating user')
+            logger.info("jabber_id is '%s', name is '%s' and vcard is '%s'" % (jabber_id, name, vcard))
+            user = create_user_object(jabber_id, name, vcard)
+
+            logger.info('Displaying user')
+            logger.info(user)
         else:
-            logger.info('else clause')
+            logger.info('else clause top')
 
         return user
 
+    def _get_room_jid(self, channel):
+        # Rooms may be configured by their short name
+        if channel is not None and channel and '@' not in channel:
+            channel = "%s@%s" % (channel, self.server)
+
+        return channel
+
     # def _get_user_from_private_chat(self, name):
     #     user = None
 
@@ -237,22 +269,19 @@ class XMPP(Client):
     #     return user
 
     def _get_vcard_by_jabber_id(self, jabber_id):
-        vcard = None
+        return self.vcard_cache.get(jabber_id)
 
-        if jabber_id is not None:
-            if isinstance(jabber_id, sleekxmpp.jid.JID):
-                bare_jid = jabber_id.bare
-            else:
-                bare_jid = jabber_id
+    def _fetch_vcard(self, bare_jid):
+        vcard = None
 
-            try:
-                vcard = self.client.plugin['xep_0054'].get_vcard(jid=bare_jid)
-            except sleekxmpp.exceptions.IqError as e:
-                logger.error("IqError - %s" % e.iq)
-            except sleekxmpp.exceptions.IqTimeout:
-                logger.error('IqTimeOut')
+        try:
+            vcard = self.client.plugin['xep_0054'].get_vcard(jid=bare_jid)
+        except sleekxmpp.exceptions.IqError as e:
+            logger.error("IqError - %s" % e.iq)
+        except sleekxmpp.exceptions.IqTimeout:
+            logger.error('IqTimeOut')
 
-            return vcard
+        return vcard
 
     # def update_user_object_from_message(self, user_object, message_object):
     #     logger.debug('update_user_object_from_message() - triggered')
@@ -349,6 +378,7 @@ class MUCBot(sleekxmpp.ClientXMPP):
 
         self.add_event_handler('session_start', self.start)
         self.add_event_handler('message', self.message)  # Also catches groupchat_message
+        self.add_event_handler('groupchat_presence', self.presence)
 
     def start(self, event):
         self.get_roster()
@@ -359,6 +389,13 @@ class MUCBot(sleekxmpp.ClientXMPP):
                 logger.debug("Joining room '%s'" % room_string)
                 self.plugin['xep_0045'].joinMUC(room_string, self.nick, wait=True)
 
+    def presence(self, presence):
+        if presence['muc']['nick'] != self.nick:
+            try:
+                self.parent.handle_presence(presence_object=presence)
+            except Exception as e:
+                logger.error(e)
+
     def log_msg(self, msg):
         logger.debug(type(msg['from']))
         logger.debug(msg['from'].resource)
@@ -1,4 +1,7 @@
 import logging
+import threading
+import time
+from collections import deque
 
 logger = logging.getLogger('__name__')
 
@@ -12,3 +15,155 @@ def catch_exceptions(function):
             return False
 
     return encapsulated_function
+
+
+# Python 2.6 does not support total_seconds()
+def timedelta_total_seconds(timedelta):
+    return (
+        timedelta.microseconds +
+        (timedelta.seconds + timedelta.days * 24 * 3600) * 10 ** 6) / 10 ** 6
+
+
+class GatherCall(object):
+    def __init__(self, function, args, on_done):
+        self.function = function
+        self.args = args
+        self.on_done = on_done
+        self.is_cancelled = False
+
+
+class GatherExecutor(object):
+    """ Fixed pool of worker threads shared by every gather_with_deadline call.
+
+    Lookups from every plugin and client run on the same few workers, so a
+    burst of requests cannot start more threads than workers. Calls that are
+    waiting for a worker count towards max_pending along with the running
+    ones. Once it is reached new calls are refused instead of queued. A call
+    still waiting when its gather gives up is dropped without being run.
+    Workers are started the first time they are needed.
+    """
+
+    def __init__(self, workers=8, max_pending=64):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.waiting = deque()
+        self.threads = []
+        self.pending = 0
+        self.submitted = 0
+        self.rejected = 0
+
+    def __str__(self):
+        return "GatherExecutor(Workers: %d, Pending: %d, Submitted: %d, Rejected: %d)" % (
+            len(self.threads), self.pending, self.submitted, self.rejected)
+
+    def submit(self, call):
+        """ Queues a GatherCall. Returns False if max_pending calls are already waiting or running.
+        """
+
+        with self.condition:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+
+            if len(self.threads) < max(1, self.workers):
+                thread = threading.Thread(target=self._work, name='HavocBotGather-%d' % len(self.threads))
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+
+            self.waiting.append(call)
+            self.pending += 1
+            self.submitted += 1
+            self.condition.notify()
+
+        return True
+
+    def cancel(self, call):
+        with self.condition:
+            call.is_cancelled = True
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.waiting:
+                    self.condition.wait()
+
+                call = self.waiting.popleft()
+                if call.is_cancelled:
+                    self.pending -= 1
+                    continue
+
+            result = None
+
+            try:
+                result = call.function(*call.args)
+            except Exception as e:
+                logger.error("Gathered call to %s raised - %s" % (getattr(call.function, '__name__', call), e))
+            finally:
+                with self.condition:
+                    self.pending -= 1
+
+                call.on_done(result)
+
+
+# Shared by every plugin and client. HavocBot sizes it from the gather_* settings
+gather_executor = GatherExecutor()
+
+
+def gather_with_deadline(calls, timeout, name='HavocBotGather', executor=None):
+    """ Runs every call on the shared gather executor and waits up to timeout seconds for them.
+
+    calls is a list of (function, args) tuples. Returns a list holding the
+    result of each call in the same order. A call that raised, was refused
+    because the executor was full or had not finished when the deadline
+    passed has a result of None. Calls that were still waiting for a worker
+    at the deadline are dropped. Calls that were already running are left to
+    finish, but their results are thrown away.
+    """
+
+    if executor is None:
+        executor = gather_executor
+
+    results = [None] * len(calls)
+    condition = threading.Condition()
+    pending = [0]
+    submitted = []
+
+    def on_done(index, result):
+        with condition:
+            results[index] = result
+            pending[0] -= 1
+            condition.notify()
+
+    for (index, (function, args)) in enumerate(calls):
+        call = GatherCall(function, args, lambda result, index=index: on_done(index, result))
+
+        with condition:
+            pending[0] += 1
+
+        if executor.submit(call):
+            submitted.append(call)
+        else:
+            logger.warning("%s call %d was refused. %s" % (name, index, executor))
+            with condition:
+                pending[0] -= 1
+
+    deadline = time.time() + timeout
+
+    with condition:
+        while pending[0] > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.warning("%s gave up on %d of %d calls after %s seconds" % (
+                    name, pending[0], len(calls), timeout))
+                break
+            condition.wait(remaining)
+
+        # Calls that finish from now on must not change what the caller sees
+        gathered = list(results)
+
+    for call in submitted:
+        executor.cancel(call)
+
+    return gathered
@@ -0,0 +1,218 @@
+import logging
+import threading
+from collections import deque
+
+# Python2/3 compat
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchJob(object):
+    def __init__(self, name, function, args, kwargs, is_catch_all=False):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.is_catch_all = is_catch_all
+
+
+class PluginSlot(object):
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.running = 0
+        self.waiting = deque()
+        self.waiting_catch_all = 0
+
+
+class Dispatcher(object):
+    """ Bounded worker pool that runs triggered plugin functions off the client threads.
+
+    Each plugin may only have a limited number of jobs running at once. Jobs
+    over that limit wait in a per plugin queue in the order they arrived so a
+    plugin with a concurrency of 1 sees its messages one at a time, exactly as
+    it did when triggers ran on the client thread. When the queues are full new
+    jobs are rejected rather than blocking the client read loop.
+
+    Jobs for catch-all triggers, which see every message, wait in the same
+    per plugin queue as the plugin's commands so the two stay in order. They
+    are counted against their own limit so a busy channel cannot fill the
+    queue and crowd out the commands.
+
+    A dispatcher configured with 0 workers runs every job inline on the
+    calling thread.
+    """
+
+    def __init__(self, workers=4, max_queue_depth=100, max_plugin_queue_depth=20, max_catch_all_queue_depth=20,
+                 plugin_concurrency=1, plugin_concurrency_limits=None):
+        self.workers = workers
+        self.max_queue_depth = max_queue_depth
+        self.max_plugin_queue_depth = max_plugin_queue_depth
+        self.max_catch_all_queue_depth = max_catch_all_queue_depth
+        self.plugin_concurrency = plugin_concurrency
+        self.plugin_concurrency_limits = plugin_concurrency_limits if plugin_concurrency_limits is not None else {}
+        self.ready = Queue()
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.threads = []
+        self.is_running = False
+        self.queued = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def __str__(self):
+        return "Dispatcher(Workers: %d, Queued: %d, Submitted: %d, Rejected: %d, Completed: %d, Failed: %d)" % (
+            self.workers, self.queued, self.submitted, self.rejected, self.completed, self.failed)
+
+    def start(self):
+        if self.workers > 0 and not self.is_running:
+            logger.debug("Starting %d dispatch workers" % self.workers)
+            self.is_running = True
+
+            for x in range(self.workers):
+                t = threading.Thread(target=self._work, name="HavocBotDispatcher-%d" % x)
+                t.daemon = True
+                self.threads.append(t)
+                t.start()
+
+    def stop(self):
+        if self.is_running:
+            logger.debug("Stopping dispatch workers. %s" % self)
+
+            with self.lock:
+                self.is_running = False
+
+                # Jobs that have not started yet are dropped
+                for slot in self.slots.values():
+                    self.queued -= len(slot.waiting)
+                    slot.waiting.clear()
+                    slot.waiting_catch_all = 0
+
+            for x in range(len(self.threads)):
+                self.ready.put(None)
+
+            self.threads = []
+
+    def submit(self, name, function, *args, **kwargs):
+        """ Queues a function to be run by a worker on behalf of the named plugin.
+
+        Returns True if the job was accepted and False if it was rejected
+        because the dispatcher is stopped or the queues are full.
+        """
+
+        return self._submit(DispatchJob(name, function, args, kwargs))
+
+    def submit_catch_all(self, name, function, *args, **kwargs):
+        """ Queues a function for a catch-all trigger of the named plugin.
+
+        The job runs in order with the plugin's other jobs but only counts
+        against max_catch_all_queue_depth while it waits.
+        """
+
+        return self._submit(DispatchJob(name, function, args, kwargs, is_catch_all=True))
+
+    def _submit(self, job):
+        name = job.name
+
+        if self.workers <= 0:
+            job.function(*job.args, **job.kwargs)
+            return True
+
+        with self.lock:
+            if not self.is_running:
+                logger.debug("Dispatcher is not running. Rejecting job for %s" % name)
+                self.rejected += 1
+                return False
+
+            if self.queued >= self.max_queue_depth:
+                logger.warning("Dispatch queue is full with %d jobs. Rejecting job for %s" % (self.queued, name))
+                self.rejected += 1
+                return False
+
+            slot = self.slots.get(name)
+            if slot is None:
+                concurrency = self.plugin_concurrency_limits.get(name, self.plugin_concurrency)
+                slot = PluginSlot(name, max(1, concurrency))
+                self.slots[name] = slot
+
+            if slot.running < slot.concurrency:
+                slot.running += 1
+                self.ready.put(job)
+            elif job.is_catch_all:
+                if slot.waiting_catch_all >= self.max_catch_all_queue_depth:
+                    logger.warning("%s has %d catch-all jobs waiting. Rejecting job" % (name, slot.waiting_catch_all))
+                    self.rejected += 1
+                    return False
+
+                slot.waiting.append(job)
+                slot.waiting_catch_all += 1
+            elif len(slot.waiting) - slot.waiting_catch_all < self.max_plugin_queue_depth:
+                slot.waiting.append(job)
+            else:
+                logger.warning("%s has %d commands waiting. Rejecting job" % (
+                    name, len(slot.waiting) - slot.waiting_catch_all))
+                self.rejected += 1
+                return False
+
+            self.queued += 1
+            self.submitted += 1
+
+        return True
+
+    def _work(self):
+        while True:
+            job = self.ready.get()
+            if job is None:
+                break
+
+            with self.lock:
+                self.queued -= 1
+
+            try:
+                job.function(*job.args, **job.kwargs)
+            except Exception as e:
+                logger.debug("%s job failed - %s" % (job.name, e))
+                with self.lock:
+                    self.failed += 1
+            else:
+                with self.lock:
+                    self.completed += 1
+            finally:
+                self._release(job)
+
+    def _release(self, job):
+        with self.lock:
+            slot = self.slots[job.name]
+
+            # Hand the slot straight to the next waiting job for the plugin
+            if slot.waiting and self.is_running:
+                next_job = slot.waiting.popleft()
+                if next_job.is_catch_all:
+                    slot.waiting_catch_all -= 1
+                self.ready.put(next_job)
+            else:
+                slot.running -= 1
+
+
+def parse_concurrency_limits(value):
+    """ Parses a setting in the format 'images:4,showtimes:2' into a dictionary.
+    """
+
+    limits = {}
+
+    if value is not None and value.strip():
+        for item in value.split(','):
+            if ':' in item:
+                (name, limit) = item.split(':', 1)
+                try:
+                    limits[name.strip()] = int(limit)
+                except ValueError:
+                    logger.error("Invalid concurrency limit '%s' for %s" % (limit, name))
+
+    return limits
@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Python2/3 compat
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPClient(object):
+    """ Shared HTTP session for plugins and client integrations.
+
+    Owned by HavocBot and shared through havocbot.http. Connections are kept
+    alive in a pool per host so repeated calls to the same API skip the TCP
+    and TLS handshakes. Every request gets a default timeout and failed
+    connections and 5xx responses are retried with exponential backoff.
+
+    get() and post() take the same arguments as requests.get() and
+    requests.post() so the module level functions can be swapped for it.
+    Latency, request and error counts are recorded per host in metrics under
+    'http.<host>'.
+    """
+
+    def __init__(self, metrics=None, timeout=10, retries=2, backoff_factor=0.5, pool_connections=10,
+                 pool_maxsize=10, status_forcelist=(500, 502, 503, 504)):
+        self.metrics = metrics
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.status_forcelist = status_forcelist
+        self.lock = threading.Lock()
+        self.session = None
+
+    def __str__(self):
+        return "HTTPClient(Timeout: %s, Retries: %d, Backoff Factor: %s, Pool Size: %d)" % (
+            self.timeout, self.retries, self.backoff_factor, self.pool_maxsize)
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                self.session = self.create_session()
+
+            return self.session
+
+    def create_session(self):
+        retry = Retry(total=self.retries, connect=self.retries, read=self.retries,
+                      backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                              max_retries=retry)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        host = urlparse(url).hostname or 'unknown'
+        start = time.time()
+
+        try:
+            response = self.get_session().request(method, url, **kwargs)
+        except requests.RequestException as e:
+            logger.error("%s request to '%s' failed - %s" % (method, host, e))
+            self.record(host, time.time() - start, error=True)
+            raise
+
+        self.record(host, time.time() - start, error=response.status_code >= 400)
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def record(self, host, seconds, error=False):
+        if self.metrics is None:
+            return
+
+        self.metrics.timing('http.%s' % host, seconds)
+        self.metrics.increment('http.%s.requests' % host)
+        if error:
+            self.metrics.increment('http.%s.errors' % host)
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """ Thread safe in process counters, gauges and timings.
+
+    Owned by HavocBot and shared with clients and plugins through
+    havocbot.metrics. Names are free form dotted strings like
+    'havocbot.restart'.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def __str__(self):
+        return "Metrics(Counters: %d, Gauges: %d, Timings: %d)" % (
+            len(self.counters), len(self.gauges), len(self.timings))
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = {'count': 1, 'total': seconds, 'min': seconds, 'max': seconds, 'last': seconds}
+            else:
+                timing['count'] += 1
+                timing['total'] += seconds
+                timing['min'] = min(timing['min'], seconds)
+                timing['max'] = max(timing['max'], seconds)
+                timing['last'] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start)
+
+    def get_counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def snapshot(self):
+        """ Returns a copy of every metric that is safe to read without the lock.
+        """
+
+        with self.lock:
+            timings = {}
+            for (name, timing) in self.timings.items():
+                timings[name] = dict(timing, average=timing['total'] / timing['count'])
+
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges), 'timings': timings}
@@ -1,12 +1,19 @@
 #!/havocbot
 
 import logging
+import random
 from random import shuffle
-import requests
+import threading
+import time
+from havocbot.cache import TTLCache
+from havocbot.common import gather_with_deadline
 from havocbot.plugin import HavocBotPlugin, Trigger, Usage
 
 logger = logging.getLogger(__name__)
 
+# Google returns at most 10 results per page
+SEARCH_PAGE_STARTS = (1, 11)
+
 
 class ImagesPlugin(HavocBotPlugin):
 
@@ -34,6 +41,12 @@ class ImagesPlugin(HavocBotPlugin):
         self.havocbot = havocbot
         self.api_key_google = None
         self.api_key_google_cx = None
+        self.search_timeout = 10
+        self.cache_ttl = 3600
+        self.daily_quota = 0
+        self.lock = threading.Lock()
+        self.cache = TTLCache(ttl=self.cache_ttl)
+        self.quota = QuotaLimiter(self.daily_quota)
 
     def configure(self, settings):
         requirements_met = False
@@ -44,6 +57,15 @@ class ImagesPlugin(HavocBotPlugin):
                     self.api_key_google = item[1]
                 elif item[0] == 'api_key_google_cx':
                     self.api_key_google_cx = item[1]
+                elif item[0] == 'search_timeout':
+                    self.search_timeout = float(item[1])
+                elif item[0] == 'cache_ttl':
+                    self.cache_ttl = int(item[1])
+                elif item[0] == 'daily_quota':
+                    self.daily_quota = int(item[1])
+
+        self.cache = TTLCache(ttl=self.cache_ttl)
+        self.quota = QuotaLimiter(self.daily_quota)
 
         if (self.api_key_google is not None and len(self.api_key_google) > 0) and \
                 (self.api_key_google_cx is not None and len(self.api_key_google_cx) > 0):
@@ -58,6 +80,7 @@ class ImagesPlugin(HavocBotPlugin):
             return False
 
     def shutdown(self):
+        logger.info("Image search at shutdown - %s, %s" % (self.cache, self.quota))
         self.havocbot = None
 
     def trigger_default(self, client, message, **kwargs):
@@ -75,36 +98,85 @@ class ImagesPlugin(HavocBotPlugin):
             client.send_message(response, message.reply(), event=message.event)
 
     def get_image(self, search_terms):
-        search_terms = search_terms.replace(' ', '+')
-
-        base_api = 'https://www.googleapis.com/customsearch/v1'
+        query = normalise_query(search_terms)
 
-        url = '%s?key=%s&cx=%s&q=%s&searchType=image&imgSize=xlarge&alt=json&num=10&start=1' % (
-            base_api, self.api_key_google, self.api_key_google_cx, search_terms)
-        url2 = '%s?key=%s&cx=%s&q=%s&searchType=image&imgSize=xlarge&alt=json&num=10&start=10' % (
-            base_api, self.api_key_google, self.api_key_google_cx, search_terms)
+        with self.lock:
+            image_urls = self.cache.get(query)
+            if image_urls:
+                # Hand out each cached result once before searching again
+                return image_urls.pop(random.randrange(len(image_urls)))
 
-        r = requests.get('%s' % url)
-        r2 = requests.get('%s' % url2)
+        if not self.quota.acquire(len(SEARCH_PAGE_STARTS)):
+            logger.warning("Skipping image search for '%s'. The search quota has been used up" % query)
+            return 'The image search quota has been used up. Try again later'
 
-        image_urls = []
-
-        if r is not None:
-            if 'items' in r.json():
-                for item in r.json()['items']:
-                    image_urls.append(item['link'])
-
-        if r2 is not None:
-            if 'items' in r2.json():
-                for item in r2.json()['items']:
-                    image_urls.append(item['link'])
+        calls = [(self.fetch_image_urls, (query, start)) for start in SEARCH_PAGE_STARTS]
+        image_urls = [x for urls in gather_with_deadline(calls, self.search_timeout, name='HavocBotImages')
+                      for x in urls or []]
 
         if image_urls:
             shuffle(image_urls)
-            return image_urls[0]
+            image_url = image_urls.pop()
+
+            with self.lock:
+                self.cache.set(query, image_urls)
+
+            return image_url
         else:
             return 'Nothing found'
 
+    def fetch_image_urls(self, query, start):
+        base_api = 'https://www.googleapis.com/customsearch/v1'
+
+        url = '%s?key=%s&cx=%s&q=%s&searchType=image&imgSize=xlarge&alt=json&num=10&start=%d' % (
+            base_api, self.api_key_google, self.api_key_google_cx, query, start)
+
+        r = self.havocbot.http.get(url)
+
+        if r.status_code != 200:
+            logger.error("Image search for '%s' returned %d" % (query, r.status_code))
+            return []
+
+        return [item['link'] for item in r.json().get('items', [])]
+
+
+class QuotaLimiter(object):
+    """ Counts API requests against a quota that resets every period seconds.
+
+    A limit of 0 or less disables the limiter.
+    """
+
+    def __init__(self, limit=0, period=86400, timer=time.time):
+        self.limit = limit
+        self.period = period
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.used = 0
+        self.window_start = timer()
+
+    def __str__(self):
+        return "QuotaLimiter(Used: %d, Limit: %d, Period: %d)" % (self.used, self.limit, self.period)
+
+    def acquire(self, cost=1):
+        if self.limit <= 0:
+            return True
+
+        with self.lock:
+            now = self.timer()
+            if now - self.window_start >= self.period:
+                self.window_start = now
+                self.used = 0
+
+            if self.used + cost > self.limit:
+                return False
+
+            self.used += cost
+            return True
+
+
+def normalise_query(search_terms):
+    return '+'.join(search_terms.lower().replace('+', ' ').split())
+
 
 # Make this plugin available to HavocBot
 havocbot_handler = ImagesPlugin()
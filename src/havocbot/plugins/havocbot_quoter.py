@@ -1,12 +1,23 @@
 #!/havocbot
 
+from collections import OrderedDict, deque
 from dateutil import tz, parser
+from datetime import datetime
+import heapq
+import json
 import logging
+import math
+import os
 import random
-from tinydb import TinyDB, Query
+import re
+import threading
+import time
+from tinydb import TinyDB
+from tinydb.database import Element
 from havocbot.exceptions import FormattedMessageNotSentError
 from havocbot.message import FormattedMessage
 from havocbot.plugin import HavocBotPlugin, Trigger, Usage
+from havocbot.stasherstorage import WriteBehindMiddleware, atomic_write
 from havocbot.user import UserDataAlreadyExistsException, UserDataNotFoundException, UserDoesNotExist
 
 logger = logging.getLogger(__name__)
@@ -26,6 +37,8 @@ class QuoterPlugin(HavocBotPlugin):
     def plugin_usages(self):
         return [
             Usage(command='!quote get <name>', example='!quote get mark', description='get a quote said by a user'),
+            Usage(command='!quote search <terms>', example='!quote search free pizza',
+                  description='find the quotes that best match the words'),
             Usage(command='!addquote <name>', example='!addquote markaperdue',
                   description='add the last message said by the user to storage'),
         ]
@@ -34,6 +47,7 @@ class QuoterPlugin(HavocBotPlugin):
     def plugin_triggers(self):
         return [
             Trigger(match='!quote\sget-id\s([0-9]+)', function=self.trigger_get_quote_by_id, requires=None),
+            Trigger(match='!quote\ssearch\s(.*)', function=self.trigger_search_quotes, requires=None),
             Trigger(match='!quote\sget\s(.*)', function=self.trigger_get_quotes_by_user_search, requires=None),
             Trigger(match='!addquote\s(.*)', function=self.trigger_add_quote, requires=None),
             Trigger(match='!debugquote', function=self.trigger_debug_quote, requires=None),
@@ -42,9 +56,12 @@ class QuoterPlugin(HavocBotPlugin):
 
     def init(self, havocbot):
         self.havocbot = havocbot
-        self.recent_messages = []
         self.max_messages_per_user_per_channel = 5
+        self.max_tracked_senders = 1000
+        self.tracked_message_max_age = 86400
+        self.recent_messages = RecentMessageTracker(self.max_messages_per_user_per_channel)
         self.same_channel_only = False
+        self.max_search_results = 3
         self.stasher = StasherTinyDBQuoter()
 
     def configure(self, settings):
@@ -54,6 +71,18 @@ class QuoterPlugin(HavocBotPlugin):
             for item in settings:
                 if item[0] == 'same_channel_only':
                     self.same_channel_only = item[1]
+                elif item[0] == 'max_messages_per_user_per_channel':
+                    self.max_messages_per_user_per_channel = int(item[1])
+                elif item[0] == 'max_tracked_senders':
+                    self.max_tracked_senders = int(item[1])
+                elif item[0] == 'tracked_message_max_age':
+                    self.tracked_message_max_age = int(item[1])
+                elif item[0] == 'max_search_results':
+                    self.max_search_results = int(item[1])
+
+        self.recent_messages = RecentMessageTracker(
+            self.max_messages_per_user_per_channel, max_keys=self.max_tracked_senders,
+            max_age=self.tracked_message_max_age)
 
         if requirements_met:
             return True
@@ -61,26 +90,15 @@ class QuoterPlugin(HavocBotPlugin):
             return False
 
     def shutdown(self):
+        self.stasher.close()
         self.havocbot = None
 
     def trigger_default(self, client, message, **kwargs):
         if message.text.startswith(('!addquote', '!debugquote')):
             return
 
-        # Count occurrences of messages by a user in a client integration
-        previous_messages = [x for x in self.recent_messages
-                             if x.sender == message.sender and x.client == message.client and x.to == message.to]
-
-        logger.debug('%d tracked messages for %s in channel %s' % (len(previous_messages), message.sender, message.to))
-
-        if len(previous_messages) >= self.max_messages_per_user_per_channel:
-            try:
-                self.recent_messages.remove(previous_messages[0])
-            except ValueError:
-                pass
-
         logger.debug('Adding message by user %s to recent messages' % message.sender)
-        self.recent_messages.append(message)
+        self.recent_messages.add(message)
 
     def _get_quote_formatted_message(self, user, quote):
         time = format_datetime_for_display(parser.parse(quote['timestamp'])) if 'timestamp' in quote else 'Unknown'
@@ -127,7 +145,7 @@ class QuoterPlugin(HavocBotPlugin):
         if users is not None and users:
             for user in users:
                 try:
-                    self._add_most_recent_quote_from_user(user, client, self.recent_messages)
+                    self._add_most_recent_quote_from_user(user, client)
                 except UserDataNotFoundException:
                     text = 'No previously tracked messages found from that user'
                     client.send_message(text, message.reply(), event=message.event)
@@ -182,31 +200,47 @@ class QuoterPlugin(HavocBotPlugin):
             text = 'Too many parameters. What are you trying to do?'
             client.send_message(text, message.reply(), event=message.event)
 
-    def trigger_debug_quote(self, client, message, **kwargs):
-        for message in self.recent_messages:
-            logger.info(message)
+    def trigger_search_quotes(self, client, message, **kwargs):
+        capture = kwargs.get('capture_groups', None)
+        captured_terms = capture[0]
 
-    def _add_most_recent_quote_from_user(self, user, client, message_list):
-        try:
-            self._search_user_and_client_in_message(user, client, message_list, reverse=True)
-        except:
-            raise
+        quotes = self.stasher.search_quotes(captured_terms, limit=self.max_search_results)
+        if quotes:
+            text_list = []
+            for quote in quotes:
+                try:
+                    user = self.havocbot.db.find_user_by_id(quote['user_id'])
+                except UserDoesNotExist:
+                    user = None
+
+                text_list.append('#%d %s' % (quote.eid, self._quote_as_string(quote, user)))
+
+            client.send_messages_from_list(text_list, message.reply(), event=message.event)
+        else:
+            text = 'No quotes found matching %s' % captured_terms
+            client.send_message(text, message.reply(), event=message.event)
 
-    def _search_user_and_client_in_message(self, user, client, message_list, reverse=None):
-        if reverse is True:
-            message_list.reverse()
+    def trigger_debug_quote(self, client, message, **kwargs):
+        logger.info(self.recent_messages)
+        for message in self.recent_messages.get_messages():
+            logger.info(message)
 
-        for message in message_list:
-            if client.integration_name in user.usernames and user.usernames[client.integration_name] is not None:
-                if message.sender in user.usernames[client.integration_name]:
-                    self._add_quote(message)
-                    return
+    def _add_most_recent_quote_from_user(self, user, client):
+        if client.integration_name in user.usernames and user.usernames[client.integration_name] is not None:
+            message = self.recent_messages.find_most_recent(client.integration_name,
+                                                            user.usernames[client.integration_name])
+            if message is not None:
+                self._add_quote(user, message)
+                return
 
         raise UserDataNotFoundException
 
-    def _add_quote(self, message):
+    def _add_quote(self, user, message):
         logger.info('Adding %s to quote db' % message)
 
+        timestamp = datetime.utcnow().replace(tzinfo=tz.tzutc()).isoformat()
+        self.stasher.add_quote(user.user_id, message.text, message.to, timestamp)
+
     def _quote_as_string(self, quote_dict, user_object=None):
         result = None
 
@@ -276,47 +310,307 @@ class QuoterPlugin(HavocBotPlugin):
     #         client.send_message(text, message.reply(), event=message.event)
 
 
+class RecentMessageTracker(object):
+    """ Keeps the last few messages of every (client, channel, sender).
+
+    Each key holds at most max_messages messages. At most max_keys keys are
+    tracked and the least recently active one is dropped to make room, as is
+    any key that has been quiet for max_age seconds. Adding a message costs
+    O(1) no matter how many senders have been seen.
+    """
+
+    def __init__(self, max_messages=5, max_keys=1000, max_age=86400, timer=time.time):
+        self.max_messages = max_messages
+        self.max_keys = max_keys
+        self.max_age = max_age
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def __str__(self):
+        return "RecentMessageTracker(Keys: %d, Max Keys: %d, Max Messages: %d)" % (
+            len(self.entries), self.max_keys, self.max_messages)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, message):
+        key = (message.client, message.to, message.sender)
+        now = self.timer()
+
+        with self.lock:
+            messages = self.entries.pop(key, None)
+            if messages is None:
+                messages = deque(maxlen=self.max_messages)
+
+            messages.append((now, message))
+
+            # The most recently active key is always last
+            self.entries[key] = messages
+            self._evict(now)
+
+    def find_most_recent(self, client_name, senders):
+        """ Returns the newest tracked message sent by any of senders on the client or None.
+        """
+
+        senders = set(senders)
+        result = None
+
+        with self.lock:
+            self._evict(self.timer())
+
+            for (key, messages) in self.entries.items():
+                if key[0] == client_name and key[2] in senders:
+                    if result is None or messages[-1][0] >= result[0]:
+                        result = messages[-1]
+
+        return result[1] if result is not None else None
+
+    def get_messages(self):
+        with self.lock:
+            return [message for messages in self.entries.values() for (_, message) in messages]
+
+    def _evict(self, now):
+        while self.entries:
+            (key, messages) = next(iter(self.entries.items()))
+
+            if len(self.entries) > self.max_keys or messages[-1][0] < now - self.max_age:
+                del self.entries[key]
+            else:
+                break
+
+
 def format_datetime_for_display(date_object):
     # Convert to local timezone from UTC timezone
     return date_object.astimezone(tz.tzlocal()).strftime('%A %B %d %Y %I:%M%p')
 
 
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)*", re.UNICODE)
+
+
+def tokenize(text):
+    """ Splits text into lower case words. Apostrophes inside a word are kept so "don't" stays one token.
+    """
+
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class QuoteSearchIndex(object):
+    """ Inverted index from the words of each quote to the quote ids.
+
+    postings maps a token to a dictionary of quote id to the number of times
+    the token appears in that quote. Every quote is tokenized once by add().
+    save() writes the index to path and load() reads it back so a restart
+    only tokenizes the quotes added since the index was last saved.
+
+    search() ranks quotes by tf-idf. Quotes matching more of the terms, and
+    rarer terms, come first.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.postings = {}
+        self.eids = set()
+        self.is_modified = False
+
+    def __str__(self):
+        return "QuoteSearchIndex(Quotes: %d, Tokens: %d)" % (len(self.eids), len(self.postings))
+
+    def __len__(self):
+        return len(self.eids)
+
+    def __contains__(self, eid):
+        return eid in self.eids
+
+    def add(self, eid, text):
+        for token in tokenize(text):
+            counts = self.postings.setdefault(token, {})
+            counts[eid] = counts.get(eid, 0) + 1
+
+        self.eids.add(eid)
+        self.is_modified = True
+
+    def search(self, terms, limit=3):
+        """ Returns the ids of the limit best matching quotes, best match first.
+        """
+
+        scores = {}
+
+        for token in set(tokenize(terms)):
+            counts = self.postings.get(token)
+            if not counts:
+                continue
+
+            idf = math.log(1.0 + float(len(self.eids)) / len(counts))
+            for (eid, count) in counts.items():
+                scores[eid] = scores.get(eid, 0.0) + (1.0 + math.log(count)) * idf
+
+        # Ties go to the newest quote
+        return heapq.nlargest(limit, scores, key=lambda x: (scores[x], x))
+
+    def clear(self):
+        self.postings = {}
+        self.eids = set()
+        self.is_modified = True
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+
+            # JSON object keys are strings so the postings are stored as lists of [id, count] pairs
+            postings = dict((token, dict((int(x), y) for (x, y) in counts))
+                            for (token, counts) in data['postings'].items())
+            eids = set(int(x) for x in data['eids'])
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Unable to read quote search index '%s' - %s" % (self.path, e))
+            return False
+
+        self.postings = postings
+        self.eids = eids
+        self.is_modified = False
+
+        return True
+
+    def save(self):
+        if self.path is None or not self.is_modified:
+            return
+
+        data = {
+            'eids': sorted(self.eids),
+            'postings': dict((token, sorted(counts.items())) for (token, counts) in self.postings.items())
+        }
+        atomic_write(self.path, json.dumps(data, separators=(',', ':'), sort_keys=True))
+
+        self.is_modified = False
+        logger.debug("Saved %s to '%s'" % (self, self.path))
+
+
 class StasherTinyDBQuoter(object):
-    def __init__(self):
-        self.db = TinyDB('stasher/havocbot_quoter.json', default_table='quotes', sort_keys=True, indent=2)
+    """ Quote storage with in memory indexes by user and by (user, channel).
+
+    Every quote is loaded into memory once when the stasher is created
+    because a TinyDB lookup reads the whole table. The indexes hold quote
+    ids so picking a random quote is a choice from a list plus one
+    dictionary lookup. add_quote() writes the quote to the file and updates
+    the indexes.
+
+    Quote text is searchable through a QuoteSearchIndex kept in index_path,
+    by default next to the quote file. It is written at startup when quotes
+    had to be tokenized and again by close().
+    """
+
+    def __init__(self, path='stasher/havocbot_quoter.json', index_path=None):
+        # Reads are served from memory and every new quote is written straight through to the file
+        self.db = TinyDB(path, storage=WriteBehindMiddleware(flush_interval=0), default_table='quotes',
+                         sort_keys=True, indent=2)
+        self.lock = threading.Lock()
+        self.quotes = {}
+        self.by_user = {}
+        self.by_user_channel = {}
+        self.keys = set()
+        self.search_index = QuoteSearchIndex(
+            index_path if index_path is not None else '%s_index.json' % os.path.splitext(path)[0])
+
+        self.search_index.load()
+
+        quotes = self.db.all()
+
+        # An index holding quotes that are no longer in the db belongs to another copy of the file
+        if not self.search_index.eids.issubset(x.eid for x in quotes):
+            logger.warning("Quote search index does not match the quote db. Rebuilding it")
+            self.search_index.clear()
+
+        indexed = len(self.search_index)
+
+        for quote in quotes:
+            self._index(quote)
+
+        logger.debug("Indexed %d quotes from %d users, tokenized %d quotes for searching" % (
+            len(self.keys), len(self.by_user), len(self.search_index) - indexed))
+
+        self.search_index.save()
 
     def find_quote_by_id(self, json_id):
         logger.info("Searching for json object with id '%d'" % json_id)
 
-        result = self.db.get(eid=json_id)
+        result = self._get_quote(json_id)
 
         logger.debug("Returning with '%s'" % result)
         return result
 
     def find_quote_by_user_id(self, user_id):
         logger.info("Searching for quote from user id '%d'" % user_id)
-        result = None
 
-        quotes_query = Query()
-        matched_quotes = self.db.search(quotes_query['user_id'] == user_id)
-        if matched_quotes is not None and matched_quotes:
-            result = random.choice(matched_quotes)
+        result = self._get_random_quote(self.by_user, user_id)
 
         logger.debug("Returning with '%s'" % result)
         return result
 
     def find_quote_by_user_id_in_channel(self, user_id, channel):
         logger.info("Searching for quote from user id '%d' in channel '%s'" % (user_id, channel))
-        result = None
 
-        quotes_query = Query()
-        matched_quotes = self.db.search((quotes_query['user_id'] == user_id) & (quotes_query['channel'] == channel))
-        if matched_quotes is not None and matched_quotes:
-            result = random.choice(matched_quotes)
+        result = self._get_random_quote(self.by_user_channel, (user_id, channel))
 
         logger.debug("Returning with '%s'" % result)
         return result
 
+    def search_quotes(self, terms, limit=3):
+        logger.info("Searching for quotes matching '%s'" % terms)
+
+        with self.lock:
+            return [self._get_quote(x) for x in self.search_index.search(terms, limit=limit)]
+
+    def add_quote(self, user_id, text, channel, timestamp):
+        """ Stores a quote and returns its id.
+
+        Raises UserDataAlreadyExistsException if the user already has the same quote in the channel.
+        """
+
+        quote = {'user_id': user_id, 'quote': text, 'channel': channel, 'timestamp': timestamp}
+
+        with self.lock:
+            if (user_id, channel, text) in self.keys:
+                raise UserDataAlreadyExistsException
+
+            eid = self.db.insert(quote)
+            self._index(Element(quote, eid))
+
+        logger.info("Added quote %d from user id '%d'" % (eid, user_id))
+        return eid
+
+    def close(self):
+        with self.lock:
+            self.search_index.save()
+
+        self.db.close()
+
+    def _index(self, quote):
+        self.quotes[quote.eid] = dict(quote)
+
+        user_id = quote.get('user_id')
+        channel = quote.get('channel')
+
+        self.by_user.setdefault(user_id, []).append(quote.eid)
+        self.by_user_channel.setdefault((user_id, channel), []).append(quote.eid)
+        self.keys.add((user_id, channel, quote.get('quote')))
+
+        if quote.eid not in self.search_index:
+            self.search_index.add(quote.eid, quote.get('quote'))
+
+    def _get_random_quote(self, index, key):
+        with self.lock:
+            eids = index.get(key)
+            return self._get_quote(random.choice(eids)) if eids else None
+
+    def _get_quote(self, eid):
+        # Hand out copies so callers can not change the stored quotes
+        quote = self.quotes.get(eid)
+        return Element(dict(quote), eid) if quote is not None else None
+
 
 # Make this plugin available to HavocBot
 havocbot_handler = QuoterPlugin()
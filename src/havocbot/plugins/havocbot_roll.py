@@ -12,6 +12,9 @@ from havocbot.user import UserDoesNotExist
 
 logger = logging.getLogger(__name__)
 
+# Seconds between rolls in a rolloff round to build up some drama
+ROLLOFF_ROLL_INTERVAL = 2
+
 
 class RollPlugin(HavocBotPlugin):
 
@@ -49,6 +52,9 @@ class RollPlugin(HavocBotPlugin):
         self.rolloff_rollers_initial = None
         self.rolloff_minimum_players = None
         self.should_award_points = False
+        self.rolloff_call = None
+        # '!rolloff' runs on a dispatcher worker but the rounds run on the scheduler thread
+        self.lock = threading.RLock()
 
     def configure(self, settings):
         requirements_met = False
@@ -79,7 +85,12 @@ class RollPlugin(HavocBotPlugin):
             return False
 
     def shutdown(self):
-        self.havocbot = None
+        with self.lock:
+            if self.rolloff_call is not None:
+                self.rolloff_call.cancel()
+
+            self._rolloff_disable()
+            self.havocbot = None
 
     def trigger_default(self, client, message, **kwargs):
         roll_result = self._get_roll(100)
@@ -128,16 +139,17 @@ class RollPlugin(HavocBotPlugin):
             client.send_message(text, message.reply(), event=message.event)
 
     def trigger_rolloff(self, client, message, **kwargs):
-        try:
-            user = self.havocbot.db.find_user_by_username_for_client(message.sender, client.integration_name)
-        except UserDoesNotExist:
-            text = 'Only known users can do that.'
-            client.send_message(text, message.reply(), event=message.event)
-        else:
-            if not self.rolloff_in_process:
-                self._new_rolloff(client, message)
+        with self.lock:
+            try:
+                user = self.havocbot.db.find_user_by_username_for_client(message.sender, client.integration_name)
+            except UserDoesNotExist:
+                text = 'Only known users can do that.'
+                client.send_message(text, message.reply(), event=message.event)
+            else:
+                if not self.rolloff_in_process:
+                    self._new_rolloff(client, message)
 
-            self._add_user_to_rolloff(client, message, user)
+                self._add_user_to_rolloff(client, message, user)
 
     def _new_rolloff(self, client, message):
         start_phrases = [
@@ -159,8 +171,7 @@ class RollPlugin(HavocBotPlugin):
 
         self._rolloff_enable()
 
-        bg_thread = threading.Thread(target=self._background_thread, args=[client, message])
-        bg_thread.start()
+        self._schedule_rolloff_step(self.rolloff_join_interval, self._close_rolloff_entries, client, message)
 
     def _rolloff_enable(self):
         self.rolloff_in_process = True
@@ -169,6 +180,7 @@ class RollPlugin(HavocBotPlugin):
         self.rolloff_rollers_initial = []
 
     def _rolloff_disable(self):
+        self.rolloff_call = None
         self.rolloff_in_process = False
         self.rolloff_start_time = None
         self.rolloff_rollers_current = []
@@ -195,61 +207,81 @@ class RollPlugin(HavocBotPlugin):
             text = 'There is no rolloff to join. Aww, nice try'
             client.send_message(text, message.reply(), event=message.event)
 
-    def _run_rolloff_round(self, client, message, round_participants):
-        round_winners_dict = {'users': [], 'roll': 0}
-
-        for user_object in round_participants:
-            # Sleep to build up some drama
-            time.sleep(2)
+    def _schedule_rolloff_step(self, delay, function, *args):
+        self.rolloff_call = self.havocbot.scheduler.call_later(delay, self._run_rolloff_step, function, *args)
 
-            roll_result = self._get_roll(100)
-            self.display_roll(client, message, user_object, roll_result)
+    def _run_rolloff_step(self, function, *args):
+        with self.lock:
+            function(*args)
 
-            if roll_result > round_winners_dict['roll']:
-                round_winners_dict['users'] = [user_object]
-                round_winners_dict['roll'] = roll_result
-            elif roll_result == round_winners_dict['roll']:
-                round_winners_dict['users'].append(user_object)
-                logger.debug("tied_users are '%s'" % (round_winners_dict['users']))
+    def _close_rolloff_entries(self, client, message):
+        logger.debug('triggered')
+        self._run_rolloff(client, message, self.rolloff_rollers_initial)
 
-        if len(round_winners_dict['users']) == 1:
-            logger.debug('Found a single winner')
-            self.rolloff_winner_found = True
+    def _run_rolloff(self, client, message, initial_participants):
+        if len(initial_participants) >= self.rolloff_minimum_players:
+            self._run_rolloff_round(client, message, initial_participants)
         else:
-            logger.debug('No single winner found')
-            tie_phrases = [
-                'A tie?! This cannot be... There can be only one!',
-                'What the? A tied score cannot stand. Fixing...',
-                'DEALING WITH IT',
-                'Everyone is out except for the people tied!'
-            ]
-            text = '%s' % (choice(tie_phrases))
+            text = 'Not enough players'
             client.send_message(text, message.reply(), event=message.event)
-            self.rolloff_winner_found = False
+            self._rolloff_disable()
 
-        return round_winners_dict
+    def _run_rolloff_round(self, client, message, initial_participants):
+        """ Starts a round where every participant rolls in turn, ROLLOFF_ROLL_INTERVAL seconds apart.
+        """
+
+        round_winners_dict = {'users': [], 'roll': 0}
 
-    def _run_rolloff(self, client, message, initial_participants):
         # Create a copy of the original list
         round_participants = list(initial_participants)
 
-        if len(initial_participants) >= self.rolloff_minimum_players:
-            winners = None
+        self._schedule_rolloff_step(ROLLOFF_ROLL_INTERVAL, self._roll_for_next_participant, client, message,
+                                    initial_participants, round_participants, round_winners_dict)
+
+    def _roll_for_next_participant(self, client, message, initial_participants, round_participants,
+                                   round_winners_dict):
+        user_object = round_participants.pop(0)
 
-            self.rolloff_winner_found = False
-            while not self.rolloff_winner_found:
-                winners = self._run_rolloff_round(client, message, round_participants)
+        roll_result = self._get_roll(100)
+        self.display_roll(client, message, user_object, roll_result)
+
+        if roll_result > round_winners_dict['roll']:
+            round_winners_dict['users'] = [user_object]
+            round_winners_dict['roll'] = roll_result
+        elif roll_result == round_winners_dict['roll']:
+            round_winners_dict['users'].append(user_object)
+            logger.debug("tied_users are '%s'" % (round_winners_dict['users']))
+
+        if round_participants:
+            self._schedule_rolloff_step(ROLLOFF_ROLL_INTERVAL, self._roll_for_next_participant, client, message,
+                                        initial_participants, round_participants, round_winners_dict)
+        else:
+            self._finish_rolloff_round(client, message, initial_participants, round_winners_dict)
+
+    def _finish_rolloff_round(self, client, message, initial_participants, round_winners_dict):
+        if len(round_winners_dict['users']) == 1:
+            logger.debug('Found a single winner')
 
-            text = '%s wins with %s' % (winners['users'][0].name, winners['roll'])
+            winner = round_winners_dict['users'][0]
+            text = '%s wins with %s' % (winner.name, round_winners_dict['roll'])
             client.send_message(text, message.reply(), event=message.event)
 
             if self.should_award_points:
-                self._award_points(winners['users'][0], initial_participants, client, message)
+                self._award_points(winner, initial_participants, client, message)
+
+            self._rolloff_disable()
         else:
-            text = 'Not enough players'
+            logger.debug('No single winner found')
+            tie_phrases = [
+                'A tie?! This cannot be... There can be only one!',
+                'What the? A tied score cannot stand. Fixing...',
+                'DEALING WITH IT',
+                'Everyone is out except for the people tied!'
+            ]
+            text = '%s' % (choice(tie_phrases))
             client.send_message(text, message.reply(), event=message.event)
 
-        self._rolloff_disable()
+            self._run_rolloff_round(client, message, initial_participants)
 
     def _award_points(self, winner_user_object, initial_participants, client, message):
         logger.info('%d initial participants' % (len(initial_participants)))
@@ -266,11 +298,6 @@ class RollPlugin(HavocBotPlugin):
                 except UserDoesNotExist:
                     logger.error('Unable to remove point from user')
 
-    def _background_thread(self, client, message):
-        time.sleep(self.rolloff_join_interval)
-        logger.debug('triggered')
-        self._run_rolloff(client, message, self.rolloff_rollers_initial)
-
 
 # Make this plugin available to HavocBot
 havocbot_handler = RollPlugin()
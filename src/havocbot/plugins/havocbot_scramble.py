@@ -1,6 +1,8 @@
 #!/havocbot
 
+from array import array
 import logging
+import mmap
 import os.path
 import random
 import threading
@@ -10,6 +12,13 @@ from havocbot.user import UserDoesNotExist
 
 logger = logging.getLogger(__name__)
 
+# Word lengths to pick from for '!scramble <difficulty>'. None leaves that end open
+DIFFICULTY_LENGTHS = {
+    'easy': (None, 5),
+    'medium': (6, 8),
+    'hard': (9, None),
+}
+
 
 class ScramblePlugin(HavocBotPlugin):
 
@@ -25,12 +34,15 @@ class ScramblePlugin(HavocBotPlugin):
     def plugin_usages(self):
         return [
             Usage(command='!scramble', example=None, description='start a round of scramble'),
+            Usage(command='!scramble <difficulty>', example='!scramble hard',
+                  description='start a round with an easy, medium or hard word'),
         ]
 
     @property
     def plugin_triggers(self):
         return [
-            Trigger(match='!scramble', function=self.trigger_start_scramble, requires='scramble:start'),
+            Trigger(match='!scramble(?:\s(easy|medium|hard))?', function=self.trigger_start_scramble,
+                    requires='scramble:start'),
             Trigger(match='(.*)', function=self.trigger_default),
         ]
 
@@ -39,10 +51,18 @@ class ScramblePlugin(HavocBotPlugin):
         self.word_file = None
         self.scramble_duration = None
         self.hint_interval = None
+        self.min_word_length = 2
+        self.max_word_length = None
+        self.word_list = None
         self.in_process = False
         self.original_word = None
         self.scrambled_word = None
         self.roll_start_time = None
+        self.hints_given = 0
+        self.hint_call = None
+        self.time_up_call = None
+        # Guesses and commands run on a dispatcher worker but hints and time_up run on the scheduler thread
+        self.lock = threading.RLock()
 
     def configure(self, settings):
         requirements_met = False
@@ -55,12 +75,16 @@ class ScramblePlugin(HavocBotPlugin):
                     self.scramble_duration = int(item[1])
                 elif item[0] == 'hint_interval':
                     self.hint_interval = int(item[1])
+                elif item[0] == 'min_word_length':
+                    self.min_word_length = int(item[1])
+                elif item[0] == 'max_word_length':
+                    self.max_word_length = int(item[1])
 
         if self.word_file is not None and self.scramble_duration is not None and self.hint_interval is not None:
             if os.path.isfile(self.word_file):
                 if self.scramble_duration > 0 and isinstance(self.scramble_duration, int):
                     if self.hint_interval > 0 and isinstance(self.scramble_duration, int):
-                        requirements_met = True
+                        requirements_met = self.load_word_list()
                     else:
                         logger.error('There was an issue with the hint interval time. '
                                      'Verify hint_interval is set in the settings file')
@@ -76,99 +100,131 @@ class ScramblePlugin(HavocBotPlugin):
             return False
 
     def shutdown(self):
+        self.reset_scramble()
+
+        if self.word_list is not None:
+            self.word_list.close()
+            self.word_list = None
+
         self.havocbot = None
 
-    def trigger_default(self, client, message, **kwargs):
-        if self.in_process is True:
-            if self.does_guess_match_scrambled_word(message.text, self.original_word):
-                user = None
-                text = None
-
-                try:
-                    user = self.havocbot.db.find_user_by_username_for_client(message.sender, client.integration_name)
-                except UserDoesNotExist:
-                    text = "%s got it correct. The answer was '%s'" % (message.sender, self.original_word)
-                else:
-                    text = "%s got it correct. The answer was '%s'" % (user.name, self.original_word)
-                finally:
-                    client.send_message(text, message.reply(), event=message.event)
-                    self.reset_scramble()
+    def load_word_list(self):
+        if self.word_list is not None:
+            self.word_list.close()
 
-    def trigger_start_scramble(self, client, message, **kwargs):
-        # Check to see if a scramble has already been started
-        if not self.in_process:
-
-            word = self.random_line(self.word_file)
-            if word:
-                scrambled_word = self.shuffle_word(word)
-                if scrambled_word and scrambled_word != 'None':
-                    # Get a word, scramble it, and set in_process to True
-                    self.in_process = True
-                    self.original_word = word
-                    self.scrambled_word = scrambled_word
-                    self.roll_start_time = time.time()
-
-                    logger.info("word is '%s', scrambled_word is '%s'" % (word, scrambled_word))
-
-                    text = "Unscramble the letters to form the word. Guessing is open for %d seconds - '%s'" % (
-                        self.scramble_duration, self.scrambled_word)
-                    client.send_message(text, message.reply(), event=message.event)
+        self.word_list = WordList(self.word_file, min_length=self.min_word_length, max_length=self.max_word_length)
+
+        try:
+            self.word_list.load()
+        except (IOError, OSError) as e:
+            logger.error("Unable to read the word list '%s' - %s" % (self.word_file, e))
+            return False
+
+        if not len(self.word_list):
+            logger.error("No usable words found in the word list '%s'" % self.word_file)
+            return False
+
+        logger.info("Loaded %s" % self.word_list)
+        return True
 
-                    verify_original_word = self.original_word
+    def trigger_default(self, client, message, **kwargs):
+        with self.lock:
+            if self.in_process is True:
+                if self.does_guess_match_scrambled_word(message.text, self.original_word):
+                    user = None
+                    text = None
+
+                    try:
+                        user = self.havocbot.db.find_user_by_username_for_client(message.sender,
+                                                                                 client.integration_name)
+                    except UserDoesNotExist:
+                        text = "%s got it correct. The answer was '%s'" % (message.sender, self.original_word)
+                    else:
+                        text = "%s got it correct. The answer was '%s'" % (user.name, self.original_word)
+                    finally:
+                        client.send_message(text, message.reply(), event=message.event)
+                        self.reset_scramble()
 
-                    helper = RepeatedTimer(self.hint_interval, self.print_letter_of_word, client, message, word)
-                    helper.start()
-                    bg_thread = threading.Thread(
-                        target=self.background_thread, args=[client, message, verify_original_word, helper])
-                    bg_thread.start()
+    def trigger_start_scramble(self, client, message, **kwargs):
+        with self.lock:
+            # Check to see if a scramble has already been started
+            if not self.in_process:
+                capture = kwargs.get('capture_groups', None)
+                difficulty = capture[0] if capture else None
+                (min_length, max_length) = DIFFICULTY_LENGTHS.get(difficulty, (None, None))
+
+                word = self.word_list.random_word(min_length=min_length, max_length=max_length)
+                if word:
+                    scrambled_word = self.shuffle_word(word)
+                    if scrambled_word and scrambled_word != 'None':
+                        # Get a word, scramble it, and set in_process to True
+                        self.in_process = True
+                        self.original_word = word
+                        self.scrambled_word = scrambled_word
+                        self.roll_start_time = time.time()
+                        self.hints_given = 0
+
+                        logger.info("word is '%s', scrambled_word is '%s'" % (word, scrambled_word))
+
+                        text = "Unscramble the letters to form the word. Guessing is open for %d seconds - '%s'" % (
+                            self.scramble_duration, self.scrambled_word)
+                        client.send_message(text, message.reply(), event=message.event)
+
+                        scheduler = self.havocbot.scheduler
+                        self.hint_call = scheduler.call_every(self.hint_interval, self.print_letter_of_word, client,
+                                                              message, word)
+                        self.time_up_call = scheduler.call_later(self.scramble_duration, self.time_up, client, message,
+                                                                 word)
 
+                    else:
+                        text = 'There was an error fetching a scrambled word'
+                        client.send_message(text, message.reply(), event=message.event)
                 else:
                     text = 'There was an error fetching a scrambled word'
                     client.send_message(text, message.reply(), event=message.event)
             else:
-                text = 'There was an error fetching a scrambled word'
+                text = 'Scramble is already running'
                 client.send_message(text, message.reply(), event=message.event)
-        else:
-            text = 'Scramble is already running'
-            client.send_message(text, message.reply(), event=message.event)
-
-    def random_line(self, afile):
-        return random.choice(open(afile).readlines()).strip()
-
-    def background_thread(self, client, message, verify_original_word, timer):
-        time.sleep(self.scramble_duration)
-        logger.debug("word is '%s' and verification is '%s'" % (self.original_word, verify_original_word))
-
-        if self.in_process and self.original_word == verify_original_word:
-            text = "Time's up! The answer was '%s'" % self.original_word
-            client.send_message(text, message.reply(), event=message.event)
-            self.reset_scramble()
-            timer.stop()
-
-    def print_letter_of_word(self, timer, client, message, word, index):
-        if timer.is_running and self.in_process:
-            if len(word) > index + 1:
-                if word == self.original_word:
-                    text = "Hint: Character at position %s is '%s'" % (index + 1, word[index])
-                    client.send_message(text, message.reply(), event=message.event)
-                else:
-                    timer.stop()
 
-    def get_hint(self, timer, word, index):
-        if timer.is_running and self.in_process:
-            if len(word) > index + 1:
-                if word == self.original_word:
-                    return index + 1, word[index]
-                else:
-                    timer.stop()
+    def time_up(self, client, message, word):
+        with self.lock:
+            logger.debug("word is '%s' and verification is '%s'" % (self.original_word, word))
+
+            if self.in_process and self.original_word == word:
+                text = "Time's up! The answer was '%s'" % self.original_word
+                client.send_message(text, message.reply(), event=message.event)
+                self.reset_scramble()
+
+    def print_letter_of_word(self, client, message, word):
+        with self.lock:
+            (position, character) = self.get_hint(word, self.hints_given)
+
+            if position is not None:
+                text = "Hint: Character at position %s is '%s'" % (position, character)
+                client.send_message(text, message.reply(), event=message.event)
+                self.hints_given += 1
+            elif self.hint_call is not None and word == self.original_word:
+                # Out of hints for this round. Rounds that are over have already cancelled their hints
+                self.hint_call.cancel()
+
+    def get_hint(self, word, index):
+        if self.in_process and word == self.original_word and len(word) > index + 1:
+            return index + 1, word[index]
 
         return None, None
 
     def reset_scramble(self):
-        self.in_process = False
-        self.original_word = None
-        self.scrambled_word = None
-        self.roll_start_time = None
+        with self.lock:
+            for call in (self.hint_call, self.time_up_call):
+                if call is not None:
+                    call.cancel()
+
+            self.hint_call = None
+            self.time_up_call = None
+            self.in_process = False
+            self.original_word = None
+            self.scrambled_word = None
+            self.roll_start_time = None
 
     def does_guess_match_scrambled_word(self, guess, word):
         if guess == word:
@@ -191,32 +247,128 @@ class ScramblePlugin(HavocBotPlugin):
             return temp_word
 
 
-class RepeatedTimer(object):
-    def __init__(self, interval, function, client, message, word):
-        self._timer = None
-        self.interval = interval
-        self.function = function
-        self.client = client
-        self.message = message
-        self.word = word
-        self.is_running = False
-        self.index = 0
-
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.function(self, self.client, self.message, self.word, self.index)
-        self.index += 1
-
-    def start(self):
-        if not self.is_running:
-            self._timer = threading.Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
-
-    def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+class WordList(object):
+    """ Words of a word file loaded once and bucketed by length.
+
+    The file is read once and the start and end offset of every word is kept
+    in an array per word length, so picking a word never rereads or splits
+    the file and can be limited to a range of lengths. Files larger than
+    mmap_threshold bytes are memory mapped instead of read so only the pages
+    holding the picked words are loaded.
+
+    Words shorter than min_length or longer than max_length and words made
+    of a single repeated letter, which can not be scrambled, are skipped.
+    random_word() loads the file again when it has been changed.
+    """
+
+    def __init__(self, path, min_length=2, max_length=None, mmap_threshold=16 * 1024 * 1024):
+        self.path = path
+        self.min_length = min_length
+        self.max_length = max_length
+        self.mmap_threshold = mmap_threshold
+        self.lock = threading.Lock()
+        self.data = None
+        self.buckets = {}
+        self.count = 0
+        self.signature = None
+
+    def __str__(self):
+        return "WordList(Path: '%s', Words: %d, Lengths: %d, Memory Mapped: %s)" % (
+            self.path, self.count, len(self.buckets), isinstance(self.data, mmap.mmap))
+
+    def __len__(self):
+        return self.count
+
+    def load(self):
+        signature = get_file_signature(self.path)
+        buckets = {}
+        count = 0
+
+        with open(self.path, 'rb') as f:
+            offset = 0
+
+            for line in f:
+                word = line.strip()
+                if word:
+                    length = len(word.decode('utf-8', 'replace'))
+                    if self._is_usable(word, length):
+                        start = offset + line.index(word)
+                        buckets.setdefault(length, array('L')).extend((start, start + len(word)))
+                        count += 1
+
+                offset += len(line)
+
+            if offset > self.mmap_threshold:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                f.seek(0)
+                data = f.read()
+
+        with self.lock:
+            old_data = self.data
+            self.data, self.buckets, self.count, self.signature = data, buckets, count, signature
+
+        if isinstance(old_data, mmap.mmap):
+            old_data.close()
+
+        logger.debug("Loaded %d words from '%s'" % (count, self.path))
+
+    def reload_if_changed(self):
+        try:
+            signature = get_file_signature(self.path)
+        except OSError as e:
+            logger.warning("Unable to check the word list '%s'. Keeping the loaded words - %s" % (self.path, e))
+            return
+
+        if signature != self.signature:
+            logger.info("Word list '%s' changed. Reloading it" % self.path)
+
+            try:
+                self.load()
+            except (IOError, OSError) as e:
+                logger.error("Unable to reload the word list '%s'. Keeping the loaded words - %s" % (self.path, e))
+
+    def random_word(self, min_length=None, max_length=None):
+        """ Returns a random word with a length between min_length and max_length or None if there is none.
+        """
+
+        self.reload_if_changed()
+
+        with self.lock:
+            buckets = [y for (x, y) in self.buckets.items()
+                       if (min_length is None or x >= min_length) and (max_length is None or x <= max_length)]
+
+            # Every word is a (start, end) pair in its bucket. Pick uniformly across all matching words
+            index = random.randrange(sum(len(x) for x in buckets) // 2) if buckets else None
+
+            for bucket in buckets:
+                size = len(bucket) // 2
+                if index < size:
+                    return self.data[bucket[2 * index]:bucket[2 * index + 1]].decode('utf-8', 'replace')
+                index -= size
+
+        return None
+
+    def close(self):
+        with self.lock:
+            if isinstance(self.data, mmap.mmap):
+                self.data.close()
+
+            self.data = None
+            self.buckets = {}
+            self.count = 0
+            self.signature = None
+
+    def _is_usable(self, word, length):
+        if length < self.min_length or (self.max_length is not None and length > self.max_length):
+            return False
+
+        return len(set(word)) > 1
+
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime
 
 
 # Make this plugin available to HavocBot
@@ -36,6 +36,10 @@ class ShowtimesPlugin(HavocBotPlugin):
         self.api_key_amc = None
         self.max_distance_in_miles = 5  # Default option
         self.max_upcoming_showtimes_to_display = 5  # Default option
+        self.lookup_timeout = 10  # Default option
+        self.locations_cache_ttl = 86400  # Default option
+        self.showtimes_cache_ttl = 3600  # Default option
+        self.cache = None
 
     def configure(self, settings):
         requirements_met = True
@@ -48,6 +52,15 @@ class ShowtimesPlugin(HavocBotPlugin):
                     self.max_distance_in_miles = item[1]
                 elif item[0] == 'max_upcoming_showtimes_to_display':
                     self.max_upcoming_showtimes_to_display = item[1]
+                elif item[0] == 'lookup_timeout':
+                    self.lookup_timeout = float(item[1])
+                elif item[0] == 'locations_cache_ttl':
+                    self.locations_cache_ttl = int(item[1])
+                elif item[0] == 'showtimes_cache_ttl':
+                    self.showtimes_cache_ttl = int(item[1])
+
+        self.cache = showtimes.ShowtimesCache(locations_ttl=self.locations_cache_ttl,
+                                              showtimes_ttl=self.showtimes_cache_ttl)
 
         if self.api_key_amc is not None and len(self.api_key_amc) > 0:
             if self.max_distance_in_miles is not None and isinstance(self.max_distance_in_miles, int):
@@ -70,6 +83,9 @@ class ShowtimesPlugin(HavocBotPlugin):
             return False
 
     def shutdown(self):
+        if self.cache is not None:
+            logger.info("Showtimes cache at shutdown - %s" % self.cache)
+
         self.havocbot = None
 
     def trigger_default(self, client, message, **kwargs):
@@ -79,7 +95,8 @@ class ShowtimesPlugin(HavocBotPlugin):
         logger.debug('searching for movies for %s' % zip_code)
         showtimes_object = showtimes.get_showtimes_for_zip_on_date(
             zip_code, datetime.now().strftime('%m-%d-%Y'), self.api_key_amc,
-            self.max_distance_in_miles, self.max_upcoming_showtimes_to_display)
+            self.max_distance_in_miles, self.max_upcoming_showtimes_to_display, http_client=self.havocbot.http,
+            timeout=self.lookup_timeout, cache=self.cache)
 
         if showtimes_object:
             client.send_messages_from_list(showtimes_object, message.reply(), event=message.event)
@@ -38,6 +38,11 @@ class WeatherPlugin(HavocBotPlugin):
         self.api_key_weatherunderground = None
         self.api_key_openweathermap = None
         self.max_zip_codes_per_query = 3  # Default value
+        self.lookup_timeout = 10  # Default value
+        self.cache_ttl = 300  # Default value
+        self.cache_max_age = 3600  # Default value
+        self.cache_file = None
+        self.cache = None
 
     def configure(self, settings):
         requirements_met = False
@@ -48,6 +53,18 @@ class WeatherPlugin(HavocBotPlugin):
                     self.api_key_weatherunderground = item[1]
                 elif item[0] == 'api_key_openweathermap':
                     self.api_key_openweathermap = item[1]
+                elif item[0] == 'lookup_timeout':
+                    self.lookup_timeout = float(item[1])
+                elif item[0] == 'cache_ttl':
+                    self.cache_ttl = int(item[1])
+                elif item[0] == 'cache_max_age':
+                    self.cache_max_age = int(item[1])
+                elif item[0] == 'cache_file':
+                    self.cache_file = item[1].strip() or None
+
+        self.cache = weather.WeatherCache(ttl=self.cache_ttl, max_age=self.cache_max_age)
+        if self.cache_file is not None:
+            self.cache.load(self.cache_file)
 
         if (self.api_key_weatherunderground is not None and len(self.api_key_weatherunderground) > 0) or \
                 (self.api_key_openweathermap is not None and len(self.api_key_openweathermap) > 0):
@@ -63,6 +80,15 @@ class WeatherPlugin(HavocBotPlugin):
             return False
 
     def shutdown(self):
+        if self.cache is not None:
+            logger.info("Weather cache at shutdown - %s, Hit Ratio: %.2f" % (self.cache, self.cache.hit_ratio()))
+
+            if self.cache_file is not None:
+                try:
+                    self.cache.save(self.cache_file)
+                except (IOError, OSError) as e:
+                    logger.error("Unable to save the weather cache - %s" % e)
+
         self.havocbot = None
 
     def trigger_default(self, client, message, **kwargs):
@@ -82,7 +108,9 @@ class WeatherPlugin(HavocBotPlugin):
             if any(x in ['warmest', 'hottest'] for x in words):
                 weather_list = weather.return_temperatures_list(
                     zip_codes, self.api_key_weatherunderground,
-                    self.api_key_openweathermap, self.max_zip_codes_per_query)
+                    self.api_key_openweathermap, self.max_zip_codes_per_query,
+                    http_client=self.havocbot.http, timeout=self.lookup_timeout, cache=self.cache)
+                self.havocbot.metrics.gauge('weather.cache.hit_ratio', self.cache.hit_ratio())
                 warmest_weather = weather.return_warmest_weather_object_from_list(weather_list)
                 if message.to:
                     if warmest_weather:
@@ -92,7 +120,9 @@ class WeatherPlugin(HavocBotPlugin):
             else:
                 weather_list = weather.return_temperatures_list(
                     zip_codes, self.api_key_weatherunderground,
-                    self.api_key_openweathermap, self.max_zip_codes_per_query)
+                    self.api_key_openweathermap, self.max_zip_codes_per_query,
+                    http_client=self.havocbot.http, timeout=self.lookup_timeout, cache=self.cache)
+                self.havocbot.metrics.gauge('weather.cache.hit_ratio', self.cache.hit_ratio())
                 if message.to:
                     if weather_list:
                         for weather_object in weather_list:
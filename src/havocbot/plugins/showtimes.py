@@ -1,18 +1,19 @@
+import argparse
+from bisect import bisect_left
+import calendar
 from dateutil import tz, parser
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
 import logging
+import random
 import requests
+import timeit
+from havocbot.cache import TTLCache
+from havocbot.common import gather_with_deadline, timedelta_total_seconds
 
 logger = logging.getLogger(__name__)
 
 
-# Python 2.6 does not support total_seconds()
-def timedelta_total_seconds(timedelta):
-    return (
-        timedelta.microseconds +
-        (timedelta.seconds + timedelta.days * 24 * 3600) * 10 ** 6) / 10 ** 6
-
-
 class TheatreObject(object):
     def __init__(self, _id=None, name=None, city=None, state=None, movies=None):
         self._id = _id
@@ -102,9 +103,29 @@ class MovieObject(object):
 
 
 class Showtimes(object):
+    """ The showtimes of a theatre.
+
+    Assigning showtimes also keeps them ordered by their start time so the
+    upcoming showtimes are found with a binary search over epoch seconds
+    instead of parsing and sorting every showtime on each request.
+    """
+
     def __init__(self, showtimes=None, count=None):
-        self.showtimes = showtimes
         self.count = count
+        self.ordered = []
+        self.epochs = []
+        self._showtimes = None
+        self.showtimes = showtimes
+
+    @property
+    def showtimes(self):
+        return self._showtimes
+
+    @showtimes.setter
+    def showtimes(self, showtimes):
+        self._showtimes = showtimes
+        self.ordered = sorted((x for x in showtimes or [] if x.epoch is not None), key=lambda x: x.epoch)
+        self.epochs = [x.epoch for x in self.ordered]
 
     def __str__(self):
         return "Showtimes(Count: %d, Showtimes: %s)" % (self.count, self.showtimes)
@@ -119,21 +140,11 @@ class Showtimes(object):
         else:
             return 'No showtimes found'
 
-    # dt must be timezone aware
+    # Returns up to max_value showtimes starting at or after dt in start time order. dt must be timezone aware
     def get_nearest_showtimes_to_datetime(self, dt, max_value):
-        nearest_showtimes = []
-
-        if self.count and self.count > 0 and self.showtimes:
-            s_list = sorted(self.showtimes, key=lambda x: timedelta_total_seconds(dt - x.get_showtime_as_datetime()))
-            # sorted_list = sorted(self.showtimes, key=lambda x: (dt - x.get_showtime_as_datetime()).total_seconds())
-
-            if len(s_list) > max_value:
-                for showtime in s_list[:max_value]:
-                    nearest_showtimes.append(showtime)
-            # else:
-            #     nearest_showtimes = nearest_showtimes.append(showtime)
+        index = bisect_left(self.epochs, calendar.timegm(dt.utctimetuple()))
 
-        return nearest_showtimes
+        return self.ordered[index:index + max_value]
 
 
 class Showtime(object):
@@ -151,8 +162,12 @@ class Showtime(object):
         self.show_date_time_local = show_date_time_local
         self.show_date_time_utc = show_date_time_utc
         self.datetime = None
+        self.epoch = None
         self.mpaa_rating = None
 
+        if show_date_time_utc is not None:
+            self.parse_show_date_time_utc()
+
     def __str__(self):
         return "Showtime(ID: %s, Movie Name: %s, Internal Release Number: %s, Movie ID: %s)" % (
             self._id, self.movie_name, self.internal_release_number, self.movie_id)
@@ -169,17 +184,22 @@ class Showtime(object):
             self.movie_name, self.get_showtime_as_datetime(), self.ticket_prices[0].type_, self.ticket_prices[0].price))
         print(self.return_basic())
 
-    def get_showtime_as_datetime(self):
-        return parser.parse(self.show_date_time_utc)
-
-    def time_as_local(self):
+    def parse_show_date_time_utc(self):
         date_time = parser.parse(self.show_date_time_utc)
 
         # Assert the current time is in UTC
-        date_time = date_time.replace(tzinfo=tz.tzutc())
+        self.datetime = date_time.replace(tzinfo=tz.tzutc())
+        self.epoch = calendar.timegm(self.datetime.utctimetuple())
+
+    def get_showtime_as_datetime(self):
+        if self.datetime is None:
+            self.parse_show_date_time_utc()
+
+        return self.datetime
 
+    def time_as_local(self):
         # Convert to local time
-        return date_time.astimezone(tz.tzlocal()).strftime('%I:%M:%S%p')
+        return self.get_showtime_as_datetime().astimezone(tz.tzlocal()).strftime('%I:%M:%S%p')
 
 
 class ShowtimeTicket(object):
@@ -193,13 +213,16 @@ class ShowtimeTicket(object):
         return "Ticket(Price: %s, Type: %s, SKU: %s)" % (self.price, self.type_, self.sku)
 
 
-def get_json_showtimes_at_theatre_on_date(theatre_object, date, api_key_amc):
+# http_client can be the HTTPClient shared by HavocBot. The requests module is used when it is not provided
+def get_json_from_amc(url, api_key_amc, http_client=None):
     headers = {'X-AMC-Vendor-Key': api_key_amc}
-    url = "https://api.amctheatres.com/v2/theatres/%s/showtimes/%s/?pageSize=25" % (theatre_object._id, date)
-
-    logger.debug("Fetching showtimes at %s on %s..." % (theatre_object._id, date))
+    http_client = http_client if http_client is not None else requests
 
-    r = requests.get(url, headers=headers)
+    try:
+        r = http_client.get(url, headers=headers)
+    except requests.RequestException as e:
+        logger.error("Unable to fetch '%s' - %s" % (url, e))
+        return None
 
     if r.status_code == 200:
         return r.json()
@@ -207,19 +230,21 @@ def get_json_showtimes_at_theatre_on_date(theatre_object, date, api_key_amc):
         return None
 
 
-def get_json_showtimes_at_theatre_on_date_for_movie(theatre_object, date, movie_name, api_key_amc):
-    headers = {'X-AMC-Vendor-Key': api_key_amc}
+def get_json_showtimes_at_theatre_on_date(theatre_object, date, api_key_amc, http_client=None):
+    url = "https://api.amctheatres.com/v2/theatres/%s/showtimes/%s/?pageSize=25" % (theatre_object._id, date)
+
+    logger.debug("Fetching showtimes at %s on %s..." % (theatre_object._id, date))
+
+    return get_json_from_amc(url, api_key_amc, http_client=http_client)
+
+
+def get_json_showtimes_at_theatre_on_date_for_movie(theatre_object, date, movie_name, api_key_amc, http_client=None):
     url = "https://api.amctheatres.com/v2/theatres/%s/showtimes/%s/?movieName=%s&pageSize=25" % (
         theatre_object._id, date, movie_name)
 
     logger.debug("Fetching showtimes at %s on %s for %s..." % (theatre_object._id, date, movie_name))
 
-    r = requests.get(url, headers=headers)
-
-    if r.status_code == 200:
-        return r.json()
-    else:
-        return None
+    return get_json_from_amc(url, api_key_amc, http_client=http_client)
 
 
 def ticket_as_payload(json):
@@ -241,6 +266,10 @@ def create_showtime_from_json(data):
         showtime.show_date_time_local = data['showDateTimeLocal'] if 'showDateTimeLocal' in data else None
         showtime.show_date_time_utc = data['showDateTimeUtc'] if 'showDateTimeUtc' in data else None
 
+        # Parse the start time once so ordering showtimes never parses it again
+        if showtime.show_date_time_utc is not None:
+            showtime.parse_show_date_time_utc()
+
         ticket_prices_list = []
         for ticket_data in data['ticketPrices']:
             ticket = ticket_as_payload(ticket_data)
@@ -252,18 +281,12 @@ def create_showtime_from_json(data):
         return None
 
 
-def get_location_suggestions(zip_code, api_key_amc):
+def get_location_suggestions(zip_code, api_key_amc, http_client=None):
     logger.info("Fetching location suggestions for %s..." % zip_code)
 
-    headers = {'X-AMC-Vendor-Key': api_key_amc}
     url = "https://api.amctheatres.com/v2/location-suggestions/?query=%s" % zip_code
 
-    r = requests.get(url, headers=headers)
-
-    if r.status_code == 200:
-        return r.json()
-    else:
-        return None
+    return get_json_from_amc(url, api_key_amc, http_client=http_client)
 
 
 def parse_location_suggestions_for_locations_url(json):
@@ -300,35 +323,87 @@ def parse_locations_for_theatre_objects_within_distance(json, distance):
     return theatre_objects_list
 
 
-def get_theater_id_list_from_locations_url(url, api_key_amc):
+def get_theater_id_list_from_locations_url(url, api_key_amc, http_client=None):
     if url is not None and 'https://api.amctheatres.com' in url and len(url) > 30:
         logger.info("Fetching locations at %s..." % url)
 
-        headers = {'X-AMC-Vendor-Key': api_key_amc}
+        return get_json_from_amc(url, api_key_amc, http_client=http_client)
 
-        r = requests.get(url, headers=headers)
 
-        if r.status_code == 200:
-            return r.json()
-        else:
-            return None
+class ShowtimesCache(object):
+    """ Caches the AMC lookups behind a showtimes request.
+
+    The locations url of a zip code and the theatres at that url change
+    almost never so they are kept for locations_ttl seconds. The showtimes
+    of a theatre on a date change a few times a day so they are kept for
+    showtimes_ttl seconds.
+    """
+
+    def __init__(self, locations_ttl=86400, showtimes_ttl=3600, max_size=500):
+        self.locations_urls = TTLCache(max_size=max_size, ttl=locations_ttl)
+        self.locations = TTLCache(max_size=max_size, ttl=locations_ttl)
+        self.showtimes = TTLCache(max_size=max_size, ttl=showtimes_ttl)
+
+    def __str__(self):
+        return "ShowtimesCache(Locations Urls: %s, Locations: %s, Showtimes: %s)" % (
+            self.locations_urls, self.locations, self.showtimes)
+
+
+def get_locations_url_for_zip(zip_code, api_key_amc, http_client=None, cache=None):
+    locations_url = cache.locations_urls.get(zip_code) if cache is not None else None
+
+    if locations_url is None:
+        location_suggestions = get_location_suggestions(zip_code, api_key_amc, http_client=http_client)
+        locations_url = parse_location_suggestions_for_locations_url(location_suggestions)
+
+        if locations_url is not None and cache is not None:
+            cache.locations_urls.set(zip_code, locations_url)
+
+    return locations_url
 
 
-def get_showtimes_for_zip_on_date(zip_code, date, api_key_amc, max_distance, max_upcoming_st):
+def get_locations_json_for_url(locations_url, api_key_amc, http_client=None, cache=None):
+    locations_json = cache.locations.get(locations_url) if cache is not None else None
+
+    if locations_json is None:
+        locations_json = get_theater_id_list_from_locations_url(locations_url, api_key_amc, http_client=http_client)
+
+        if locations_json is not None and cache is not None:
+            cache.locations.set(locations_url, locations_json)
+
+    return locations_json
+
+
+def get_showtimes_for_zip_on_date(zip_code, date, api_key_amc, max_distance, max_upcoming_st, http_client=None,
+                                  timeout=10, cache=None):
     results = []
     if zip_code is not None and date is not None and api_key_amc is not None \
             and max_distance is not None and max_upcoming_st is not None:
-        location_suggestions = get_location_suggestions(zip_code, api_key_amc)
-        locations_url = parse_location_suggestions_for_locations_url(location_suggestions)
+        locations_url = get_locations_url_for_zip(zip_code, api_key_amc, http_client=http_client, cache=cache)
 
         if locations_url is not None:
-            locations_json = get_theater_id_list_from_locations_url(locations_url, api_key_amc)
+            locations_json = get_locations_json_for_url(locations_url, api_key_amc, http_client=http_client,
+                                                        cache=cache)
             theatre_list = parse_locations_for_theatre_objects_within_distance(locations_json, max_distance)
 
             # We now have some theaters within the max distance of the zip code
-            for theatre in theatre_list:
+            if cache is not None:
+                showtimes_lists = [cache.showtimes.get((theatre._id, date)) for theatre in theatre_list]
+            else:
+                showtimes_lists = [None] * len(theatre_list)
+
+            # Fetch the theatres that missed the cache at the same time
+            missing = [index for (index, showtimes_list) in enumerate(showtimes_lists) if showtimes_list is None]
+            if missing:
+                calls = [(fetch_showtimes_list_for_theatre_object_and_date,
+                          (theatre_list[index], date, api_key_amc, http_client, cache)) for index in missing]
+                fetched = gather_with_deadline(calls, timeout, name='HavocBotShowtimes')
+
+                for (index, showtimes_list) in zip(missing, fetched):
+                    showtimes_lists[index] = showtimes_list
+
+            for (theatre, showtimes_list) in zip(theatre_list, showtimes_lists):
                 results.append("Upcoming showtimes at %s" % theatre.name)
-                showtimes_list = get_showtimes_list_for_theatre_object_and_date(theatre, date, api_key_amc)
 
                 if showtimes_list is not None:
                     now = datetime.utcnow().replace(tzinfo=tz.tzutc())
@@ -344,21 +419,44 @@ def get_showtimes_for_zip_on_date(zip_code, date, api_key_amc, max_distance, max
     return results
 
 
-def get_showtimes_list_for_theatre_object_and_date(theatre_object, date, api_key_amc):
-    data = get_json_showtimes_at_theatre_on_date(theatre_object, date, api_key_amc)
+def create_showtimes_from_json(data):
+    showtimes = Showtimes()
+    if 'count' in data:
+        showtimes.count = data['count']
+
+    # Create a list of showtimes
+    showtimes_list = []
+    if '_embedded' in data and 'showtimes' in data['_embedded']:
+        for item in data['_embedded']['showtimes']:
+            showtime = create_showtime_from_json(item)
+            showtimes_list.append(showtime)
+        showtimes.showtimes = showtimes_list
+
+    return showtimes
+
+
+def get_showtimes_list_for_theatre_object_and_date(theatre_object, date, api_key_amc, http_client=None, cache=None):
+    if cache is not None:
+        showtimes = cache.showtimes.get((theatre_object._id, date))
+        if showtimes is not None:
+            return showtimes
+
+    return fetch_showtimes_list_for_theatre_object_and_date(theatre_object, date, api_key_amc,
+                                                            http_client=http_client, cache=cache)
+
+
+def fetch_showtimes_list_for_theatre_object_and_date(theatre_object, date, api_key_amc, http_client=None,
+                                                     cache=None):
+    """ Asks AMC without looking in the cache. The showtimes are stored in the cache.
+    """
+
+    data = get_json_showtimes_at_theatre_on_date(theatre_object, date, api_key_amc, http_client=http_client)
 
     if data is not None:
-        showtimes = Showtimes()
-        if 'count' in data:
-            showtimes.count = data['count']
-
-        # Create a list of showtimes
-        showtimes_list = []
-        if '_embedded' in data and 'showtimes' in data['_embedded']:
-            for item in data['_embedded']['showtimes']:
-                showtime = create_showtime_from_json(item)
-                showtimes_list.append(showtime)
-            showtimes.showtimes = showtimes_list
+        showtimes = create_showtimes_from_json(data)
+
+        if cache is not None:
+            cache.showtimes.set((theatre_object._id, date), showtimes)
 
         return showtimes
     else:
@@ -368,9 +466,72 @@ def get_showtimes_list_for_theatre_object_and_date(theatre_object, date, api_key
         return None
 
 
+def create_benchmark_payload(count, seed=1):
+    """ Creates a showtimes payload shaped like the AMC API response for a theatre with count showtimes.
+    """
+
+    generator = random.Random(seed)
+    start = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=12)
+
+    showtimes_json = []
+    for index in range(count):
+        show_date_time = start + timedelta(minutes=generator.randint(0, 7 * 24 * 60))
+        showtimes_json.append({
+            'id': index, 'movieId': index % 40, 'movieName': 'Movie %d' % (index % 40), 'mpaaRating': 'PG',
+            'showDateTimeUtc': show_date_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'showDateTimeLocal': show_date_time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'ticketPrices': [{'price': 12.5, 'type': 'Adult', 'sku': 'A'}],
+        })
+
+    return {'count': count, '_embedded': {'showtimes': showtimes_json}}
+
+
+def run_benchmark(data, queries, max_value):
+    now = datetime.utcnow().replace(tzinfo=tz.tzutc())
+
+    parse_time = min(timeit.repeat(lambda: create_showtimes_from_json(data), number=1, repeat=3))
+    showtimes = create_showtimes_from_json(data)
+
+    # The previous approach parsed every showtime inside the sort key of each request
+    def sort_and_parse():
+        upcoming = [x for x in showtimes.showtimes if parser.parse(x.show_date_time_utc).replace(
+            tzinfo=tz.tzutc()) >= now]
+        return sorted(upcoming, key=lambda x: parser.parse(x.show_date_time_utc))[:max_value]
+
+    expected = [x._id for x in sort_and_parse()]
+    if expected != [x._id for x in showtimes.get_nearest_showtimes_to_datetime(now, max_value)]:
+        raise AssertionError('Upcoming showtimes do not match')
+
+    sort_time = min(timeit.repeat(sort_and_parse, number=1, repeat=3))
+    bisect_time = min(timeit.repeat(lambda: showtimes.get_nearest_showtimes_to_datetime(now, max_value),
+                                    number=queries, repeat=3)) / queries
+
+    print('%10s  %14s  %14s  %14s' % ('showtimes', 'parse ms', 'sort us/query', 'bisect us/query'))
+    print('%10d  %14.1f  %14.1f  %14.1f' % (len(showtimes.showtimes or []), parse_time * 10 ** 3,
+                                            sort_time * 10 ** 6, bisect_time * 10 ** 6))
+
+
 def main():
-    zip_code = "94110"
-    showtimes = get_showtimes_for_zip_on_date(zip_code, datetime.now().strftime("%m-%d-%Y"), None, None, None)
+    arg_parser = argparse.ArgumentParser(description='Fetch showtimes near a zip code')
+    arg_parser.add_argument('-z', '--zip-code', help='zip code to search near', default='94110')
+    arg_parser.add_argument('-b', '--bench', help='benchmark upcoming showtime selection', action='store_true')
+    arg_parser.add_argument('-f', '--file', help='recorded theatre showtimes payload to benchmark with', default=None)
+    arg_parser.add_argument('-c', '--count', help='number of showtimes to generate when no file is given',
+                            type=int, default=5000)
+    arg_parser.add_argument('-q', '--queries', help='number of queries to time', type=int, default=1000)
+    args = vars(arg_parser.parse_args())
+
+    if args['bench']:
+        if args['file']:
+            with open(args['file']) as f:
+                data = json.load(f)
+        else:
+            data = create_benchmark_payload(args['count'])
+
+        run_benchmark(data, args['queries'], 5)
+        return
+
+    showtimes = get_showtimes_for_zip_on_date(args['zip_code'], datetime.now().strftime("%m-%d-%Y"), None, None, None)
     if showtimes is not None:
         for listing in showtimes:
             print(listing)
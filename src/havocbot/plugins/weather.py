@@ -1,20 +1,22 @@
 import argparse
 from datetime import datetime
 from dateutil import tz
+import json
 import logging
 import logging.handlers
+import os
 import requests
 import sys
+import time
 from xml.etree import ElementTree
+from havocbot.cache import TTLCache
+from havocbot.common import gather_with_deadline, timedelta_total_seconds
+from havocbot.stasherstorage import atomic_write
 
 logger = logging.getLogger(__name__)
 
-
-# Python 2.6 does not support total_seconds()
-def timedelta_total_seconds(timedelta):
-    return (
-        timedelta.microseconds +
-        (timedelta.seconds + timedelta.days * 24 * 3600) * 10 ** 6) / 10 ** 6
+OPEN_WEATHER_MAP = 'OpenWeatherMap'
+WEATHER_UNDERGROUND = 'WeatherUnderground'
 
 
 class WeatherObject:
@@ -71,10 +73,80 @@ class WeatherObject:
         # Convert to local time
         return utc.astimezone(tz.tzlocal()).strftime('%b %d %Y %I:%M:%S%p')
 
+    def to_dict(self):
+        return {'zip_code': self.zip_code, 'temperature': self.temperature, 'city': self.city, 'state': self.state,
+                'source': self.source, 'last_updated': self.last_updated}
+
+
+class WeatherCache(TTLCache):
+    """ Cache of WeatherObjects keyed by (source, zip code).
+
+    An observation is kept for ttl seconds but never past the point where it
+    is max_age seconds old, so an observation that was already stale when it
+    was fetched is not cached at all. The cache can be saved to and loaded
+    from a JSON file to survive a restart.
+    """
+
+    def __init__(self, max_size=500, ttl=300, max_age=3600, timer=time.time):
+        super(WeatherCache, self).__init__(max_size=max_size, ttl=ttl, timer=timer)
+        self.max_age = max_age
+
+    def get_weather(self, source, zip_code):
+        return self.get((source, zip_code))
+
+    def set_weather(self, weather_object, ttl=None):
+        age = self.timer() - weather_object.last_updated
+        ttl = min(ttl if ttl is not None else self.ttl, self.max_age - age)
+
+        if ttl > 0:
+            self.set((weather_object.source, weather_object.zip_code), weather_object, ttl=ttl)
+        else:
+            logger.debug("Not caching %s. The observation is %d seconds old" % (weather_object, age))
+
+    def save(self, path):
+        with self.lock:
+            now = self.timer()
+            entries = [{'expires': expires, 'weather': weather_object.to_dict()}
+                       for (weather_object, expires) in self.entries.values() if expires > now]
+
+        atomic_write(path, json.dumps(entries))
+        logger.debug("Saved %d cached observations to '%s'" % (len(entries), path))
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except ValueError as e:
+            logger.error("Unable to load cached observations from '%s' - %s" % (path, e))
+            return
+
+        now = self.timer()
+
+        # Restored observations only get the time they had left when they were saved
+        for entry in entries:
+            self.set_weather(WeatherObject(**entry['weather']), ttl=entry['expires'] - now)
+
+        logger.debug("Loaded %d cached observations from '%s'" % (len(self), path))
+
+
+def create_weather_from_openweathermap_for_zip_code(zip_code, api_key_openweathermap, http_client=None, cache=None):
+    if cache is not None:
+        weather_object = cache.get_weather(OPEN_WEATHER_MAP, zip_code)
+        if weather_object is not None:
+            return weather_object
+
+    return fetch_weather_from_openweathermap_for_zip_code(zip_code, api_key_openweathermap, http_client=http_client,
+                                                          cache=cache)
+
+
+def fetch_weather_from_openweathermap_for_zip_code(zip_code, api_key_openweathermap, http_client=None, cache=None):
+    """ Asks OpenWeatherMap without looking in the cache. A valid observation is stored in the cache.
+    """
 
-def create_weather_from_openweathermap_for_zip_code(zip_code, api_key_openweathermap):
-    source = "OpenWeatherMap"
-    data = get_openweathermap_xml_for_zip_code(zip_code, api_key_openweathermap)
+    data = get_openweathermap_xml_for_zip_code(zip_code, api_key_openweathermap, http_client=http_client)
 
     if data is not None and is_valid_openweathermap_data(data):
         temperature = data.find('temperature').get('value')
@@ -85,34 +157,66 @@ def create_weather_from_openweathermap_for_zip_code(zip_code, api_key_openweathe
         date_time = datetime.strptime(date_raw, '%Y-%m-%dT%H:%M:%S')
         epoch_seconds = timedelta_total_seconds(date_time - datetime.utcfromtimestamp(0))
 
-        return WeatherObject(zip_code=zip_code, temperature=temperature, city=city,
-                             source=source, last_updated=float(epoch_seconds))
+        weather_object = WeatherObject(zip_code=zip_code, temperature=temperature, city=city,
+                                       source=OPEN_WEATHER_MAP, last_updated=float(epoch_seconds))
+
+        if cache is not None:
+            cache.set_weather(weather_object)
+
+        return weather_object
     else:
         logger.error("Invalid weather data for zip code %s" % zip_code)
 
         return None
 
 
-def create_weather_from_weatherunderground_for_zip_code(zip_code, api_key_weatherunderground):
-    source = "WeatherUnderground"
-    data = get_weather_underground_data_for_zip_code(zip_code, api_key_weatherunderground)
+def create_weather_from_weatherunderground_for_zip_code(zip_code, api_key_weatherunderground, http_client=None,
+                                                        cache=None):
+    if cache is not None:
+        weather_object = cache.get_weather(WEATHER_UNDERGROUND, zip_code)
+        if weather_object is not None:
+            return weather_object
+
+    return fetch_weather_from_weatherunderground_for_zip_code(zip_code, api_key_weatherunderground,
+                                                              http_client=http_client, cache=cache)
+
+
+def fetch_weather_from_weatherunderground_for_zip_code(zip_code, api_key_weatherunderground, http_client=None,
+                                                       cache=None):
+    """ Asks WeatherUnderground without looking in the cache. A valid observation is stored in the cache.
+    """
+
+    data = get_weather_underground_data_for_zip_code(zip_code, api_key_weatherunderground, http_client=http_client)
 
     if data is not None and is_valid_wu_weather(data):
-        return WeatherObject(zip_code=zip_code, temperature=data['current_observation']['temp_f'],
-                             city=data['current_observation']['display_location']['city'],
-                             state=data['current_observation']['display_location']['state'],
-                             source=source, last_updated=float(data['current_observation']['observation_epoch']))
+        weather_object = WeatherObject(
+            zip_code=zip_code, temperature=data['current_observation']['temp_f'],
+            city=data['current_observation']['display_location']['city'],
+            state=data['current_observation']['display_location']['state'],
+            source=WEATHER_UNDERGROUND, last_updated=float(data['current_observation']['observation_epoch']))
+
+        if cache is not None:
+            cache.set_weather(weather_object)
+
+        return weather_object
     else:
         logger.error("Invalid weather data for zip code %s" % zip_code)
 
         return None
 
 
-def get_openweathermap_xml_for_zip_code(zip_code, api_key_openweathermap):
+# http_client can be the HTTPClient shared by HavocBot. The requests module is used when it is not provided
+def get_openweathermap_xml_for_zip_code(zip_code, api_key_openweathermap, http_client=None):
     logger.info("Fetching OpenWeatherMap data for zip code %s..." % zip_code)
 
-    r = requests.get('http://api.openweathermap.org/data/2.5/weather?zip=%s,us&mode=xml&units=imperial&appid=%s' % (
-        zip_code, api_key_openweathermap))
+    http_client = http_client if http_client is not None else requests
+
+    try:
+        r = http_client.get('http://api.openweathermap.org/data/2.5/weather?zip=%s,us&mode=xml&units=imperial&appid=%s'
+                            % (zip_code, api_key_openweathermap))
+    except requests.RequestException as e:
+        logger.error("Unable to fetch OpenWeatherMap data for zip code %s - %s" % (zip_code, e))
+        return None
 
     if r.status_code == 200:
         try:
@@ -125,10 +229,17 @@ def get_openweathermap_xml_for_zip_code(zip_code, api_key_openweathermap):
         return None
 
 
-def get_weather_underground_data_for_zip_code(zip_code, api_key_weatherunderground):
+def get_weather_underground_data_for_zip_code(zip_code, api_key_weatherunderground, http_client=None):
     logger.info("Fetching WeatherUnderground data for zip code %s..." % zip_code)
 
-    r = requests.get('http://api.wunderground.com/api/%s/conditions/q/%s.json' % (api_key_weatherunderground, zip_code))
+    http_client = http_client if http_client is not None else requests
+
+    try:
+        r = http_client.get('http://api.wunderground.com/api/%s/conditions/q/%s.json' % (
+            api_key_weatherunderground, zip_code))
+    except requests.RequestException as e:
+        logger.error("Unable to fetch WeatherUnderground data for zip code %s - %s" % (zip_code, e))
+        return None
 
     if r.status_code == 200:
         return r.json()
@@ -297,37 +408,53 @@ def add_most_recent_weather_in_list_to_master_list(new_list, master_list):
         logger.debug("No recent weather objects found")
 
 
-def return_temperatures_list(zip_code_list, api_key_wu, api_key_owm, max_zip_codes_per_query):
+def return_temperatures_list(zip_code_list, api_key_wu, api_key_owm, max_zip_codes_per_query, http_client=None,
+                             timeout=10, cache=None):
     temperatures = []
 
     # Fetch weather data for the zip codes in the global list
     if len(zip_code_list) > max_zip_codes_per_query:
         logger.info("Too many zip codes requested. Fetching only the first %d elements" % max_zip_codes_per_query)
 
+    providers = []
+
+    # Get data from WeatherUnderground
+    if api_key_wu is not None and len(api_key_wu) > 0:
+        providers.append((WEATHER_UNDERGROUND, fetch_weather_from_weatherunderground_for_zip_code, api_key_wu))
+
+    # Get data from OpenWeatherMap
+    if api_key_owm is not None and len(api_key_owm) > 0:
+        providers.append((OPEN_WEATHER_MAP, fetch_weather_from_openweathermap_for_zip_code, api_key_owm))
+
+    zip_codes = []
+    results = []
+    calls = []
+
     for item in zip_code_list[:max_zip_codes_per_query]:
         # Strip off spaces if the user provided them during input
         zip_code_temp = item.strip()
 
         if is_valid_zip_code(zip_code_temp):
-            # Create an empty list
-            sources = []
-
-            # Get data from WeatherUnderground
-            if api_key_wu is not None and len(api_key_wu) > 0:
-                weather = create_weather_from_weatherunderground_for_zip_code(zip_code_temp, api_key_wu)
-                if weather:
-                    sources.append(weather)
-
-            # Get data from OpenWeatherMap
-            if api_key_owm is not None and len(api_key_owm) > 0:
-                weather_alt = create_weather_from_openweathermap_for_zip_code(zip_code_temp, api_key_owm)
-                if weather_alt:
-                    sources.append(weather_alt)
-
-            add_most_recent_weather_in_list_to_master_list(sources, temperatures)
+            zip_codes.append(zip_code_temp)
+
+            for (source, fetch_function, api_key) in providers:
+                weather_object = cache.get_weather(source, zip_code_temp) if cache is not None else None
+
+                if weather_object is not None:
+                    results.append(weather_object)
+                else:
+                    calls.append((fetch_function, (zip_code_temp, api_key, http_client, cache)))
         else:
             logger.info("'%s' is not a valid zip code" % zip_code_temp)
 
+    # The lookups that missed the cache are all made at the same time. Results that did not arrive in time are left out
+    if calls:
+        results.extend(gather_with_deadline(calls, timeout, name='HavocBotWeather'))
+
+    for zip_code in zip_codes:
+        sources = [x for x in results if x and x.zip_code == zip_code]
+        add_most_recent_weather_in_list_to_master_list(sources, temperatures)
+
     return temperatures
 
 
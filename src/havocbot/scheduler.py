@@ -0,0 +1,169 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledCall(object):
+    """ A callback waiting in a Scheduler. Returned by call_later() and call_every() so it can be cancelled.
+    """
+
+    def __init__(self, scheduler, when, interval, function, args, kwargs):
+        self.scheduler = scheduler
+        self.when = when
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.is_cancelled = False
+
+    def __str__(self):
+        return "ScheduledCall(Function: %s, When: %s, Interval: %s, Cancelled: %s)" % (
+            getattr(self.function, '__name__', self.function), self.when, self.interval, self.is_cancelled)
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class Scheduler(object):
+    """ Runs delayed and repeating callbacks for plugins on a single thread.
+
+    Owned by HavocBot and shared through havocbot.scheduler. Pending calls
+    wait in a heap ordered by due time and the scheduler thread sleeps until
+    the earliest one is due, so any number of running games and countdowns
+    costs one thread instead of one sleeping thread each.
+
+    Callbacks run one at a time on the scheduler thread and should return
+    quickly. A callback that needs to wait should schedule its next step
+    instead of sleeping. Cancelled calls are dropped when they come due.
+    Calls that are still pending when the scheduler is stopped are dropped.
+    """
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.condition = threading.Condition()
+        self.heap = []
+        self.sequence = itertools.count()
+        self.thread = None
+        self.is_running = False
+        self.completed = 0
+        self.failed = 0
+
+    def __str__(self):
+        return "Scheduler(Pending: %d, Completed: %d, Failed: %d)" % (len(self.heap), self.completed, self.failed)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def start(self):
+        with self.condition:
+            if self.is_running:
+                return
+
+            self.is_running = True
+            self.thread = threading.Thread(target=self._run, name='HavocBotScheduler')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            if not self.is_running:
+                return
+
+            logger.debug("Stopping the scheduler. %s" % self)
+
+            self.is_running = False
+            for (_, _, call) in self.heap:
+                call.is_cancelled = True
+            self.heap = []
+            self.condition.notify()
+
+        # The scheduler thread may be the one stopping the bot
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def call_later(self, delay, function, *args, **kwargs):
+        """ Runs function(*args, **kwargs) once after delay seconds.
+        """
+
+        return self._schedule(delay, None, function, args, kwargs)
+
+    def call_every(self, interval, function, *args, **kwargs):
+        """ Runs function(*args, **kwargs) every interval seconds, starting interval seconds from now.
+        """
+
+        if interval <= 0:
+            raise ValueError('The interval must be greater than 0')
+
+        return self._schedule(interval, interval, function, args, kwargs)
+
+    def cancel(self, call):
+        # Leave the call in the heap. Removing it would cost a heap rebuild
+        with self.condition:
+            call.is_cancelled = True
+
+    def _schedule(self, delay, interval, function, args, kwargs):
+        with self.condition:
+            call = ScheduledCall(self, self.timer() + max(0, delay), interval, function, args, kwargs)
+            self._push(call)
+
+        return call
+
+    def _push(self, call):
+        heapq.heappush(self.heap, (call.when, next(self.sequence), call))
+
+        # Wake the scheduler thread if the new call is due before the one it is waiting on
+        if self.heap[0][2] is call:
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                call = self._next_due_call()
+                if call is None:
+                    break
+
+            try:
+                call.function(*call.args, **call.kwargs)
+            except Exception as e:
+                logger.error("Scheduled call to %s failed - %s" % (getattr(call.function, '__name__', call), e))
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def _next_due_call(self):
+        """ Waits for the next call that is due and returns it, or None once the scheduler is stopped.
+
+        Must be called while holding condition.
+        """
+
+        while self.is_running:
+            if not self.heap:
+                self.condition.wait()
+                continue
+
+            (when, _, call) = self.heap[0]
+
+            if call.is_cancelled:
+                heapq.heappop(self.heap)
+                continue
+
+            now = self.timer()
+            if when > now:
+                self.condition.wait(when - now)
+                continue
+
+            heapq.heappop(self.heap)
+
+            # Reschedule from the due time so repeating calls do not drift
+            if call.interval is not None:
+                call.when = max(when + call.interval, now)
+                self._push(call)
+
+            return call
+
+        return None
@@ -4,6 +4,7 @@ import logging
 import os
 import havocbot.exceptions as exceptions
 from havocbot.singletonmixin import Singleton
+from havocbot.stasherstorage import atomic_write
 from havocbot.user import User, StasherClass
 
 logger = logging.getLogger(__name__)
@@ -40,11 +41,9 @@ class Stasher(Singleton):
 
     def write_db(self):
         logger.info("Writing to db")
-        with open(self.filename, 'wt') as outfile:
-            json.dump(json.loads(
-                jsonpickle.encode(self.data, unpicklable=False)),
-                outfile, indent=2, sort_keys=True)
-        self.load_db()
+        atomic_write(self.filename, json.dumps(json.loads(
+            jsonpickle.encode(self.data, unpicklable=False)),
+            indent=2, sort_keys=True))
 
     def add_json_to_key(self, json_data, key, unique_root_key, unique_root_value):
         if self.data is not None:
@@ -165,15 +164,23 @@ class Stasher(Singleton):
         logger.info("Writing plugin data to '%s'" % plugin_file)
         logger.info(self.plugin_data)
 
-        with open(plugin_file, 'wt') as outfile:
-            json.dump(json.loads(
-                jsonpickle.encode(self.plugin_data, unpicklable=False)),
-                outfile, indent=2, sort_keys=True)
-        self.plugin_data = self.get_plugin_data(plugin_name)
+        # Keep the same plain json form that reading the file back would give
+        self.plugin_data = json.loads(jsonpickle.encode(self.plugin_data, unpicklable=False))
+        atomic_write(plugin_file, json.dumps(self.plugin_data, indent=2, sort_keys=True))
 
 
 class StasherDB(StasherClass):
+    """ Legacy user storage on top of the Stasher singleton.
+
+    Only the points methods change anything and they notify the change
+    listeners. Adding or removing users, aliases and permissions is not
+    implemented here, so permission changes made to the underlying data by
+    other means reach HavocBot's permission cache only once the cached
+    entry expires after permission_cache_ttl seconds.
+    """
+
     def __init__(self):
+        super(StasherDB, self).__init__()
         self.stasher = Stasher.getInstance()
         self.db = self.stasher.data
 
@@ -210,6 +217,8 @@ class StasherDB(StasherClass):
                     logger.debug("Adding initial points of %d" % points)
                     stashed_user.points = points
                     # self.write_db()
+
+                self.notify_change_listeners(user_id)
         else:
             logger.error('Points must be an integer')
 
@@ -229,6 +238,8 @@ class StasherDB(StasherClass):
                     logger.debug("Adding initial points of %d" % points)
                     stashed_user.points = -points
                     # self.write_db()
+
+                self.notify_change_listeners(user_id)
         else:
             logger.error('Points must be an integer')
 
@@ -1,13 +1,16 @@
+from havocbot.stashersqlite import StasherSQLite
 from havocbot.stashertinydb import StasherTinyDB
 from havocbot.stasher import StasherDB
 
 
 class StasherFactory(object):
-    def factory(factory_type):
+    def factory(factory_type, **kwargs):
         if factory_type == "StasherTinyDB":
-            return StasherTinyDB()
+            return StasherTinyDB(**kwargs)
+        elif factory_type == "StasherSQLite":
+            return StasherSQLite(**kwargs)
         elif factory_type == "StasherDB":
             return StasherDB()
         else:
-            return StasherTinyDB()
+            return StasherTinyDB(**kwargs)
     factory = staticmethod(factory)
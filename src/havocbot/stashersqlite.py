@@ -0,0 +1,365 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from havocbot.user import (
+    User, StasherClass, UserDataAlreadyExistsException, UserDataNotFoundException, UserDoesNotExist)
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    name_key TEXT,
+    points INTEGER NOT NULL DEFAULT 0,
+    image TEXT,
+    plugin_data TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS users_name_key ON users (name_key);
+
+CREATE TABLE IF NOT EXISTS usernames (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    client TEXT NOT NULL,
+    username TEXT NOT NULL,
+    UNIQUE (user_id, client, username)
+);
+CREATE INDEX IF NOT EXISTS usernames_client_username ON usernames (client, username);
+
+CREATE TABLE IF NOT EXISTS aliases (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    alias TEXT NOT NULL,
+    alias_key TEXT NOT NULL,
+    UNIQUE (user_id, alias)
+);
+CREATE INDEX IF NOT EXISTS aliases_alias_key ON aliases (alias_key);
+
+CREATE TABLE IF NOT EXISTS permissions (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    permission TEXT NOT NULL,
+    UNIQUE (user_id, permission)
+);
+"""
+
+
+class StasherSQLite(StasherClass):
+    """ Stores users in an SQLite database.
+
+    Usernames, aliases and permissions live in their own indexed tables so
+    lookups do not scan every user. The database runs in WAL mode and every
+    thread gets its own connection so plugins on different dispatcher
+    workers can read while another writes.
+
+    The first time a database is opened any users in the TinyDB file at
+    json_path are copied into it, keeping their user ids.
+    """
+
+    def __init__(self, path='stasher/havocbot.sqlite', json_path='stasher/havocbot.json'):
+        super(StasherSQLite, self).__init__()
+        self.path = path
+        self.json_path = json_path
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        with self._get_connection() as conn:
+            conn.executescript(SCHEMA)
+
+        self._migrate_from_json()
+
+    def _get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+
+            self.local.conn = conn
+            with self.connections_lock:
+                self.connections.append(conn)
+
+        return conn
+
+    def close(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+        self.local = threading.local()
+
+    def _migrate_from_json(self):
+        conn = self._get_connection()
+
+        if conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone() is not None:
+            return
+
+        users = {}
+        if self.json_path is not None and os.path.isfile(self.json_path) and os.path.getsize(self.json_path) > 0:
+            with open(self.json_path) as f:
+                users = json.load(f).get('users', {})
+
+        logger.info("Migrating %d users from '%s' to '%s'" % (len(users), self.json_path, self.path))
+
+        with conn:
+            for (user_id, document) in sorted(users.items(), key=lambda x: int(x[0])):
+                self._insert_user(conn, document, int(user_id))
+
+            conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (self.json_path,))
+
+    def _insert_user(self, conn, document, user_id=None):
+        name = document.get('name')
+        cursor = conn.execute(
+            'INSERT INTO users (id, name, name_key, points, image, plugin_data) VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, name, name.lower() if name is not None else None, document.get('points') or 0,
+             document.get('image'), json.dumps(document.get('plugin_data') or {})))
+        user_id = cursor.lastrowid
+
+        for (client, usernames) in (document.get('usernames') or {}).items():
+            for username in usernames:
+                conn.execute('INSERT OR IGNORE INTO usernames (user_id, client, username) VALUES (?, ?, ?)',
+                             (user_id, client, username))
+
+        for alias in document.get('aliases') or []:
+            conn.execute('INSERT OR IGNORE INTO aliases (user_id, alias, alias_key) VALUES (?, ?, ?)',
+                         (user_id, alias, alias.lower()))
+
+        for permission in document.get('permissions') or []:
+            conn.execute('INSERT OR IGNORE INTO permissions (user_id, permission) VALUES (?, ?)',
+                         (user_id, permission))
+
+        return user_id
+
+    def add_user(self, user):
+        conn = self._get_connection()
+
+        with conn:
+            # Take the write lock up front so another thread can not add the same username in between
+            conn.execute('BEGIN IMMEDIATE')
+
+            # Iterate through the user's usernames and see if any usernames already exist
+            for (client, usernames) in (user.usernames or {}).items():
+                for username in usernames:
+                    if self._find_user_ids_by_username(conn, username, client):
+                        logger.error("This user already exists in the db")
+                        raise UserDataAlreadyExistsException
+
+            logger.info("Adding new user '%s' to database" % user.name)
+
+            logger.debug("add_user - adding '%s'" % (user.to_dict_for_db()))
+            user_id = self._insert_user(conn, user.to_dict_for_db())
+
+        self.notify_change_listeners(user_id)
+
+    def del_user(self, user):
+        with self._get_connection() as conn:
+            conn.execute('DELETE FROM users WHERE id = ?', (user.user_id,))
+
+        self.notify_change_listeners(user.user_id)
+
+    def add_permission_to_user_id(self, user_id, permission):
+        logger.info("Adding 'permissions' item '%s' to user id %d" % (permission, user_id))
+        self._add_to_list_table(user_id, 'INSERT INTO permissions (user_id, permission) VALUES (?, ?)',
+                                (user_id, permission))
+
+    def del_permission_to_user_id(self, user_id, permission):
+        logger.info("Deleting 'permissions' item '%s' from user id %d" % (permission, user_id))
+        self._del_from_list_table(user_id, 'DELETE FROM permissions WHERE user_id = ? AND permission = ?',
+                                  (user_id, permission))
+
+    def add_alias_to_user_id(self, user_id, alias):
+        logger.info("Adding 'aliases' item '%s' to user id %d" % (alias, user_id))
+        self._add_to_list_table(user_id, 'INSERT INTO aliases (user_id, alias, alias_key) VALUES (?, ?, ?)',
+                                (user_id, alias, alias.lower()))
+
+    def del_alias_to_user_id(self, user_id, alias):
+        logger.info("Deleting 'aliases' item '%s' from user id %d" % (alias, user_id))
+        self._del_from_list_table(user_id, 'DELETE FROM aliases WHERE user_id = ? AND alias = ?', (user_id, alias))
+
+    def add_points_to_user_id(self, user_id, points):
+        logger.info("Adding %d points to user id %s" % (points, user_id))
+        self._change_points(user_id, int(points))
+
+    def del_points_to_user_id(self, user_id, points):
+        logger.info("Deleting %d points from user id %s" % (points, user_id))
+        self._change_points(user_id, -int(points))
+
+    def find_user_by_id(self, search_user_id):
+        logger.info("Searching for '%s'" % search_user_id)
+
+        users = self._build_users(self._get_connection(), [search_user_id])
+
+        if users:
+            return users[0]
+        else:
+            raise UserDoesNotExist
+
+    def find_user_by_username_for_client(self, search_username, client_name):
+        logger.info("Searching for '%s' in client '%s'" % (search_username, client_name))
+
+        conn = self._get_connection()
+        user_ids = self._find_user_ids_by_username(conn, search_username, client_name)
+
+        if len(user_ids) == 1:
+            return self._build_users(conn, user_ids)[0]
+
+        raise UserDoesNotExist
+
+    def find_users_by_username(self, search_username):
+        pass
+
+    def find_users_by_name_for_client(self, search_name, client_name):
+        logger.info("Searching for '%s' in client '%s'" % (search_name, client_name))
+
+        conn = self._get_connection()
+        rows = conn.execute(
+            'SELECT DISTINCT users.id FROM users JOIN usernames ON usernames.user_id = users.id '
+            'WHERE users.name_key = ? AND usernames.client = ? ORDER BY users.id',
+            (search_name.lower(), client_name)).fetchall()
+
+        results = [x for x in self._build_users(conn, [row[0] for row in rows]) if x.is_valid()]
+
+        logger.debug("Returning with '[%s]'" % (', '.join(map(str, results))))
+        return results
+
+    def find_users_by_alias_for_client(self, search_alias, client_name):
+        logger.info("Searching for '%s' in client '%s'" % (search_alias, client_name))
+
+        conn = self._get_connection()
+        rows = conn.execute(
+            'SELECT DISTINCT aliases.user_id FROM aliases JOIN usernames ON usernames.user_id = aliases.user_id '
+            'WHERE aliases.alias_key = ? AND usernames.client = ? ORDER BY aliases.user_id',
+            (search_alias.lower(), client_name)).fetchall()
+
+        results = [x for x in self._build_users(conn, [row[0] for row in rows]) if x.is_valid()]
+
+        logger.debug("Returning with '[%s]'" % (', '.join(map(str, results))))
+        return results
+
+    def find_users_by_matching_string_for_client(self, search_string, client_name):
+        logger.info("Searching for '%s' in client '%s'" % (search_string, client_name))
+
+        results = []
+
+        results_name = self.find_users_by_name_for_client(search_string, client_name)
+        if results_name is not None and results_name:
+            results.extend(results_name)
+
+        try:
+            result_username = self.find_user_by_username_for_client(search_string, client_name)
+        except UserDoesNotExist:
+            pass
+        else:
+            results.append(result_username)
+
+        results_alias = self.find_users_by_alias_for_client(search_string, client_name)
+        if results_alias is not None and results_alias:
+            results.extend(results_alias)
+
+        return results
+
+    def find_all_users(self):
+        conn = self._get_connection()
+        rows = conn.execute('SELECT id FROM users ORDER BY id').fetchall()
+
+        return self._build_users(conn, [row[0] for row in rows])
+
+    def set_image_for_user_id(self, user_id, url):
+        logger.info("Setting %s url to user id %s" % (url, user_id))
+
+        if url is not None and 'http' not in url:
+            raise ValueError
+
+        with self._get_connection() as conn:
+            if conn.execute('UPDATE users SET image = ? WHERE id = ?', (url, user_id)).rowcount == 0:
+                raise UserDoesNotExist
+
+        self.notify_change_listeners(user_id)
+
+    def build_user(self, result_data):
+        user = User(result_data['id'])
+
+        user.name = result_data['name']
+        user.usernames = result_data['usernames']
+        user.points = result_data['points']
+        user.permissions = result_data['permissions']
+        user.aliases = result_data['aliases']
+        user.image = result_data['image']
+        user.plugin_data = json.loads(result_data['plugin_data']) if result_data['plugin_data'] else {}
+        user.is_stashed = True
+
+        return user
+
+    def _build_users(self, conn, user_ids):
+        """ Builds User objects for the ids with one query per table.
+        """
+
+        if not user_ids:
+            return []
+
+        placeholders = ','.join('?' * len(user_ids))
+        documents = {}
+
+        for row in conn.execute('SELECT * FROM users WHERE id IN (%s)' % placeholders, user_ids):
+            documents[row['id']] = dict(row, usernames={}, aliases=[], permissions=[])
+
+        for row in conn.execute('SELECT user_id, client, username FROM usernames WHERE user_id IN (%s) '
+                                'ORDER BY rowid' % placeholders, user_ids):
+            documents[row['user_id']]['usernames'].setdefault(row['client'], []).append(row['username'])
+
+        for row in conn.execute('SELECT user_id, alias FROM aliases WHERE user_id IN (%s) '
+                                'ORDER BY rowid' % placeholders, user_ids):
+            documents[row['user_id']]['aliases'].append(row['alias'])
+
+        for row in conn.execute('SELECT user_id, permission FROM permissions WHERE user_id IN (%s) '
+                                'ORDER BY rowid' % placeholders, user_ids):
+            documents[row['user_id']]['permissions'].append(row['permission'])
+
+        return [self.build_user(documents[x]) for x in user_ids if x in documents]
+
+    def _find_user_ids_by_username(self, conn, username, client_name):
+        rows = conn.execute('SELECT DISTINCT user_id FROM usernames WHERE client = ? AND username = ?',
+                            (client_name, username)).fetchall()
+
+        return [row[0] for row in rows]
+
+    def _user_id_exists(self, conn, user_id):
+        return conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+
+    def _add_to_list_table(self, user_id, statement, parameters):
+        with self._get_connection() as conn:
+            if not self._user_id_exists(conn, user_id):
+                raise UserDoesNotExist
+
+            try:
+                conn.execute(statement, parameters)
+            except sqlite3.IntegrityError:
+                raise UserDataAlreadyExistsException
+
+        self.notify_change_listeners(user_id)
+
+    def _del_from_list_table(self, user_id, statement, parameters):
+        with self._get_connection() as conn:
+            if not self._user_id_exists(conn, user_id):
+                raise UserDoesNotExist
+
+            if conn.execute(statement, parameters).rowcount == 0:
+                raise UserDataNotFoundException
+
+        self.notify_change_listeners(user_id)
+
+    def _change_points(self, user_id, points):
+        with self._get_connection() as conn:
+            if conn.execute('UPDATE users SET points = points + ? WHERE id = ?', (points, user_id)).rowcount == 0:
+                raise UserDoesNotExist
+
+        self.notify_change_listeners(user_id)
@@ -0,0 +1,302 @@
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import Storage
+
+# Python2/3 compat
+try:
+    from os import replace as replace_file
+except ImportError:
+    from os import rename as replace_file
+
+logger = logging.getLogger(__name__)
+
+
+def read_umask():
+    # The umask can only be read by replacing it, which affects every thread. Only call this at import time
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once while the module is imported, before the bot starts its threads
+UMASK = read_umask()
+
+
+class WriteBehindMiddleware(CachingMiddleware):
+    """ TinyDB middleware that keeps tables in memory and writes them out in batches.
+
+    Reads are always served from memory. Writes only mark the cache as dirty
+    and a background thread writes the whole database out every
+    flush_interval seconds. A burst of writes reaching flush_threshold is
+    written out straight away. close() always writes out pending changes.
+
+    A flush_interval of 0 writes every change through to the file like the
+    plain JSONStorage does. Writing after close() raises a ValueError.
+
+    All access goes through lock so the middleware can be shared by the
+    dispatcher worker threads. Hold lock across a read and the write that
+    follows it to keep another thread from changing the data in between.
+    """
+
+    def __init__(self, storage_cls=None, flush_interval=5, flush_threshold=100):
+        storage_cls = storage_cls if storage_cls is not None else AtomicJSONStorage
+        super(WriteBehindMiddleware, self).__init__(storage_cls)
+
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold if flush_interval > 0 else 1
+        self.lock = threading.RLock()
+        self.is_closed = False
+        self.closing = threading.Event()
+        self.thread = None
+        self.flush_count = 0
+
+    def __call__(self, *args, **kwargs):
+        super(WriteBehindMiddleware, self).__call__(*args, **kwargs)
+
+        if self.flush_interval > 0:
+            self.thread = threading.Thread(target=self._flush_periodically, name='HavocBotStasherFlush')
+            self.thread.daemon = True
+            self.thread.start()
+
+        return self
+
+    def read(self):
+        with self.lock:
+            return super(WriteBehindMiddleware, self).read()
+
+    def write(self, data):
+        with self.lock:
+            if self.is_closed:
+                raise ValueError('The storage has been closed')
+
+            self.cache = data
+            self._cache_modified_count += 1
+
+            if self._cache_modified_count >= self.flush_threshold:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self._cache_modified_count > 0:
+                logger.debug("Writing %d batched changes to storage" % self._cache_modified_count)
+                self.storage.write(self.cache)
+                self._cache_modified_count = 0
+                self.flush_count += 1
+
+    def close(self):
+        self.closing.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        with self.lock:
+            if not self.is_closed:
+                self.is_closed = True
+                super(WriteBehindMiddleware, self).close()
+
+    def _flush_periodically(self):
+        while not self.closing.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Unable to write batched changes to storage - %s" % e)
+
+
+
+class AtomicJSONStorage(Storage):
+    """ TinyDB storage that never leaves a half written database file behind.
+
+    The database is written to a temporary file in the same directory,
+    fsynced and renamed over the old file so a crash leaves either the old
+    or the new version on disk.
+
+    With oplog enabled each write only appends the documents that changed
+    to a '<path>.oplog' file instead of rewriting the database. Opening the
+    storage replays the log on top of the database file. The log is folded
+    back into the database file once it holds compact_threshold entries and
+    when the storage is closed.
+    """
+
+    def __init__(self, path, oplog=False, compact_threshold=1000, **kwargs):
+        super(AtomicJSONStorage, self).__init__()
+
+        self.path = path
+        self.oplog_path = path + '.oplog' if oplog else None
+        self.compact_threshold = compact_threshold
+        self.kwargs = kwargs
+        self.oplog_entries = 0
+        self.snapshot = None
+
+    def read(self):
+        data = None
+
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path) as f:
+                data = json.load(f)
+
+        if self.oplog_path is not None:
+            data = self._replay_oplog(data)
+            self.snapshot = self._create_snapshot(data)
+
+        return data
+
+    def write(self, data):
+        if self.oplog_path is None:
+            atomic_write(self.path, json.dumps(data, **self.kwargs))
+            return
+
+        if self.snapshot is None:
+            self.read()
+
+        snapshot = self._create_snapshot(data)
+        entries = self._diff_snapshots(self.snapshot, snapshot)
+
+        if self.oplog_entries + len(entries) >= self.compact_threshold or not os.path.exists(self.path):
+            self.compact(data)
+        elif entries:
+            with open(self.oplog_path, 'a') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(',', ':'), sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.oplog_entries += len(entries)
+
+        self.snapshot = snapshot
+
+    def compact(self, data):
+        """ Writes the whole database file and empties the operation log.
+        """
+
+        logger.debug("Compacting %d operation log entries into '%s'" % (self.oplog_entries, self.path))
+
+        atomic_write(self.path, json.dumps(data, **self.kwargs))
+
+        if self.oplog_path is not None and os.path.exists(self.oplog_path):
+            os.remove(self.oplog_path)
+
+        self.oplog_entries = 0
+        self.snapshot = self._create_snapshot(data)
+
+    def close(self):
+        if self.oplog_path is not None and self.oplog_entries > 0:
+            self.compact(self.read())
+
+    def _replay_oplog(self, data):
+        self.oplog_entries = 0
+
+        if not os.path.exists(self.oplog_path):
+            return data
+
+        data = data if data is not None else {}
+
+        with open(self.oplog_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash while appending can leave a partial last line
+                    logger.warning("Skipping unreadable entry in '%s'" % self.oplog_path)
+                    continue
+
+                table = data.setdefault(entry['table'], {})
+                if 'document' in entry:
+                    table[entry['id']] = entry['document']
+                elif 'id' in entry:
+                    table.pop(entry['id'], None)
+                else:
+                    del data[entry['table']]
+
+                self.oplog_entries += 1
+
+        logger.info("Replayed %d operation log entries from '%s'" % (self.oplog_entries, self.oplog_path))
+
+        return data
+
+    def _create_snapshot(self, data):
+        snapshot = {}
+
+        for (table, documents) in (data or {}).items():
+            snapshot[table] = dict((str(k), json.dumps(v, sort_keys=True)) for (k, v) in documents.items())
+
+        return snapshot
+
+    def _diff_snapshots(self, old, new):
+        entries = []
+
+        for (table, documents) in new.items():
+            old_documents = old.get(table, {})
+
+            for (eid, serialized) in documents.items():
+                if old_documents.get(eid) != serialized:
+                    entries.append({'table': table, 'id': eid, 'document': json.loads(serialized)})
+
+            for eid in old_documents:
+                if eid not in documents:
+                    entries.append({'table': table, 'id': eid})
+
+        for table in old:
+            if table not in new:
+                entries.append({'table': table})
+
+        return entries
+
+
+def atomic_write(path, text):
+    """ Replaces the file at path with text without ever exposing a partial file.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    (fd, temp_path) = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), suffix='.tmp', dir=directory)
+
+    try:
+        # mkstemp creates private files. Keep the permissions of the file being replaced or honour the umask
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(temp_path, 0o666 & ~UMASK)
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+        replace_file(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # Make the rename itself durable. Not every platform can open a directory
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def storage_locked(function):
+    """ Runs a stasher method while holding the lock of its WriteBehindMiddleware.
+
+    Used on methods that read a document and write it back so concurrent
+    plugin calls can not lose each other's changes.
+    """
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        with self.storage.lock:
+            return function(self, *args, **kwargs)
+
+    return wrapper
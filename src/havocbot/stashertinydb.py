@@ -1,5 +1,7 @@
 import logging
-from tinydb import TinyDB, Query
+from tinydb import TinyDB
+from havocbot.stasherstorage import WriteBehindMiddleware, storage_locked
+from havocbot.userindex import UserIndex
 from havocbot.user import (
     User, StasherClass, UserDataAlreadyExistsException, UserDataNotFoundException, UserDoesNotExist)
 
@@ -7,9 +9,21 @@ logger = logging.getLogger(__name__)
 
 
 class StasherTinyDB(StasherClass):
-    def __init__(self):
-        self.db = TinyDB('stasher/havocbot.json', default_table='users', sort_keys=True, indent=2)
+    def __init__(self, flush_interval=5, flush_threshold=100, oplog=False, oplog_compact_threshold=1000):
+        super(StasherTinyDB, self).__init__()
+        self.storage = WriteBehindMiddleware(flush_interval=flush_interval, flush_threshold=flush_threshold)
+        self.db = TinyDB('stasher/havocbot.json', storage=self.storage, default_table='users', sort_keys=True,
+                         indent=2, oplog=oplog, compact_threshold=oplog_compact_threshold)
+        self.index = UserIndex()
+        self.index.rebuild(self.db.all())
 
+    def flush(self):
+        self.storage.flush()
+
+    def close(self):
+        self.db.close()
+
+    @storage_locked
     def add_user(self, user):
         # Iterate through the user's usernames and see if any usernames already exist
         if self._user_exists(user):
@@ -19,7 +33,8 @@ class StasherTinyDB(StasherClass):
         logger.info("Adding new user '%s' to database" % user.name)
 
         logger.debug("add_user - adding '%s'" % (user.to_dict_for_db()))
-        self.db.insert(user.to_dict_for_db())
+        eid = self.db.insert(user.to_dict_for_db())
+        self._reindex_user(eid)
 
     def del_user(self, user):
         pass
@@ -48,6 +63,7 @@ class StasherTinyDB(StasherClass):
         except:
             raise
 
+    @storage_locked
     def add_points_to_user_id(self, user_id, points):
         logger.info("Adding %d points to user id %s" % (points, user_id))
 
@@ -61,7 +77,10 @@ class StasherTinyDB(StasherClass):
             self.db.update(increment_by_value('points', points), eids=[user_id])
         except KeyError:
             raise UserDoesNotExist
+        else:
+            self._reindex_user(user_id)
 
+    @storage_locked
     def del_points_to_user_id(self, user_id, points):
         logger.info("Deleting %d points from user id %s" % (points, user_id))
 
@@ -75,11 +94,13 @@ class StasherTinyDB(StasherClass):
             self.db.update(decrement_by_value('points', points), eids=[user_id])
         except KeyError:
             raise UserDoesNotExist
+        else:
+            self._reindex_user(user_id)
 
     def find_user_by_id(self, search_user_id):
         logger.info("Searching for '%s'" % search_user_id)
 
-        result = self.db.get(eid=search_user_id)
+        result = self.index.get(search_user_id)
 
         if result is not None:
             return self.build_user(result)
@@ -89,8 +110,7 @@ class StasherTinyDB(StasherClass):
     def find_user_by_username_for_client(self, search_username, client_name):
         logger.info("Searching for '%s' in client '%s'" % (search_username, client_name))
 
-        user_query = Query()
-        result_list = self.db.search(user_query.usernames[client_name].any([search_username]))
+        result_list = self.index.find_by_username(search_username, client_name)
 
         if result_list is not None and result_list:
             if len(result_list) == 1:
@@ -117,13 +137,7 @@ class StasherTinyDB(StasherClass):
         logger.info("Searching for '%s' in client '%s'" % (search_name, client_name))
         results = []
 
-        def name_test_func(val, nested_search_name):
-            return val.lower() == nested_search_name.lower()
-
-        user_query = Query()
-        matched_users = self.db.search((user_query['name'].test(name_test_func, search_name)) &
-                                       (user_query['usernames'].any([client_name]))
-                                       )
+        matched_users = self.index.find_by_name(search_name, client_name)
 
         if matched_users:
             for matched_user in matched_users:
@@ -138,13 +152,7 @@ class StasherTinyDB(StasherClass):
         logger.info("Searching for '%s' in client '%s'" % (search_alias, client_name))
         results = []
 
-        def alias_test_func(val, nested_search_alias):
-            return any(x.lower() for x in val if x.lower() == search_alias.lower())
-
-        user_query = Query()
-        matched_users = self.db.search((user_query['aliases'].test(alias_test_func, search_alias)) &
-                                       (user_query['usernames'].any([client_name]))
-                                       )
+        matched_users = self.index.find_by_alias(search_alias, client_name)
 
         if matched_users:
             for matched_user in matched_users:
@@ -180,6 +188,7 @@ class StasherTinyDB(StasherClass):
     def find_all_users(self):
         pass
 
+    @storage_locked
     def set_image_for_user_id(self, user_id, url):
         logger.info("Setting %s url to user id %s" % (url, user_id))
 
@@ -192,6 +201,7 @@ class StasherTinyDB(StasherClass):
             raise UserDoesNotExist
 
         self.db.update({'image': url}, eids=[user_id])
+        self._reindex_user(user_id)
 
     def build_user(self, result_data):
         user = User(result_data.eid)
@@ -206,6 +216,7 @@ class StasherTinyDB(StasherClass):
 
         return user
 
+    @storage_locked
     def _add_string_to_list_by_key_for_user_id(self, user_id, list_key, string_item):
         logger.info("Adding '%s' item '%s' to user id %d" % (list_key, string_item, user_id))
 
@@ -229,7 +240,9 @@ class StasherTinyDB(StasherClass):
         finally:
             logger.debug("Updating '%s' to '%s' for user id '%s'" % (list_key, list_items, user_id))
             self.db.update({list_key: list_items}, eids=[user_id])
+            self._reindex_user(user_id)
 
+    @storage_locked
     def _del_string_to_list_by_key_for_user_id(self, user_id, list_key, string_item):
         logger.info("Deleting '%s' item '%s' from user id %d" % (list_key, string_item, user_id))
 
@@ -251,6 +264,17 @@ class StasherTinyDB(StasherClass):
                 list_items.remove(string_item)
                 logger.debug("Updating '%s' to '%s' for user id '%s'" % (list_key, list_items, user_id))
                 self.db.update({list_key: list_items}, eids=[user_id])
+                self._reindex_user(user_id)
+
+    def _reindex_user(self, user_id):
+        result = self.db.get(eid=user_id)
+
+        if result is not None:
+            self.index.update(result)
+        else:
+            self.index.remove(user_id)
+
+        self.notify_change_listeners(user_id)
 
     def _user_exists(self, user):
         # Iterate through the user's usernames and see if any usernames already exist
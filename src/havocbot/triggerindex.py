@@ -0,0 +1,407 @@
+import argparse
+import logging
+import random
+import re
+import timeit
+
+logger = logging.getLogger(__name__)
+
+# Characters that end the literal prefix of a trigger pattern
+REGEX_METACHARACTERS = '.^$*+?{}[]()|\\'
+
+# Characters that make the preceding literal character optional or repeatable
+REGEX_QUANTIFIERS = '*+?{'
+
+
+class IndexedTrigger(object):
+    def __init__(self, position, trigger, pattern, regex, literal):
+        self.position = position
+        self.trigger = trigger
+        self.pattern = pattern
+        self.regex = regex
+        self.literal = literal
+
+    @property
+    def is_catch_all(self):
+        """ True for triggers without a literal prefix, like '(.*)', which are tested against every message.
+        """
+
+        return not self.literal
+
+    def __str__(self):
+        return "IndexedTrigger(Position: %d, Pattern: '%s', Literal: '%s')" % (
+            self.position, self.pattern, self.literal)
+
+
+class TriggerIndex(object):
+    """ Precompiled lookup structure for the triggers registered with HavocBot.
+
+    Trigger patterns are compiled once when the trigger set changes instead of
+    on every incoming message. Triggers whose pattern begins with a literal
+    string (like '!roll' or '!user add ') are grouped in a dispatch table keyed
+    by the first word of that literal so a message is only tested against the
+    triggers whose command word appears in it.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.prefix_table = {}
+        self.unprefixed = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rebuild(self, triggers, exact_match_one_word_triggers=False):
+        entries = []
+        prefix_table = {}
+        unprefixed = []
+
+        for trigger in triggers:
+            pattern = get_trigger_pattern(trigger[0], exact_match_one_word_triggers)
+
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                logger.error("Unable to compile trigger '%s' for %s - %s" % (pattern, trigger[1], e))
+                continue
+
+            literal = get_literal_prefix(pattern)
+            entry = IndexedTrigger(len(entries), trigger, pattern, regex, literal)
+            entries.append(entry)
+
+            key = get_dispatch_key(literal)
+            if key is not None:
+                prefix_table.setdefault(key, []).append(entry)
+            else:
+                unprefixed.append(entry)
+
+        logger.debug("Indexed %d triggers. %d dispatch keys, %d triggers without a literal prefix" % (
+            len(entries), len(prefix_table), len(unprefixed)))
+
+        # Swap in the new structures together so readers never see a partial index
+        self.entries, self.prefix_table, self.unprefixed = entries, prefix_table, unprefixed
+
+    def candidates(self, text):
+        """ Returns the indexed triggers that could match the text in registration order.
+        """
+
+        prefix_table = self.prefix_table
+        unprefixed = self.unprefixed
+
+        buckets = [prefix_table[key] for key in prefix_table if key in text]
+        if not buckets:
+            return unprefixed
+
+        return merge_candidates(unprefixed, buckets)
+
+    def match(self, text):
+        """ Yields a (trigger, pattern, match) tuple for every trigger matching the text.
+
+        Triggers are tested in the order they were registered, the same order
+        a linear walk over HavocBot.triggers would use.
+        """
+
+        for (entry, match) in self.match_entries(text):
+            yield entry.trigger, entry.pattern, match
+
+    def match_entries(self, text):
+        """ Yields an (IndexedTrigger, match) tuple for every trigger matching the text, in registration order.
+        """
+
+        for entry in self.candidates(text):
+            match = entry.regex.search(text)
+            if match is not None:
+                yield entry, match
+
+
+class CombinedTriggerIndex(TriggerIndex):
+    """ Trigger index that scans a message once for every literal prefix.
+
+    The literal prefixes of all triggers are fused into a single regex built
+    from a trie of the literals. One pass of that regex over the message finds
+    every literal present, and only the triggers owning those literals (plus
+    the triggers without a literal prefix) are run for their capture groups.
+    """
+
+    def __init__(self):
+        super(CombinedTriggerIndex, self).__init__()
+        self.scanner = None
+        self.literal_table = {}
+        self.implied_literals = {}
+
+    def rebuild(self, triggers, exact_match_one_word_triggers=False):
+        super(CombinedTriggerIndex, self).rebuild(triggers, exact_match_one_word_triggers)
+
+        # Every trigger is either scanned for by its literal or in unprefixed, never both
+        literal_table = {}
+        for entry in self.entries:
+            if not entry.is_catch_all:
+                literal_table.setdefault(entry.literal, []).append(entry)
+
+        # The scanner reports the longest literal found at a position. Any shorter
+        # literal that is a prefix of it is present at that position too
+        implied_literals = {}
+        for literal in literal_table:
+            implied_literals[literal] = [literal[:x] for x in range(1, len(literal) + 1)
+                                         if literal[:x] in literal_table]
+
+        if literal_table:
+            scanner = re.compile('(?=(%s))' % build_trie_pattern(literal_table))
+        else:
+            scanner = None
+
+        self.scanner, self.literal_table, self.implied_literals = scanner, literal_table, implied_literals
+
+    def candidates(self, text):
+        unprefixed = self.unprefixed
+        scanner = self.scanner
+
+        if scanner is None:
+            return unprefixed
+
+        found = set()
+        implied_literals = self.implied_literals
+        for match in scanner.finditer(text):
+            found.update(implied_literals[match.group(1)])
+
+        if not found:
+            return unprefixed
+
+        literal_table = self.literal_table
+
+        return merge_candidates(unprefixed, [literal_table[literal] for literal in found])
+
+
+def merge_candidates(unprefixed, buckets):
+    """ Returns every trigger in unprefixed and the buckets once, in registration order.
+    """
+
+    results = set(unprefixed)
+    for bucket in buckets:
+        results.update(bucket)
+
+    return sorted(results, key=lambda x: x.position)
+
+
+def create_trigger_index(matcher):
+    if matcher is not None and matcher.strip().lower() == 'combined':
+        return CombinedTriggerIndex()
+    else:
+        return TriggerIndex()
+
+
+def build_trie_pattern(literals):
+    """ Builds a regex that matches the longest of the literals at a position.
+    """
+
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    return _trie_node_pattern(trie)
+
+
+def _trie_node_pattern(node):
+    branches = [re.escape(char) + _trie_node_pattern(child) for (char, child) in sorted(node.items()) if char]
+
+    if not branches:
+        return ''
+
+    # Greedy optional groups try the longer literal before settling on this one
+    if '' in node:
+        return '(?:%s)?' % '|'.join(branches)
+    elif len(branches) == 1:
+        return branches[0]
+    else:
+        return '(?:%s)' % '|'.join(branches)
+
+
+def get_trigger_pattern(trigger, exact_match_one_word_triggers=False):
+    # Add exact regex match if user defined
+    if exact_match_one_word_triggers is True and len(trigger.split()) == 1:
+        if not trigger.startswith('^') and not trigger.endswith('$'):
+            trigger = "^" + trigger + "$"
+
+    return trigger
+
+
+def get_literal_prefix(pattern):
+    """ Returns the literal text every match of the pattern must start with.
+
+    Returns an empty string when the pattern has no usable literal prefix, for
+    instance when it starts with a wildcard or group or contains a top level
+    alternation. A prefix made only of whitespace is found in nearly every
+    message, so it counts as no prefix at all.
+    """
+
+    if has_top_level_alternation(pattern):
+        return ''
+
+    index = 1 if pattern.startswith('^') else 0
+    literal = []
+
+    while index < len(pattern):
+        char = pattern[index]
+
+        if char == '\\':
+            # Only escaped punctuation is literal. Things like \s or \d are classes
+            if index + 1 < len(pattern) and not pattern[index + 1].isalnum():
+                char = pattern[index + 1]
+                index += 2
+            else:
+                break
+        elif char in REGEX_METACHARACTERS:
+            break
+        else:
+            index += 1
+
+        # A quantified character is not guaranteed to be in the match
+        if index < len(pattern) and pattern[index] in REGEX_QUANTIFIERS:
+            break
+
+        literal.append(char)
+
+    literal = ''.join(literal)
+
+    return literal if literal.strip() else ''
+
+
+def get_dispatch_key(literal):
+    if literal is not None:
+        words = literal.split()
+        if words:
+            return words[0]
+
+    return None
+
+
+def has_top_level_alternation(pattern):
+    depth = 0
+    in_class = False
+    index = 0
+
+    while index < len(pattern):
+        char = pattern[index]
+
+        if char == '\\':
+            index += 2
+            continue
+
+        if in_class:
+            if char == ']':
+                in_class = False
+        elif char == '[':
+            in_class = True
+            # A closing bracket straight after the opening one is a literal
+            if pattern[index + 1:index + 2] == ']':
+                index += 1
+            elif pattern[index + 1:index + 3] == '^]':
+                index += 2
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+
+        index += 1
+
+    return False
+
+
+def match_linear(triggers, text, exact_match_one_word_triggers=False):
+    """ The original HavocBot.handle_message matching loop. Used for benchmarking.
+    """
+
+    results = []
+
+    for trigger in triggers:
+        pattern = get_trigger_pattern(trigger[0], exact_match_one_word_triggers)
+        match = re.compile(pattern).search(text)
+        if match is not None:
+            results.append((trigger, pattern, match))
+
+    return results
+
+
+def create_benchmark_triggers(count):
+    triggers = []
+
+    # Mirror the shape of the bundled plugins. Mostly '!command' triggers with a
+    # couple of catch-all and free form patterns that cannot be indexed
+    for x in range(count - 2):
+        if x % 3 == 0:
+            triggers.append(('!command%d' % x, None))
+        elif x % 3 == 1:
+            triggers.append(('!command%d\\s(.*)' % x, None))
+        else:
+            triggers.append(('!group%d add (.*) (.*)' % (x // 10), None))
+
+    triggers.append(('(.*)', None))
+    triggers.append(('.*\\d{5}.*weather|weather.*\\d{5}', None))
+
+    return triggers
+
+
+def create_benchmark_messages(count, trigger_count, seed=1):
+    generator = random.Random(seed)
+    chatter = [
+        'anyone around for lunch today?',
+        'the build is broken again',
+        'what is the weather in 94110',
+        'has anyone seen the new release notes for the api',
+        'ok',
+    ]
+
+    messages = []
+    for x in range(count):
+        if x % 4 == 0:
+            messages.append('!command%d some arguments here' % generator.randrange(trigger_count))
+        else:
+            messages.append(generator.choice(chatter))
+
+    return messages
+
+
+def run_benchmark(sizes, message_count):
+    print('%8s  %14s  %14s  %14s' % ('triggers', 'linear us/msg', 'indexed us/msg', 'combined us/msg'))
+
+    for size in sizes:
+        triggers = create_benchmark_triggers(size)
+        messages = create_benchmark_messages(message_count, size)
+
+        indexed = TriggerIndex()
+        indexed.rebuild(triggers)
+        combined = CombinedTriggerIndex()
+        combined.rebuild(triggers)
+
+        # Sanity check that every engine agrees before timing them
+        for text in messages:
+            expected = [(x[0], x[2].groups()) for x in match_linear(triggers, text)]
+            if expected != [(x[0], x[2].groups()) for x in indexed.match(text)] or \
+                    expected != [(x[0], x[2].groups()) for x in combined.match(text)]:
+                raise AssertionError("Trigger engines disagree on '%s'" % text)
+
+        timings = []
+        for engine in (lambda x: match_linear(triggers, x), lambda x: list(indexed.match(x)),
+                       lambda x: list(combined.match(x))):
+            elapsed = min(timeit.repeat(lambda: [engine(x) for x in messages], number=1, repeat=3))
+            timings.append(elapsed / len(messages) * 10 ** 6)
+
+        print('%8d  %14.1f  %14.1f  %14.1f' % (size, timings[0], timings[1], timings[2]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the HavocBot trigger matching engines')
+    parser.add_argument('-s', '--sizes', help='comma separated list of trigger counts', default='10,100,1000')
+    parser.add_argument('-m', '--messages', help='number of messages to match per size', type=int, default=200)
+    args = vars(parser.parse_args())
+
+    run_benchmark([int(x) for x in args['sizes'].split(',')], args['messages'])
+
+
+if __name__ == "__main__":
+    main()
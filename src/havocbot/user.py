@@ -238,6 +238,9 @@ class ClientUser(object):
 class StasherClass(object):
     __metaclass__ = ABCMeta
 
+    def __init__(self):
+        self.change_listeners = []
+
     @abstractmethod
     def add_user(self, user):
         pass
@@ -302,6 +305,28 @@ class StasherClass(object):
     def build_user(self, result_data):
         pass
 
+    def add_change_listener(self, listener):
+        """ Registers a callable that is run as listener(user_id) after a user is changed.
+        """
+        self.change_listeners.append(listener)
+
+    def notify_change_listeners(self, user_id):
+        for listener in self.change_listeners:
+            try:
+                listener(user_id)
+            except Exception as e:
+                logger.error("Change listener failed for user id %s - %s" % (user_id, e))
+
+    def flush(self):
+        """ Writes any changes still held in memory to permanent storage.
+        """
+        pass
+
+    def close(self):
+        """ Flushes pending changes and releases the storage.
+        """
+        pass
+
 
 class UserDataAlreadyExistsException(Exception):
     pass
@@ -0,0 +1,114 @@
+import copy
+import logging
+import threading
+from tinydb.database import Element
+
+logger = logging.getLogger(__name__)
+
+
+class UserIndex(object):
+    """ In memory inverted index over the user documents of a stasher.
+
+    Maps (client, lowercase username), lowercase alias and lowercase name to
+    the ids of the users that have them so a lookup only touches the
+    matching users instead of scanning every document. The index keeps its
+    own copy of every document and hands out copies so callers can never
+    change it behind the stasher's back.
+
+    The stasher must call update() or remove() after every change it makes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = {}
+        self.usernames = {}
+        self.names = {}
+        self.aliases = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def rebuild(self, documents):
+        with self.lock:
+            self.documents = {}
+            self.usernames = {}
+            self.names = {}
+            self.aliases = {}
+
+            for document in documents:
+                self._add(document.eid, document)
+
+        logger.debug("Indexed %d users. %d usernames, %d names, %d aliases" % (
+            len(self.documents), len(self.usernames), len(self.names), len(self.aliases)))
+
+    def update(self, document):
+        with self.lock:
+            self._remove(document.eid)
+            self._add(document.eid, document)
+
+    def remove(self, eid):
+        with self.lock:
+            self._remove(eid)
+
+    def get(self, eid):
+        with self.lock:
+            return self._copy(eid) if eid in self.documents else None
+
+    def find_by_username(self, username, client_name):
+        with self.lock:
+            eids = self.usernames.get((client_name, username.lower()), ())
+
+            # The key is lowercase but usernames are matched exactly
+            return self._copies(x for x in eids if username in self.documents[x].get('usernames', {})[client_name])
+
+    def find_by_name(self, name, client_name):
+        with self.lock:
+            eids = self.names.get(name.lower(), ())
+            return self._copies(x for x in eids if client_name in self.documents[x].get('usernames', {}))
+
+    def find_by_alias(self, alias, client_name):
+        with self.lock:
+            eids = self.aliases.get(alias.lower(), ())
+            return self._copies(x for x in eids if client_name in self.documents[x].get('usernames', {}))
+
+    def _add(self, eid, document):
+        document = copy.deepcopy(dict(document))
+        self.documents[eid] = document
+
+        for (client_name, usernames) in (document.get('usernames') or {}).items():
+            for username in usernames:
+                self.usernames.setdefault((client_name, username.lower()), set()).add(eid)
+
+        if document.get('name') is not None:
+            self.names.setdefault(document['name'].lower(), set()).add(eid)
+
+        for alias in document.get('aliases') or []:
+            self.aliases.setdefault(alias.lower(), set()).add(eid)
+
+    def _remove(self, eid):
+        document = self.documents.pop(eid, None)
+        if document is None:
+            return
+
+        for (client_name, usernames) in (document.get('usernames') or {}).items():
+            for username in usernames:
+                self._discard(self.usernames, (client_name, username.lower()), eid)
+
+        if document.get('name') is not None:
+            self._discard(self.names, document['name'].lower(), eid)
+
+        for alias in document.get('aliases') or []:
+            self._discard(self.aliases, alias.lower(), eid)
+
+    def _discard(self, table, key, eid):
+        eids = table.get(key)
+        if eids is not None:
+            eids.discard(eid)
+            if not eids:
+                del table[key]
+
+    def _copies(self, eids):
+        return [self._copy(x) for x in sorted(eids)]
+
+    def _copy(self, eid):
+        return Element(copy.deepcopy(self.documents[eid]), eid)
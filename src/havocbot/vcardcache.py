@@ -0,0 +1,101 @@
+import logging
+from havocbot.cache import TTLCache
+from havocbot.common import gather_with_deadline
+
+logger = logging.getLogger(__name__)
+
+
+class VCardCache(object):
+    """ Cache of vCards keyed by bare JID for the XMPP based clients.
+
+    fetch_function takes a bare JID and returns its vCard or None. It is
+    usually a blocking IQ round trip so get_many() fetches the vCards that
+    are not cached batch_size at a time, waiting up to timeout seconds for
+    each batch. vCards are kept for ttl seconds and dropped as soon as the
+    client sees their owner leave through handle_presence().
+    """
+
+    def __init__(self, fetch_function, ttl=3600, max_size=1000, batch_size=20, timeout=10):
+        self.fetch_function = fetch_function
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    def __str__(self):
+        return "VCardCache(%s)" % self.cache
+
+    def get(self, jabber_id):
+        bare_jid = get_bare_jid(jabber_id)
+        if bare_jid is None:
+            return None
+
+        vcard = self.cache.get(bare_jid)
+
+        return vcard if vcard is not None else self._fetch(bare_jid)
+
+    def get_many(self, jabber_ids):
+        """ Returns a dictionary of bare JID to vCard for every JID that could be resolved.
+        """
+
+        vcards = {}
+        missing = []
+        bare_jids = set(get_bare_jid(x) for x in jabber_ids)
+        bare_jids.discard(None)
+
+        for bare_jid in bare_jids:
+            vcard = self.cache.get(bare_jid)
+            if vcard is not None:
+                vcards[bare_jid] = vcard
+            else:
+                missing.append(bare_jid)
+
+        cached = len(vcards)
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            results = gather_with_deadline([(self._fetch, (x,)) for x in batch], self.timeout, name='HavocBotVCard')
+            vcards.update((x, y) for (x, y) in zip(batch, results) if y is not None)
+
+        logger.debug("Resolved %d of %d vCards, %d from the cache" % (len(vcards), len(bare_jids), cached))
+
+        return vcards
+
+    def _fetch(self, bare_jid):
+        generation = self.cache.generation
+        vcard = self.fetch_function(bare_jid)
+
+        # Failed lookups are not cached so they are retried next time
+        if vcard is not None:
+            self.cache.set(bare_jid, vcard, generation=generation)
+
+        return vcard
+
+    def invalidate(self, jabber_id):
+        bare_jid = get_bare_jid(jabber_id)
+        if bare_jid is not None:
+            self.cache.remove(bare_jid)
+
+    def handle_presence(self, presence):
+        """ Drops the vCard of a user that went offline or left a room so it is fetched fresh when they return.
+        """
+
+        if presence['type'] != 'unavailable':
+            return
+
+        # Room presences come from room@server/nick. The real JID is only known in non anonymous rooms
+        jabber_id = presence['muc']['jid'] if presence['muc']['jid'] else presence['from']
+        self.invalidate(jabber_id)
+
+    def clear(self):
+        self.cache.clear()
+
+
+def get_bare_jid(jabber_id):
+    if jabber_id is None or not jabber_id:
+        return None
+
+    bare_jid = getattr(jabber_id, 'bare', None)
+    if bare_jid is None:
+        bare_jid = str(jabber_id).split('/', 1)[0]
+
+    return bare_jid or None